@@ -1,94 +1,296 @@
 from courtreader import readers
+from courtreader.opener import get_unavailable_courts
+from courtreader.pipeline import ParsePool
+from courtreader.records import HearingDateSearchResult, get_case_details_type
+from courtutils import metrics, tracing
 from courtutils.logger import get_logger
+from courtutils.databases.writer import WriteBehindWriter, WriterError
+from courtutils.profiler import SamplingProfiler, install_signal_toggle
+from courtutils.resilience import CircuitOpen, backoff_delay
+from courtutils.tasks import MAX_SEARCH_TTL, get_search_ttl
 from datetime import datetime, timedelta
 from time import sleep
+import argparse
 import os
-import sys
 import time
 import traceback
 
 MONGO = False
 POSTGRES = True
+SQLITE = False
 
 if MONGO:
     import pymongo
     from courtutils.databases.mongo import MongoDatabase
 if POSTGRES:
     from courtutils.databases.postgres import PostgresDatabase
+if SQLITE:
+    from courtutils.databases.sqlite import SqliteDatabase
 
 # configure logging
 log = get_logger()
-log.info('Worker running')
 
-COURT_TYPE = sys.argv[1]
-if COURT_TYPE != 'circuit' and COURT_TYPE != 'district':
-    raise ValueError('Unknown court type')
+# set from the command line when run as a script
+COURT_TYPE = None
+PARSE_PROCESSES = 0
+WRITE_BEHIND = False
+SESSION_POOL = False
+HEDGE = False
+
+CASES = metrics.counter(
+    'collector_cases_total',
+    'Cases found in hearing date searches, by what the collector did with them',
+    ['court', 'case_type', 'result'])
+DATES_SEARCHED = metrics.counter(
+    'collector_dates_searched_total', 'Hearing dates searched',
+    ['court', 'case_type'])
+SEARCH_CACHE = metrics.counter(
+    'collector_search_cache_total',
+    'Hearing date searches answered from the cache (hit) or the court site (miss)',
+    ['court', 'result'])
+TASK_RETRIES = metrics.counter(
+    'collector_task_retries_total',
+    'Tasks put back on the queue after an error', ['court'])
+
+# After unexpected errors, the collector waits a random time up to
+# ERROR_BACKOFF_BASE seconds, doubling with each error in a row, up to
+# ERROR_BACKOFF_CAP seconds
+ERROR_BACKOFF_BASE = 15
+ERROR_BACKOFF_CAP = 600
+
+# Save the cases done on the current date to the task every this many cases
+CURSOR_INTERVAL = 25
 
 def get_db_connection():
     if MONGO:
         return MongoDatabase('va_court_search', COURT_TYPE)
     if POSTGRES:
         return PostgresDatabase(COURT_TYPE)
+    if SQLITE:
+        return SqliteDatabase(COURT_TYPE)
     return None
 
-def get_cases_on_date(db, reader, fips, case_type, date, dateStr):
+class DateCursor:
+    """The case numbers done so far on the date a task is working on,
+    saved to the task as they go so a task that's put back, or taken over
+    by another worker, picks up from the same case."""
+    def __init__(self, store, task, date):
+        self.store = store
+        self.task = task
+        self.date = date
+        self.cases = []
+        cursor = task.get('cursor')
+        if cursor is not None and cursor['date'] == date:
+            self.cases = list(cursor['cases'])
+        self.done_cases = set(self.cases)
+
+    @property
+    def resuming(self):
+        return len(self.cases) > 0
+
+    def is_done(self, case_number):
+        return case_number in self.done_cases
+
+    def add(self, case_number):
+        self.cases.append(case_number)
+        self.done_cases.add(case_number)
+        if len(self.cases) % CURSOR_INTERVAL == 0:
+            self.store.update_date_task_cursor(self.task, self.date, self.cases)
+
+    def to_dict(self):
+        return {'date': self.date, 'cases': self.cases}
+
+def get_cases_on_date(db, store, reader, parse_pool, fips, case_type, date, dateStr, cursor):
     log.info('Getting cases on ' + dateStr)
-    sleep(1)
-    cases = reader.get_cases_by_date(fips, case_type, dateStr)
+    search_trace = tracing.Trace('hearing_date_search', court=COURT_TYPE,
+                                 fips=fips, case_type=case_type, date=dateStr)
+    with search_trace.active():
+        cases = search_hearing_date(db, reader, fips, case_type, date, dateStr,
+                                    cursor.resuming)
+        # a case with several hearings on the date is listed once for each,
+        # but only needs collecting once
+        case_numbers = set()
+        unique_cases = []
+        for case in cases:
+            if case['case_number'] not in case_numbers:
+                case_numbers.add(case['case_number'])
+                unique_cases.append(case)
+        cases = unique_cases
+        # one lookup for every case's already collected details
+        collected_dates = db.get_more_recent_case_dates(
+            fips, case_type,
+            set(case['case_number'] for case in cases if not cursor.is_done(case['case_number'])),
+            date)
+    search_trace.attributes['cases'] = len(cases)
+    tracing.record(search_trace)
+    if cursor.resuming:
+        log.info('Resuming after %s cases', len(cursor.cases))
     for case in cases:
-        case['details_fetched_for_hearing_date'] = date
-        case['fips'] = fips
-        case['collected'] = datetime.now()
-        case_details = db.get_more_recent_case_details(case, case_type, date)
-        if case_details != None:
-            last_date = case_details['details_fetched_for_hearing_date'].strftime('%m/%d/%Y')
-            log.info('%s details collected for hearing on %s', case['case_number'], last_date)
+        if cursor.is_done(case['case_number']):
             continue
-        if '--' in case['case_number']:
-            if case_type == 'civil':
-                case['details'] = {
-                    'CaseNumber': case['case_number']
-                }
-            elif 'defendant' in case:
-                case['details'] = {
-                    'CaseNumber': case['case_number'],
-                    'Defendant': case['defendant']
-                }
-        else:
-            case['details'] = reader.get_case_details_by_number(
-                fips, case_type, case['case_number'],
-                case['details_url'] if 'details_url' in case else None)
-        if 'error' in case['details']:
-            log.warn('Could not collect case details for %s in %s',
-                     case['case_number'], case['fips'])
-        else:
-            log.info('%s %s', case['case_number'], case['defendant'])
-            db.replace_case_details(case, case_type)
-
-def run_collector(reader, last_task):
+        trace = tracing.Trace('case', court=COURT_TYPE, fips=fips,
+                              case_type=case_type, case_number=case['case_number'])
+        with trace.active():
+            parsing = collect_case(store, reader, parse_pool, fips, case_type, date, case,
+                                   collected_dates.get(case['case_number']), trace)
+        if not parsing:
+            tracing.record(trace)
+            cursor.add(case['case_number'])
+        if parse_pool is not None:
+            # store whatever has finished parsing in the meantime
+            store_parsed_cases(store, parse_pool.completed(), case_type, cursor)
+    if parse_pool is not None:
+        # Every case has to be stored before the date is marked as searched
+        store_parsed_cases(store, parse_pool.drain(), case_type, cursor)
+
+def search_hearing_date(db, reader, fips, case_type, date, dateStr, resuming=False):
+    # results are reused for as long as a search of the date stays fresh
+    fetched_since = datetime.now() - get_search_ttl(date)
+    if resuming:
+        # the cases done so far came from the cached results, whatever
+        # their age, and the rest should come from the same list
+        fetched_since = datetime.min
+    cached_cases = db.get_cached_search_results(fips, case_type, date, fetched_since)
+    if cached_cases is not None:
+        log.info('Using cached search results for %s', dateStr)
+        SEARCH_CACHE.inc(court=COURT_TYPE, result='hit')
+        return [HearingDateSearchResult(**case) for case in cached_cases]
+    SEARCH_CACHE.inc(court=COURT_TYPE, result='miss')
+    sleep(1)
+    cases = reader.get_cases_by_date(fips, case_type, dateStr)
+    db.cache_search_results(fips, case_type, date, cases)
+    return cases
+
+def collect_case(store, reader, parse_pool, fips, case_type, date, case, collected_date, trace):
+    """Collect and store a case's details, unless collected_date, the
+    hearing date its stored details were collected for, is set. Returns True
+    if the case was handed to the parse pool instead, to be stored once it's
+    parsed."""
+    case['details_fetched_for_hearing_date'] = date
+    case['fips'] = fips
+    case['collected'] = datetime.now()
+    if collected_date is not None:
+        last_date = collected_date.strftime('%m/%d/%Y')
+        log.info('%s details collected for hearing on %s', case['case_number'], last_date)
+        CASES.inc(court=COURT_TYPE, case_type=case_type, result='already_collected')
+        return False
+    if '--' in case['case_number']:
+        case_details_type = get_case_details_type(COURT_TYPE, case_type)
+        if case_type == 'civil':
+            case['details'] = case_details_type(
+                CaseNumber=case['case_number']
+            )
+        elif 'defendant' in case:
+            case['details'] = case_details_type(
+                CaseNumber=case['case_number'],
+                Defendant=case['defendant']
+            )
+    elif parse_pool is not None:
+        # Hand the raw pages off to be parsed and keep fetching
+        pages = reader.fetch_case_details_by_number(
+            fips, case_type, case['case_number'],
+            case['details_url'] if 'details_url' in case else None)
+        parse_pool.submit(case, case_type, pages, trace)
+        return True
+    else:
+        case['details'] = reader.get_case_details_by_number(
+            fips, case_type, case['case_number'],
+            case['details_url'] if 'details_url' in case else None)
+    store_case_details(store, case, case_type)
+    return False
+
+def store_parsed_cases(store, parsed_cases, case_type, cursor):
+    for case, details, trace in parsed_cases:
+        case['details'] = details
+        with trace.active():
+            store_case_details(store, case, case_type)
+        tracing.record(trace)
+        cursor.add(case['case_number'])
+
+def store_case_details(store, case, case_type):
+    if 'error' in case['details']:
+        log.warn('Could not collect case details for %s in %s',
+                 case['case_number'], case['fips'])
+        CASES.inc(court=COURT_TYPE, case_type=case_type, result='error')
+    else:
+        log.info('%s %s', case['case_number'], case['defendant'])
+        store.replace_case_details(case, case_type)
+        CASES.inc(court=COURT_TYPE, case_type=case_type, result='stored')
+
+def remaining_task(task, date, end_date, cursor):
+    # Only the dates that haven't been checkpointed go back on the queue,
+    # with the cases already done on the first of them
+    task = dict(task)
+    task['start_date'] = date
+    task['end_date'] = end_date
+    task['cursor'] = None
+    if cursor is not None and cursor.date == date and cursor.resuming:
+        task['cursor'] = cursor.to_dict()
+    return task
+
+def close_writer(writer):
+    """Commit the writer's queued writes. Returns False if some of them
+    were lost."""
+    if writer is None:
+        return True
+    try:
+        writer.close()
+        return True
+    except WriterError:
+        log.error(traceback.format_exc())
+        return False
+
+def run_collector(reader, parse_pool, last_task):
     db = get_db_connection()
 
-    task = db.get_and_delete_date_task(last_task)
+    # Prefer work on the court the reader's session is already on, so it
+    # doesn't have to change courts
+    current_fips = reader.fips_code or None
+    current_case_type = reader.case_type or None
+    # and leave courts whose sites are failing for later
+    unavailable = get_unavailable_courts(COURT_TYPE)
+    if unavailable:
+        log.info('Skipping tasks for %s until their sites recover',
+                 ', '.join(sorted(unavailable)))
+    task = db.get_and_delete_date_task(last_task, current_fips, current_case_type,
+                                       exclude_fips=unavailable)
+    if task is None:
+        # help out with whichever running task has the most dates left
+        task = db.split_active_date_task(current_fips, current_case_type,
+                                         exclude_fips=unavailable)
+        if task is not None:
+            log.info('Took over %s %s %s-%s from a running task',
+                     task['fips'], task['case_type'],
+                     task['start_date'].strftime('%m/%d/%Y'),
+                     task['end_date'].strftime('%m/%d/%Y'))
     if task is None:
         log.info('Nothing to do. Sleeping for 30 seconds.')
         sleep(30)
         return
 
-    try:
-        reader_connected = False
+    fips = task['fips']
+    start_date = task['start_date']
+    end_date = task['end_date']
+    case_type = task['case_type']
+    date = start_date
+    cursor = None
+    # Case details, dates searched and cursors are stored either straight
+    # away or, with a write-behind writer, in batches by a background thread
+    writer = None
+    store = db
+    if WRITE_BEHIND:
+        writer = store = WriteBehindWriter(get_db_connection)
 
-        fips = task['fips']
-        start_date = task['start_date']
-        end_date = task['end_date']
-        case_type = task['case_type']
+    try:
 
         log.info('Start %s %s %s-%s',
                  fips,
                  case_type,
                  start_date.strftime('%m/%d/%Y'),
                  end_date.strftime('%m/%d/%Y'))
-        date = start_date
 
+        # end_date can move up while we work if another worker splits off
+        # the rest of the range, so it's re-read at every checkpoint
         while date >= end_date:
             date_search = {
                 'fips': fips,
@@ -99,20 +301,40 @@ def run_collector(reader, last_task):
             if db.get_date_search(date_search) != None:
                 log.info(date_str + ' already searched')
             else:
-                if not reader_connected:
-                    reader.connect()
-                    reader_connected = True
-                get_cases_on_date(db, reader, fips, case_type, date, date_str)
-                db.add_date_search(date_search)
+                # the reader connects on first use and keeps its session
+                # across tasks, reconnecting only when the site expires it
+                cursor = DateCursor(store, task, date)
+                get_cases_on_date(db, store, reader, parse_pool, fips, case_type,
+                                  date, date_str, cursor)
+                store.add_date_search(date_search)
+                DATES_SEARCHED.inc(court=COURT_TYPE, case_type=case_type)
+                if writer is not None:
+                    # the date is only checkpointed once it's stored
+                    writer.flush()
+            end_date = db.update_date_task_progress(task, date)
             date += timedelta(days=-1)
-
-        if reader_connected:
-            reader.log_off()
+    except CircuitOpen, err:
+        # the court's site is failing; the session is fine for other courts
+        log.warn('%s. Putting task back', err)
+        TASK_RETRIES.inc(court=COURT_TYPE)
+        if parse_pool is not None:
+            parse_pool.discard()
+        if not close_writer(writer):
+            cursor = None
+        db.rollback()
+        db.add_date_task(remaining_task(task, date, end_date, cursor), True)
+        db.disconnect()
+        return None
     except Exception, err:
         log.error(traceback.format_exc())
         log.warn('Putting task back')
+        TASK_RETRIES.inc(court=COURT_TYPE)
+        if parse_pool is not None:
+            parse_pool.discard()
+        if not close_writer(writer):
+            cursor = None
         db.rollback()
-        db.add_date_task(task, True)
+        db.add_date_task(remaining_task(task, date, end_date, cursor), True)
         db.disconnect()
         try:
             reader.log_off()
@@ -121,8 +343,10 @@ def run_collector(reader, last_task):
         raise
     except KeyboardInterrupt:
         log.warn('Putting task back')
+        if not close_writer(writer):
+            cursor = None
         db.rollback()
-        db.add_date_task(task, True)
+        db.add_date_task(remaining_task(task, date, end_date, cursor), True)
         db.disconnect()
         try:
             reader.log_off()
@@ -130,28 +354,100 @@ def run_collector(reader, last_task):
             pass
         raise
 
+    close_writer(writer)
+    log.info('Finished %s %s, %s court changes so far',
+             fips, case_type, reader.court_changes)
     db.disconnect()
     return task
 
 def get_reader():
     return readers.CircuitCourtReader() if 'circuit' in COURT_TYPE else \
-            readers.DistrictCourtReader()
+            readers.DistrictCourtReader(SESSION_POOL, HEDGE)
+
+def prune_search_cache():
+    # results older than the longest TTL can't be fresh for any date
+    db = get_db_connection()
+    pruned = db.prune_search_cache(datetime.now() - MAX_SEARCH_TTL)
+    if pruned:
+        log.info('Pruned %s cached search results', pruned)
+    db.disconnect()
 
 def run():
+    prune_search_cache()
     reader = None
+    parse_pool = None
+    if PARSE_PROCESSES > 0:
+        parse_pool = ParsePool(COURT_TYPE, PARSE_PROCESSES)
     finished_task = None
-    while True:
-        try:
-            if reader is None:
-                reader = get_reader()
-            finished_task = run_collector(reader, finished_task)
-        except Exception, err:
+    errors_in_a_row = 0
+    try:
+        while True:
             try:
-                reader.log_off()
-            except:
-                pass
-            reader = None
-            log.error(traceback.format_exc())
-            log.info('Unexpect error. Sleeping for 10 minute')
-            sleep(600)
-run()
+                if reader is None:
+                    reader = get_reader()
+                finished_task = run_collector(reader, parse_pool, finished_task)
+                errors_in_a_row = 0
+            except Exception, err:
+                try:
+                    reader.log_off()
+                except:
+                    pass
+                reader = None
+                log.error(traceback.format_exc())
+                delay = backoff_delay(errors_in_a_row, ERROR_BACKOFF_BASE, ERROR_BACKOFF_CAP)
+                errors_in_a_row += 1
+                log.info('Unexpected error. Sleeping for %.0f seconds', delay)
+                sleep(delay)
+    finally:
+        if parse_pool is not None:
+            parse_pool.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('court_type', choices=['circuit', 'district'])
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        help='parse case details in this many worker processes '
+                             'while the main process keeps fetching (default: parse inline)')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='store cases in batches from a background thread '
+                             'while the collector keeps fetching')
+    parser.add_argument('--session-pool', action='store_true',
+                        help='wait for district court sessions from court_session_pool.py '
+                             'instead of solving CAPTCHAs')
+    parser.add_argument('--hedge', action='store_true',
+                        help='repeat slow district case details requests on a second '
+                             'stored session and use whichever answers first')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics at http://localhost:PORT/metrics')
+    parser.add_argument('--metrics-file',
+                        help='write metrics to this file every minute')
+    parser.add_argument('--trace-file',
+                        help='append per-case timing breakdowns to this JSONL file')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.1,
+                        help='fraction of cases to write to the trace file (default: 0.1)')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the sampling profiler from startup')
+    parser.add_argument('--profile-seconds', type=int, default=60,
+                        help='length of each profiling window, 0 to run until '
+                             'toggled off with SIGUSR2 (default: 60)')
+    parser.add_argument('--profile-dir', default='.',
+                        help='directory to write collapsed stack files to')
+    args = parser.parse_args()
+    COURT_TYPE = args.court_type
+    PARSE_PROCESSES = args.parse_processes
+    WRITE_BEHIND = args.write_behind
+    SESSION_POOL = args.session_pool
+    HEDGE = args.hedge
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    if args.metrics_file is not None:
+        metrics.start_file_writer(args.metrics_file)
+    if args.trace_file is not None:
+        tracing.configure(args.trace_file, args.trace_sample_rate)
+    # kill -USR2 <pid> starts or stops a profiling window on a running worker
+    profiler = SamplingProfiler(args.profile_dir, duration=args.profile_seconds)
+    install_signal_toggle(profiler)
+    if args.profile:
+        profiler.start()
+    log.info('Worker running')
+    run()
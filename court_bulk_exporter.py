@@ -10,7 +10,7 @@ import zipfile
 import boto3
 from firebase import firebase
 
-from courtutils.databases.postgres import PostgresDatabase
+from courtutils.databases.postgres import PostgresDatabase, PARTITIONED_TABLES
 
 # PGHOST, PGDATABASE, PGUSER, PGPASSWORD
 
@@ -194,6 +194,15 @@ ORDER BY p.person_id
     ]
     print start_id, subprocess.check_output(psql_cmd)
 
+def get_partition_filter(child_table, year):
+    # Child rows of a partitioned table are in the partition for their
+    # case's year; saying so keeps the join from scanning every year
+    if child_table not in PARTITIONED_TABLES:
+        return ''
+    return 'and "{0}".{1} >= \'{2}\' and "{0}".{1} < \'{3}\' '.format(
+        child_table, 'details_fetched_for_hearing_date', '1/1/' + str(year), '1/1/' + str(year+1)
+    )
+
 def download_data_by_year(table, year, outfile_path, case_type):
     if case_type == 'civil':
         copy_cmd = '\\copy (Select * From "{}" '.format(table)
@@ -216,6 +225,7 @@ def download_data_by_year(table, year, outfile_path, case_type):
         copy_cmd += 'WHERE "{0}".{1} >= \'{2}\' and "{0}".{1} < \'{3}\' '.format(
             table, 'details_fetched_for_hearing_date', '1/1/' + str(year), '1/1/' + str(year+1)
         )
+        copy_cmd += get_partition_filter(hearing_table, year)
         copy_cmd += 'ORDER BY case_id, "Date" DESC) To \'{}\' With CSV HEADER;'.format(
             outfile_path
         )
@@ -240,9 +250,10 @@ def download_party_data(table, party_table, year, outfile_path):
     copy_cmd += 'inner join "{}" on "{}".case_id = "{}".id '.format(
         party_table, party_table, table
     )
-    copy_cmd += 'where {0} >= \'{1}\' and {0} < \'{2}\' '.format(
-        'details_fetched_for_hearing_date', '1/1/' + str(year), '1/1/' + str(year+1)
+    copy_cmd += 'where "{0}".{1} >= \'{2}\' and "{0}".{1} < \'{3}\' '.format(
+        table, 'details_fetched_for_hearing_date', '1/1/' + str(year), '1/1/' + str(year+1)
     )
+    copy_cmd += get_partition_filter(party_table, year)
     copy_cmd += 'order by "{}".case_id) To \'{}\' With CSV HEADER;'.format(
         party_table, outfile_path
     )
@@ -267,64 +278,84 @@ def create_data_files(filepath, temp_filepath, court_type, case_type):
     with open(temp_filepath, 'r') as temp_file:
         data_file = None
         anon_data_file = None
-        data_reader = csv.DictReader(temp_file)
+        data_reader = csv.reader(temp_file)
+        header = data_reader.next()
         party_readers = []
         if case_type == 'civil':
             for party in PARTIES:
                 party_filepath = get_party_temp_file(temp_filepath, party)
                 party_file = open(party_filepath, 'r')
+                party_reader = csv.reader(party_file)
+                party_header = party_reader.next()
                 party_readers.append({
                     'filepath': party_filepath, 'file': party_file,
-                    'name': party, 'reader': csv.DictReader(party_file), 'lastRead': None
+                    'name': party, 'reader': party_reader, 'lastRead': None,
+                    'caseIdColumn': party_header.index('case_id'),
+                    'fieldColumns': [party_header.index(field)
+                                     for field in get_party_fields(court_type)]
                 })
+
+        # Rows stay as lists and are written through column projections that
+        # are worked out once, instead of building and rewriting a dict per case.
+        # Duplicate column names (e.g. id from a join) resolve to the last one,
+        # as they did when rows were read into dicts.
+        columns = dict((field, i) for i, field in enumerate(header))
+        fieldnames = list(header)
+        sources = [columns[field] for field in header]
+        for party in party_readers:
+            party_headers = get_party_headers(party['name'], court_type)
+            sources.extend(range(len(fieldnames), len(fieldnames) + len(party_headers)))
+            fieldnames.extend(party_headers)
+
+        complete_fieldnames = []
+        complete_columns = []
+        for field, source in zip(fieldnames, sources):
+            if field in REMOVE_FIELDS:
+                continue
+            complete_fieldnames.append(ALTER_FIELDS.get(field, field))
+            complete_columns.append(source)
+        anon_fieldnames = []
+        anon_columns = []
+        for field, source in zip(complete_fieldnames, complete_columns):
+            if field in ANON_FIELDS:
+                continue
+            anon_fieldnames.append(field)
+            anon_columns.append(source)
+
+        id_column = columns.get('id')
+        date_column = columns.get('Date')
+
         case_count = 0
         for case in data_reader:
             if case_count % CASES_PER_FILE == 0:
-                fieldnames = list(data_reader.fieldnames)
-                for party in party_readers:
-                    fieldnames.extend(get_party_headers(party['name'], court_type))
-
-                fieldnames = [field for field in fieldnames if field not in REMOVE_FIELDS]
-                fieldnames = [field if field not in ALTER_FIELDS else ALTER_FIELDS[field] for field in fieldnames]
                 if data_file: data_file.close()
                 metadata['complete']['filepaths'].append('{}_{}.csv'.format(
                     filepath, str(case_count/CASES_PER_FILE).zfill(2)
                 ))
                 data_file = open(metadata['complete']['filepaths'][-1], 'w')
-                data_writer = csv.DictWriter(data_file, fieldnames=fieldnames)
-                data_writer.writeheader()
+                data_writer = csv.writer(data_file)
+                data_writer.writerow(complete_fieldnames)
 
-                fieldnames = [field for field in fieldnames if field not in ANON_FIELDS]
                 if anon_data_file: anon_data_file.close()
                 metadata['anon']['filepaths'].append('{}_anon_{}.csv'.format(
                     filepath, str(case_count/CASES_PER_FILE).zfill(2)
                 ))
                 anon_data_file = open(metadata['anon']['filepaths'][-1], 'w')
-                anon_data_writer = csv.DictWriter(anon_data_file, fieldnames=fieldnames)
-                anon_data_writer.writeheader()
+                anon_data_writer = csv.writer(anon_data_file)
+                anon_data_writer.writerow(anon_fieldnames)
 
             for party in party_readers:
-                party['curCaseParties'], party['lastRead'] = get_parties(
-                    case['id'], party['reader'], party['lastRead']
+                parties, party['lastRead'] = get_parties(
+                    case[id_column], party['reader'], party['lastRead'],
+                    party['caseIdColumn']
                 )
-                add_parties_to_case(case, party['curCaseParties'], party['name'], court_type)
-
-            for field in ALTER_FIELDS:
-                if field in case:
-                    if field == 'Date':
-                        case[field] = case[field].split(' ')[0]
-                    case[ALTER_FIELDS[field]] = case[field]
-                    del case[field]
+                case.extend(get_party_values(parties, party['fieldColumns']))
 
-            for field in REMOVE_FIELDS:
-                if field in case:
-                    del case[field]
-            data_writer.writerow(case)
+            if date_column is not None:
+                case[date_column] = case[date_column].split(' ')[0]
 
-            for field in ANON_FIELDS:
-                if field in case:
-                    del case[field]
-            anon_data_writer.writerow(case)
+            data_writer.writerow([case[i] for i in complete_columns])
+            anon_data_writer.writerow([case[i] for i in anon_columns])
 
             case_count += 1
     metadata['cases'] = case_count
@@ -348,13 +379,16 @@ def get_party_headers(party_name, court_type):
             party_headers.append(party_name + str(i+1) + field)
     return party_headers
 
-def add_parties_to_case(case, parties, party_name, court_type):
+def get_party_values(parties, field_columns):
+    values = []
     for i in range(0, 3):
         if len(parties) > i:
-            for field in get_party_fields(court_type):
-                case[party_name + str(i+1) + field] = parties[i][field]
+            values.extend([parties[i][column] for column in field_columns])
+        else:
+            values.extend([''] * len(field_columns))
+    return values
 
-def get_parties(case_id, party_reader, last_party_read):
+def get_parties(case_id, party_reader, last_party_read, case_id_column):
     parties = []
     party = last_party_read
     while True:
@@ -364,7 +398,7 @@ def get_parties(case_id, party_reader, last_party_read):
             except StopIteration:
                 print 'EOF'
                 return (parties, party)
-        if party['case_id'] != case_id:
+        if party[case_id_column] != case_id:
             return (parties, party)
         parties.append(party)
         party = None
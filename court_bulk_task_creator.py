@@ -1,6 +1,8 @@
 from courtreader import readers
 from courtutils.logger import get_logger
+from courtutils.tasks import MAX_TASK_DAYS, plan_date_tasks
 from datetime import datetime, timedelta
+import argparse
 import csv
 import os
 import sys
@@ -8,48 +10,54 @@ import time
 
 MONGO = False
 POSTGRES = True
+SQLITE = False
 
 if MONGO:
     import pymongo
     from courtutils.databases.mongo import MongoDatabase
 if POSTGRES:
     from courtutils.databases.postgres import PostgresDatabase
+if SQLITE:
+    from courtutils.databases.sqlite import SqliteDatabase
 
 # get command line args
-start_date = datetime.strptime(sys.argv[1], '%m/%d/%Y')
-end_date = datetime.strptime(sys.argv[2], '%m/%d/%Y')
+parser = argparse.ArgumentParser(
+    description='Create tasks for the dates in a range that have not been searched')
+parser.add_argument('start_date', help='newest date, e.g. 6/6/2017')
+parser.add_argument('end_date', help='oldest date')
+parser.add_argument('court_type', choices=['circuit', 'district'])
+parser.add_argument('case_type', choices=['criminal', 'civil'])
+parser.add_argument('fips', nargs='?', help='only create tasks for this court')
+parser.add_argument('--max-days', type=int, default=MAX_TASK_DAYS,
+                    help='split ranges longer than this many days into separate tasks '
+                         '(default: {})'.format(MAX_TASK_DAYS))
+args = parser.parse_args()
+
+start_date = datetime.strptime(args.start_date, '%m/%d/%Y')
+end_date = datetime.strptime(args.end_date, '%m/%d/%Y')
 if start_date < end_date:
     raise ValueError('Start Date must be after End Date so they decend')
 
-court_type = sys.argv[3]
-if court_type != 'circuit' and court_type != 'district':
-    raise ValueError('Unknown court type')
-
-case_type = sys.argv[4]
-if case_type != 'criminal' and case_type != 'civil':
-    raise ValueError('Unknown case type')
+court_type = args.court_type
+case_type = args.case_type
 
 # connect to database
 db = None
 if MONGO: db = MongoDatabase('va_court_search', court_type)
 if POSTGRES: db = PostgresDatabase(court_type)
+if SQLITE: db = SqliteDatabase(court_type)
 
 # get the courts to create tasks for
 # check command line args for a specific court
 courts = list(db.get_courts())
-if len(sys.argv) > 5:
-    courts = [court for court in courts if court['fips'] == sys.argv[5]]
-
-# create the tasks
-tasks = []
-for court in courts:
-    tasks.append({
-        'fips': court['fips'],
-        'start_date': start_date,
-        'end_date': end_date,
-        'case_type': case_type
-    })
+if args.fips is not None:
+    courts = [court for court in courts if court['fips'] == args.fips]
+
+# create tasks for the dates that haven't been searched and aren't in
+# another task already
+tasks = plan_date_tasks(db, [court['fips'] for court in courts], case_type,
+                        start_date, end_date, args.max_days)
 
 # add the tasks to the database
 db.add_date_tasks(tasks)
-print 'Created', len(tasks), 'tasks'
+print 'Created', len(tasks), 'tasks for', len(set(task['fips'] for task in tasks)), 'courts'
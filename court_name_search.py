@@ -0,0 +1,37 @@
+import argparse
+import json
+import sys
+from courtreader import namesearch
+from courtutils.logger import get_logger
+
+# Searches every court for a name, a number of courts at a time, and prints
+# the cases found, one JSON object per line
+
+log = get_logger()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Search every court for cases with a party of this name')
+    parser.add_argument('name', help='last name, or LAST, FIRST')
+    parser.add_argument('case_type', choices=['criminal', 'civil'])
+    parser.add_argument('--court-type', choices=namesearch.COURT_TYPES,
+                        help='search only district or circuit courts')
+    parser.add_argument('--fips', nargs='+',
+                        help='search only the courts with these fips codes')
+    parser.add_argument('--workers', type=int, default=namesearch.DEFAULT_WORKERS,
+                        help='courts to search at once (default: %(default)s)')
+    parser.add_argument('--session-pool', action='store_true',
+                        help='wait for district court sessions from court_session_pool.py '
+                             'instead of solving CAPTCHAs')
+    args = parser.parse_args()
+    court_types = namesearch.COURT_TYPES if args.court_type is None \
+                  else (args.court_type,)
+    cases, failures = namesearch.search_name(
+        args.name, args.case_type, court_types, args.fips,
+        args.workers, args.session_pool)
+    for case in cases:
+        print json.dumps(case)
+    for court_type, fips_code, error in failures:
+        log.warn('Could not search %s court %s: %s', court_type, fips_code, error)
+    log.info('Found %s cases, %s courts failed', len(cases), len(failures))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,59 @@
+import argparse
+from courtutils.databases import partitions
+from courtutils.databases.postgres import PostgresDatabase, create_postgres_engine
+from courtutils.logger import get_logger
+
+# Manages the yearly partitioned case tables. See
+# courtutils/databases/partitions.py for how they're laid out. Collectors
+# and the exporter check whether the tables are partitioned when they
+# start, so restart them after migrating.
+
+log = get_logger()
+
+def parse_years(values):
+    years = []
+    for value in values:
+        if '-' in value:
+            start, end = value.split('-')
+            years.extend(range(int(start), int(end) + 1))
+        else:
+            years.append(int(value))
+    return years
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Partition the case tables by year of hearing date')
+    subparsers = parser.add_subparsers(dest='command')
+
+    create_parser = subparsers.add_parser(
+        'create', help='create partitioned case tables in a new database')
+    create_parser.add_argument('years', nargs='*', help='years to add partitions for, e.g. 2010-2017')
+
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='copy the existing flat case tables into partitioned tables')
+    migrate_parser.add_argument('--drop-flat', action='store_true',
+                                help='drop the flat tables afterwards instead of keeping them as <table>_flat')
+
+    add_parser = subparsers.add_parser(
+        'add-years', help='add partitions, moving their rows out of the default partitions')
+    add_parser.add_argument('years', nargs='+', help='e.g. 2018 or 2018-2020')
+
+    detach_parser = subparsers.add_parser(
+        'detach-year', help="detach a year's partitions to archive them")
+    detach_parser.add_argument('year', type=int)
+
+    args = parser.parse_args()
+    engine = create_postgres_engine()
+    if args.command == 'create':
+        partitions.create_partitioned_tables(engine, parse_years(args.years))
+        # then the rest of the tables, as usual
+        PostgresDatabase('district')
+    elif args.command == 'migrate':
+        # brings the flat tables up to date with the models first
+        PostgresDatabase('district')
+        partitions.migrate_flat_tables(engine, args.drop_flat)
+    elif args.command == 'add-years':
+        partitions.add_year_partitions(engine, parse_years(args.years))
+    elif args.command == 'detach-year':
+        partitions.detach_year_partitions(engine, args.year)
+    log.info('Done')
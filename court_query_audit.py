@@ -0,0 +1,136 @@
+import argparse
+import json
+import sys
+from sqlalchemy import text
+from courtutils.databases import postgres
+from courtutils.databases.postgres import create_postgres_engine, get_child_tables
+from courtutils.logger import get_logger
+
+# Checks that the queries the collectors and exporter run most use indexes.
+# `explain` runs EXPLAIN ANALYZE on each of them, with parameters taken
+# from rows already in the database, and exits with an error if any plan
+# has a sequential scan on a large table. Point POSTGRES_DB at a test copy
+# of the database; the queries only read, but the scans are real.
+# `create-indexes` adds the indexes declared on the models to a database
+# created before they were.
+
+log = get_logger()
+
+def get_hot_queries():
+    """(name, query to find sample parameters, query to explain)"""
+    queries = []
+    for case_builder in postgres.CASE_TABLES:
+        table = case_builder.__tablename__
+        queries.append((
+            'get_more_recent_case_details ' + table,
+            'SELECT fips, "CaseNumber" AS case_number, '
+            'details_fetched_for_hearing_date AS date FROM "{}" LIMIT 1'.format(table),
+            'SELECT * FROM "{}" WHERE fips = :fips AND "CaseNumber" = :case_number '
+            'AND details_fetched_for_hearing_date >= :date LIMIT 1'.format(table)
+        ))
+        for child_builder in get_child_tables(case_builder):
+            child_table = child_builder.__tablename__
+            queries.append((
+                'case rows ' + child_table,
+                'SELECT case_id FROM "{}" LIMIT 1'.format(child_table),
+                'SELECT * FROM "{}" WHERE case_id = :case_id'.format(child_table)
+            ))
+    for table, name_column, sex_column in [
+            (postgres.CircuitCriminalCase.__tablename__, 'Defendant', 'Sex'),
+            (postgres.DistrictCriminalCase.__tablename__, 'Name', 'Gender')]:
+        queries.append((
+            'list_people_to_id ' + table,
+            'SELECT "DOB" AS dob, "{1}" AS sex, substr("{0}", 1, 1) || \'%\' AS prefix '
+            'FROM "{2}" WHERE "DOB" IS NOT NULL AND "{0}" IS NOT NULL LIMIT 1'.format(
+                name_column, sex_column, table),
+            'SELECT id, "{0}", "Address" FROM "{2}" '
+            'WHERE "DOB" = :dob AND "{0}" LIKE :prefix AND "{1}" = :sex'.format(
+                name_column, sex_column, table)
+        ))
+    for builder in [postgres.CircuitCourtDateSearch, postgres.DistrictCourtDateSearch]:
+        table = builder.__tablename__
+        queries.append((
+            'get_date_search ' + table,
+            'SELECT fips, date, casetype FROM "{}" LIMIT 1'.format(table),
+            'SELECT * FROM "{}" WHERE fips = :fips AND date = :date '
+            'AND casetype = :casetype LIMIT 1'.format(table)
+        ))
+    return queries
+
+def get_scans(plan):
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for child_plan in plan.get('Plans', []):
+        for relation in get_scans(child_plan):
+            yield relation
+
+def get_row_estimate(connection, relation):
+    return connection.execute(text(
+        'SELECT reltuples FROM pg_class WHERE relname = :relation'
+    ), relation=relation).scalar() or 0
+
+def explain(engine, min_rows):
+    failures = 0
+    with engine.connect() as connection:
+        for name, sample_query, query in get_hot_queries():
+            sample = connection.execute(sample_query).first()
+            if sample is None:
+                print '{:<60} skipped, no rows to take parameters from'.format(name)
+                continue
+            result = connection.execute(
+                text('EXPLAIN (ANALYZE, FORMAT JSON) ' + query), **dict(sample.items())
+            ).scalar()
+            if isinstance(result, basestring):
+                result = json.loads(result)
+            plan = result[0]
+
+            large_scans = []
+            for relation in get_scans(plan['Plan']):
+                rows = get_row_estimate(connection, relation)
+                if rows >= min_rows:
+                    large_scans.append('{} ({:.0f} rows)'.format(relation, rows))
+            if large_scans:
+                failures += 1
+                status = 'SEQ SCAN on ' + ', '.join(large_scans)
+            else:
+                status = 'ok'
+            print '{:<60} {:>9.2f} ms  {}'.format(name, plan['Execution Time'], status)
+    return failures
+
+def create_indexes(engine):
+    partitioned = postgres.get_partitioned_tables(engine)
+    # CREATE INDEX CONCURRENTLY doesn't block the collectors' writes, but
+    # can't run in a transaction or on a partitioned table
+    connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    for index in postgres.get_missing_indexes(connection):
+        log.info('Creating %s', index.name)
+        if index.table.name in partitioned:
+            index.create(connection)
+            continue
+        ops = index.dialect_options['postgresql']['ops']
+        connection.execute('CREATE INDEX CONCURRENTLY "{}" ON "{}" ({})'.format(
+            index.name, index.table.name,
+            ', '.join('"{}" {}'.format(column.name, ops.get(column.name, '')).strip()
+                      for column in index.columns)))
+    connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the hot queries use indexes')
+    subparsers = parser.add_subparsers(dest='command')
+    explain_parser = subparsers.add_parser(
+        'explain', help='EXPLAIN ANALYZE the hot queries')
+    explain_parser.add_argument('--min-rows', type=int, default=10000,
+                                help='fail on sequential scans of tables with at '
+                                     'least this many rows (default: 10000)')
+    subparsers.add_parser(
+        'create-indexes', help='add indexes declared on the models that are missing')
+    args = parser.parse_args()
+
+    engine = create_postgres_engine()
+    if args.command == 'create-indexes':
+        create_indexes(engine)
+    else:
+        failures = explain(engine, args.min_rows)
+        if failures > 0:
+            print '{} queries scan large tables'.format(failures)
+            sys.exit(1)
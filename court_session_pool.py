@@ -0,0 +1,97 @@
+import argparse
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+from courtreader.districtcourtopener import DistrictCourtOpener
+from courtreader.sessions import SessionStore
+from courtutils import metrics
+from courtutils.logger import get_logger
+
+# Keeps a number of ready district court sessions in the session store
+# (see courtreader/sessions.py), so collectors started with --session-pool
+# take one instead of opening Chrome for a CAPTCHA. New sessions are made
+# by a limited number of browsers at a time, and stored sessions are
+# checked and kept from going idle on the site.
+
+log = get_logger()
+
+READY_SESSIONS = metrics.histogram(
+    'session_pool_ready_sessions', 'Free sessions in the store at each check',
+    buckets=(0, 1, 2, 4, 8, 16, 32))
+
+# Stored sessions that haven't been used for this long are checked, which
+# also keeps the site from expiring them
+REFRESH_SECONDS = 5 * 60
+
+def welcome_url():
+    return DistrictCourtOpener.url_root + 'caseSearch.do?welcomePage=welcomePage'
+
+def refresh_sessions(store):
+    """Check the sessions that have been idle a while. Returns the number
+    the site had expired."""
+    expired = 0
+    opener = DistrictCourtOpener()
+    while True:
+        lease = store.lease('district', idle_seconds=REFRESH_SECONDS)
+        if lease is None:
+            return expired
+        try:
+            page_content = opener.check_stored_session(welcome_url(), lease)
+        except Exception:
+            # the site or the network failing doesn't mean the session has
+            # expired, so give it back to be checked again later
+            log.error(traceback.format_exc())
+            store.release(lease)
+            continue
+        if page_content is None:
+            expired += 1
+        else:
+            store.release(lease)
+
+def create_session():
+    opener = DistrictCourtOpener()
+    try:
+        opener.open_new_session(welcome_url())
+        opener.release_session()
+        return True
+    except Exception:
+        log.error(traceback.format_exc())
+        return False
+
+def check_pool(store, browsers, target):
+    expired = refresh_sessions(store)
+    free, leased = store.count('district')
+    READY_SESSIONS.observe(free)
+    log.info('%s sessions ready, %s leased, %s expired', free, leased, expired)
+    if free < target:
+        needed = target - free
+        log.info('Creating %s sessions', needed)
+        created = browsers.map(lambda _: create_session(), range(needed))
+        log.info('Created %s sessions', created.count(True))
+
+def run(target, drivers, interval):
+    store = SessionStore()
+    browsers = ThreadPool(drivers)
+    while True:
+        try:
+            check_pool(store, browsers, target)
+        except Exception:
+            log.error(traceback.format_exc())
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Keep ready district court sessions for collectors to use')
+    parser.add_argument('--target', type=int, default=4,
+                        help='free sessions to keep ready (default: 4)')
+    parser.add_argument('--drivers', type=int, default=1,
+                        help='browsers to make sessions with at once (default: 1)')
+    parser.add_argument('--interval', type=int, default=30,
+                        help='seconds between checks of the store (default: 30)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics at http://localhost:PORT/metrics')
+    args = parser.parse_args()
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    log.info('Session pool running')
+    run(args.target, args.drivers, args.interval)
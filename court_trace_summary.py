@@ -0,0 +1,88 @@
+import argparse
+import json
+
+# Summarizes the trace files written by court_bulk_collector.py --trace-file:
+# p50/p95 time per stage for each kind of trace, and the courts where cases
+# take longest to collect.
+
+STAGE_ORDER = ['fetch', 'parse', 'db_lookup', 'db_store', 'other']
+
+def percentile(values, fraction):
+    # nearest rank on values sorted ascending
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+def read_traces(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+def sorted_stages(stages):
+    return sorted(stages, key=lambda stage: (
+        STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER), stage))
+
+def print_stage_summary(kind, traces):
+    stage_times = {}
+    for trace in traces:
+        for stage, seconds in trace['stages'].iteritems():
+            stage_times.setdefault(stage, []).append(seconds)
+    totals = sorted(trace['total'] for trace in traces)
+
+    print '{} ({} traces)'.format(kind, len(traces))
+    print '    {:<12} {:>9} {:>9} {:>9} {:>7}'.format('stage', 'p50', 'p95', 'mean', 'share')
+    total_time = sum(totals)
+    for stage in sorted_stages(stage_times.keys()):
+        times = sorted(stage_times[stage])
+        # traces without a stage spent no time in it
+        times = [0.0] * (len(traces) - len(times)) + times
+        print '    {:<12} {:>9.3f} {:>9.3f} {:>9.3f} {:>6.1f}%'.format(
+            stage, percentile(times, 0.5), percentile(times, 0.95),
+            sum(times) / len(times),
+            100 * sum(times) / total_time if total_time > 0 else 0)
+    print '    {:<12} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+        'total', percentile(totals, 0.5), percentile(totals, 0.95),
+        total_time / len(totals))
+    print
+
+def print_slowest_courts(traces, count):
+    courts = {}
+    for trace in traces:
+        key = (trace.get('court'), trace.get('fips'), trace.get('case_type'))
+        courts.setdefault(key, []).append(trace)
+
+    rows = []
+    for (court, fips, case_type), court_traces in courts.iteritems():
+        totals = sorted(trace['total'] for trace in court_traces)
+        fetch = sum(trace['stages'].get('fetch', 0) for trace in court_traces)
+        rows.append((percentile(totals, 0.95), percentile(totals, 0.5),
+                     fetch / sum(totals) if sum(totals) > 0 else 0,
+                     len(totals), court, fips, case_type))
+    rows.sort(reverse=True)
+
+    print 'Slowest courts by p95 time per case'
+    print '    {:<9} {:<5} {:<9} {:>6} {:>9} {:>9} {:>7}'.format(
+        'court', 'fips', 'type', 'cases', 'p50', 'p95', 'fetch')
+    for p95, p50, fetch_share, cases, court, fips, case_type in rows[:count]:
+        print '    {:<9} {:<5} {:<9} {:>6} {:>9.3f} {:>9.3f} {:>6.1f}%'.format(
+            court, fips, case_type, cases, p50, p95, 100 * fetch_share)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarize collector trace files')
+    parser.add_argument('trace_files', nargs='+')
+    parser.add_argument('--courts', type=int, default=10,
+                        help='number of slowest courts to list (default: 10)')
+    args = parser.parse_args()
+
+    traces_by_kind = {}
+    for trace in read_traces(args.trace_files):
+        traces_by_kind.setdefault(trace['kind'], []).append(trace)
+    if len(traces_by_kind) == 0:
+        print 'No traces found'
+    for kind in sorted(traces_by_kind):
+        print_stage_summary(kind, traces_by_kind[kind])
+    if 'case' in traces_by_kind:
+        print_slowest_courts(traces_by_kind['case'], args.courts)
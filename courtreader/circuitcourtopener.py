@@ -1,9 +1,13 @@
 import urllib
 from bs4 import BeautifulSoup
-from opener import Opener
+from courtutils import tracing
+from opener import Opener, SessionExpired
 
 class CircuitCourtOpener:
     url_root = 'http://ewsocis1.courts.state.va.us/CJISWeb/'
+    # an expired session gets sent back to the court selection page
+    session_expired_urls = ['circuit.jsp']
+    session_expired_markers = ['Your session has expired', 'Session Timeout']
 
     def __init__(self):
         self.opener = Opener('circuit')
@@ -11,8 +15,24 @@ class CircuitCourtOpener:
     def url(self, url):
         return CircuitCourtOpener.url_root + url
 
+    def check_session(self, page, content):
+        page_url = page.geturl()
+        for url in self.session_expired_urls:
+            if url in page_url:
+                raise SessionExpired(page_url)
+        for marker in self.session_expired_markers:
+            if marker in content:
+                raise SessionExpired(page_url)
+        return content
+
+    def read(self, page):
+        with tracing.span('fetch'):
+            content = page.read()
+        return self.check_session(page, content)
+
     def open_welcome_page(self):
         url = self.url('circuit.jsp')
+        self.opener.court = None
         page = self.opener.open(url)
         return BeautifulSoup(page.read(), 'html.parser')
 
@@ -31,9 +51,11 @@ class CircuitCourtOpener:
             'whichsystem': court
         })
         url = self.url('MainMenu.do')
-        self.opener.open(url, data)
+        # requests from here on count against this court's circuit breakers
+        self.opener.court = code
+        self.read(self.opener.open(url, data))
 
-    def do_case_number_search(self, code, case_number, category):
+    def do_case_number_search_html(self, code, case_number, category):
         data = {
             'submitValue': '',
             'courtId':code,
@@ -42,10 +64,14 @@ class CircuitCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('CaseDetail.do')
-        page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        page = self.opener.open(url, data, idempotent=True)
+        return self.read(page)
 
-    def do_case_number_pleadings_search(self, code, case_number, category):
+    def do_case_number_search(self, code, case_number, category):
+        content = self.do_case_number_search_html(code, case_number, category)
+        return BeautifulSoup(content, 'html.parser')
+
+    def do_case_number_pleadings_search_html(self, code, case_number, category):
         data = {
             'submitValue':'P',
             'courtId':code,
@@ -55,10 +81,14 @@ class CircuitCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('CaseDetail.do')
-        page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        page = self.opener.open(url, data, idempotent=True)
+        return self.read(page)
 
-    def do_case_number_services_search(self, code, case_number, category):
+    def do_case_number_pleadings_search(self, code, case_number, category):
+        content = self.do_case_number_pleadings_search_html(code, case_number, category)
+        return BeautifulSoup(content, 'html.parser')
+
+    def do_case_number_services_search_html(self, code, case_number, category):
         data = {
             'submitValue':'S',
             'courtId':code,
@@ -68,8 +98,12 @@ class CircuitCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('CaseDetail.do')
-        page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        page = self.opener.open(url, data, idempotent=True)
+        return self.read(page)
+
+    def do_case_number_services_search(self, code, case_number, category):
+        content = self.do_case_number_services_search_html(code, case_number, category)
+        return BeautifulSoup(content, 'html.parser')
 
     def return_to_main_menu(self, code):
         data = {
@@ -77,10 +111,10 @@ class CircuitCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('MainMenu.do')
-        self.opener.open(url, data)
+        self.read(self.opener.open(url, data, idempotent=True))
         return
 
-    def do_name_search(self, code, name, category):
+    def do_name_search_html(self, code, name, category):
         data = {
             'category': category,
             'lastName': name,
@@ -89,10 +123,14 @@ class CircuitCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('Search.do')
-        page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        page = self.opener.open(url, data, idempotent=True)
+        return self.read(page)
 
-    def continue_name_search(self, code, category):
+    def do_name_search(self, code, name, category):
+        content = self.do_name_search_html(code, name, category)
+        return BeautifulSoup(content, 'html.parser')
+
+    def continue_name_search_html(self, code, category):
         data = {
             'courtId': code,
             'pagelink': 'Next',
@@ -109,9 +147,13 @@ class CircuitCourtOpener:
         data = urllib.urlencode(data)
         url = self.url('Search.do')
         page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        return self.read(page)
 
-    def do_date_search(self, code, date, category):
+    def continue_name_search(self, code, category):
+        content = self.continue_name_search_html(code, category)
+        return BeautifulSoup(content, 'html.parser')
+
+    def do_date_search_html(self, code, date, category):
         data = {
             'hearSelect':'',
             'selectDate':date,
@@ -122,10 +164,14 @@ class CircuitCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('hearSearch.do')
-        page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        page = self.opener.open(url, data, idempotent=True)
+        return self.read(page)
 
-    def continue_date_search(self, code, category):
+    def do_date_search(self, code, date, category):
+        content = self.do_date_search_html(code, date, category)
+        return BeautifulSoup(content, 'html.parser')
+
+    def continue_date_search_html(self, code, category):
         data = {
             'courtId': code,
             'pagelink': 'Next',
@@ -140,4 +186,8 @@ class CircuitCourtOpener:
         data = urllib.urlencode(data)
         url = self.url('hearSearch.do')
         page = self.opener.open(url, data)
-        return BeautifulSoup(page.read(), 'html.parser')
+        return self.read(page)
+
+    def continue_date_search(self, code, category):
+        content = self.continue_date_search_html(code, category)
+        return BeautifulSoup(content, 'html.parser')
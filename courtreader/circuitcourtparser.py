@@ -1,5 +1,13 @@
 import re
-from datetime import datetime
+from bs4 import BeautifulSoup, SoupStrainer
+from courtutils import metrics, tracing
+from conversions import (apply_conversions, build_registry, parse_date,
+                         simplify_time_str_to_days)
+from records import (HearingDateSearchResult, CircuitHearing, CircuitPleading,
+                     CircuitService, CircuitParty, get_case_details_type)
+
+PARSE_SECONDS = metrics.histogram(
+    'court_parse_seconds', 'Time spent parsing a page', ['court', 'page'])
 
 def handle_parse_exception(soup):
     print '\nException parsing HTML.', \
@@ -8,6 +16,28 @@ def handle_parse_exception(soup):
     with open('unexpected_output.html', 'wb') as output:
         output.write(soup.prettify().encode('UTF-8'))
 
+def handle_page_parse_exception(content):
+    print '\nException parsing HTML.', \
+          'Probably contained something unexpected.', \
+          'Check unexpected_output.html'
+    if isinstance(content, unicode):
+        content = content.encode('UTF-8')
+    with open('unexpected_output.html', 'wb') as output:
+        output.write(content)
+
+def is_search_results_tag(name, attrs):
+    classes = attrs.get('class', '')
+    if not isinstance(classes, list):
+        classes = classes.split()
+    return 'nameList' in classes
+
+# Only the nameList table is read from search result pages
+SEARCH_RESULTS_STRAINER = SoupStrainer(is_search_results_tag)
+
+def get_search_results_soup(content):
+    return BeautifulSoup(content, 'html.parser',
+                         parse_only=SEARCH_RESULTS_STRAINER)
+
 def parse_court_names(soup):
     try:
         courts = {}
@@ -73,7 +103,28 @@ BOOL = [
     'FilingFeePaid'
 ]
 
-def get_data_from_table_with_rows(table, court_type):
+def convert_civil_date(value):
+    return parse_date(value, '%m/%d/%y')
+
+def convert_monetary(value):
+    return float(value.replace('$', '').replace(',', ''))
+
+def convert_bool(value):
+    return True if value.upper() == 'YES' else False
+
+CONVERSIONS = build_registry(
+    (DATES, parse_date),
+    (TIME_SPANS, simplify_time_str_to_days),
+    (MONETARY, convert_monetary),
+    (BOOL, convert_bool)
+)
+
+CIVIL_CONVERSIONS = build_registry(
+    (DATES, convert_civil_date),
+    (BOOL, convert_bool)
+)
+
+def get_data_from_table_with_rows(table, court_type, record_type):
     date_format = '%m/%d/%Y'
     if court_type == 'civil':
         date_format = '%m/%d/%y'
@@ -83,7 +134,8 @@ def get_data_from_table_with_rows(table, court_type):
     if '#' in col_names[0]:
         col_names[0] = 'Number'
     for row in rows:
-        item = {}
+        item = record_type()
+        time = None
         for i, col in enumerate(row.find_all('td')):
             key = col_names[i].encode('ascii', 'ignore') \
                          .replace(':', '') \
@@ -92,19 +144,19 @@ def get_data_from_table_with_rows(table, court_type):
             val = col.get_text(strip=True) \
                      .encode('ascii', 'ignore') \
                      .replace('\0', '').strip()
-            if val == '':
+            if val == '' or key == 'Number':
+                continue
+            if key == 'Time':
+                time = val
                 continue
             if key in DATES:
-                val = datetime.strptime(val, date_format)
+                val = parse_date(val, date_format)
             item[key] = val
-        if 'Time' in item:
-            if item['Time'].startswith('0:'):
-                item['Time'] = '1:00AM'
-            full_dt = '{} {}'.format(item['Date'], item['Time'])
-            item['Date'] = datetime.strptime(full_dt, date_format + ' %I:%M%p')
-            del item['Time']
-        if 'Number' in item:
-            del item['Number']
+        if time is not None:
+            if time.startswith('0:'):
+                time = '1:00AM'
+            full_dt = '{} {}'.format(item['Date'], time)
+            item['Date'] = parse_date(full_dt, date_format + ' %I:%M%p')
         if 'Jury' in item:
             item['Jury'] = True if item['Jury'].upper() == 'YES' else False
         data.append(item)
@@ -112,15 +164,15 @@ def get_data_from_table_with_rows(table, court_type):
 
 def parse_pleadings_table(soup, court_type):
     pleadings_table = soup.find(id='count')
-    return get_data_from_table_with_rows(pleadings_table, court_type)
+    return get_data_from_table_with_rows(pleadings_table, court_type, CircuitPleading)
 
 def parse_services_table(soup, court_type):
     services_table = soup.find(id='count')
-    return get_data_from_table_with_rows(services_table, court_type)
+    return get_data_from_table_with_rows(services_table, court_type, CircuitService)
 
 def parse_case_details(soup):
     try:
-        case_details = {}
+        case_details = get_case_details_type('circuit', 'criminal')()
         if soup.find(text=re.compile('Case not found')) is not None:
             case_details['error'] = 'case_not_found'
             return case_details
@@ -142,21 +194,7 @@ def parse_case_details(soup):
         if 'DOB' in case_details:
             case_details['DOB'] = case_details['DOB'].replace('****', '1004')
 
-        for key in DATES:
-            if key in case_details:
-                case_details[key] = datetime.strptime(case_details[key], '%m/%d/%Y')
-
-        for key in TIME_SPANS:
-            if key in case_details:
-                case_details[key] = simplify_time_str_to_days(case_details[key])
-
-        for key in MONETARY:
-            if key in case_details:
-                case_details[key] = float(case_details[key].replace('$', '').replace(',', ''))
-
-        for key in BOOL:
-            if key in case_details:
-                case_details[key] = True if case_details[key].upper() == 'YES' else False
+        apply_conversions(case_details, CONVERSIONS)
 
         if 'ConcurrentConsecutive' in case_details:
             if 'Consecutively' in case_details['ConcurrentConsecutive']:
@@ -170,7 +208,7 @@ def parse_case_details(soup):
             if 'Sentencing' in case_details['ProbationStarts']:
                 case_details['ProbationStarts'] = 'Sentencing'
 
-        case_details['Hearings'] = get_data_from_table_with_rows(hearings_table, 'criminal')
+        case_details['Hearings'] = get_data_from_table_with_rows(hearings_table, 'criminal', CircuitHearing)
 
         return case_details
     except:
@@ -179,7 +217,7 @@ def parse_case_details(soup):
 
 def parse_civil_case_details(soup):
     try:
-        case_details = {}
+        case_details = get_case_details_type('circuit', 'civil')()
         if soup.find(text=re.compile('Case not found')) is not None:
             case_details['error'] = 'case_not_found'
             return case_details
@@ -188,7 +226,7 @@ def parse_civil_case_details(soup):
         get_data_from_table(case_details, details_table)
 
         hearings_table = tables[12]
-        case_details['Hearings'] = get_data_from_table_with_rows(hearings_table, 'civil')
+        case_details['Hearings'] = get_data_from_table_with_rows(hearings_table, 'civil', CircuitHearing)
 
         case_details['Plaintiffs'] = []
         case_details['Defendants'] = []
@@ -199,7 +237,7 @@ def parse_civil_case_details(soup):
                 continue
             key = line[0].replace(':', '')
             if 'Plaintiff' in key or 'Defendant' in key:
-                party = {'Name': line[1]}
+                party = CircuitParty(Name=line[1])
                 for l in line:
                     if 'Trading as:' in l and l != 'Trading as:':
                         party['TradingAs'] = l.replace('Trading as:', '')
@@ -213,13 +251,7 @@ def parse_civil_case_details(soup):
             else:
                 case_details[key] = line[1]
 
-        for key in DATES:
-            if key in case_details:
-                case_details[key] = datetime.strptime(case_details[key], '%m/%d/%y')
-
-        for key in BOOL:
-            if key in case_details:
-                case_details[key] = True if case_details[key].upper() == 'YES' else False
+        apply_conversions(case_details, CIVIL_CONVERSIONS)
 
         if 'NumberofDefendants' in case_details:
             case_details['NumberofDefendants'] = int(case_details['NumberofDefendants'])
@@ -231,6 +263,15 @@ def parse_civil_case_details(soup):
         handle_parse_exception(soup)
         raise
 
+@metrics.timed(PARSE_SECONDS, court='circuit', page='name_search')
+@tracing.traced('parse')
+def parse_name_search_page(content, name, cases):
+    try:
+        return parse_name_search(get_search_results_soup(content), name, cases)
+    except:
+        handle_page_parse_exception(content)
+        raise
+
 def parse_name_search(soup, name, cases):
     try:
         for row in soup.find(class_='nameList').find_all('tr'):
@@ -260,6 +301,15 @@ def parse_name_search(soup, name, cases):
         handle_parse_exception(soup)
         raise
 
+@metrics.timed(PARSE_SECONDS, court='circuit', page='hearing_date_search')
+@tracing.traced('parse')
+def parse_date_search_page(content, cases):
+    try:
+        return parse_date_search(get_search_results_soup(content), cases)
+    except:
+        handle_page_parse_exception(content)
+        raise
+
 def parse_date_search(soup, cases):
     try:
         case_numbers = [case['case_number'] for case in cases]
@@ -275,32 +325,11 @@ def parse_date_search(soup, cases):
             case_number = case_number.strip()
             if case_number in case_numbers:
                 continue
-            cases.append({
-                'case_number': case_number,
-                'defendant': defendant.replace('\0', '').strip()
-            })
+            cases.append(HearingDateSearchResult(
+                case_number=case_number,
+                defendant=defendant.replace('\0', '').strip()
+            ))
         return previous_cases_count == len(cases)
     except:
         handle_parse_exception(soup)
         raise
-
-def simplify_time_str_to_days(time_string):
-    time_string = time_string.replace(' Year(s)', 'Years ') \
-                             .replace(' Month(s)', 'Months ') \
-                             .replace(' Day(s)', 'Days ')
-    days = 0
-    string_parts = time_string.split(' ')
-    for string_part in string_parts:
-        if 'Years' in string_part:
-            days += int(string_part.replace('Years', '')) * 365
-        elif string_part == '12Months':
-            days += 365
-        elif 'Months' in string_part:
-            days += int(string_part.replace('Months', '')) * 30
-        elif 'Days' in string_part:
-            days += int(string_part.replace('Days', ''))
-        elif 'Hours' in string_part:
-            hours = int(string_part.replace('Hours', ''))
-            if hours > 0:
-                days += 1
-    return days
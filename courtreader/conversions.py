@@ -0,0 +1,115 @@
+"""Field conversions shared by the court parsers.
+
+Each parser declares which fields are dates, time spans, amounts and flags,
+and builds a registry mapping field name -> converter once at import. Parsing
+a case then only touches the fields that are actually present. The raw
+strings repeat a lot (filing dates, sentence lengths), so the expensive
+conversions are memoized in small LRU caches.
+"""
+from datetime import datetime
+
+CACHE_SIZE = 8192
+
+class LRUCache(object):
+    """Approximate LRU cache built from two plain dicts.
+
+    Lookups promote entries into the current generation; when it fills up the
+    older generation (everything not used since the last rotation) is
+    dropped. This keeps hits down to a dict lookup or two, where a strict LRU
+    on an OrderedDict costs more than the conversions it is caching.
+    """
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.current[key]
+        except KeyError:
+            value = self.previous[key]
+            self.set(key, value)
+            self.misses -= 1
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.misses += 1
+        if len(self.current) >= self.size / 2:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+def memoize(func):
+    cache = LRUCache()
+    def memoized(*args):
+        try:
+            return cache.get(args)
+        except KeyError:
+            value = func(*args)
+            cache.set(args, value)
+            return value
+    memoized.cache = cache
+    memoized.__name__ = func.__name__
+    memoized.__doc__ = func.__doc__
+    return memoized
+
+@memoize
+def parse_date(value, date_format='%m/%d/%Y'):
+    # Nearly every date on both sites is m/d/Y, which is much cheaper to
+    # split by hand than to run through strptime. Anything else, including
+    # malformed and out of range values, falls back to strptime so errors
+    # are unchanged.
+    if date_format == '%m/%d/%Y':
+        parts = value.split('/')
+        if len(parts) == 3 and len(parts[0]) <= 2 and len(parts[1]) <= 2 \
+                and len(parts[2]) == 4 and parts[0].isdigit() \
+                and parts[1].isdigit() and parts[2].isdigit():
+            try:
+                return datetime(int(parts[2]), int(parts[0]), int(parts[1]))
+            except ValueError:
+                pass
+    return datetime.strptime(value, date_format)
+
+@memoize
+def simplify_time_str_to_days(time_string):
+    time_string = time_string.replace(' Year(s)', 'Years ') \
+                             .replace(' Month(s)', 'Months ') \
+                             .replace(' Day(s)', 'Days ')
+    days = 0
+    string_parts = time_string.split(' ')
+    for string_part in string_parts:
+        if 'Years' in string_part:
+            days += int(string_part.replace('Years', '')) * 365
+        elif string_part == '12Months':
+            days += 365
+        elif 'Months' in string_part:
+            days += int(string_part.replace('Months', '')) * 30
+        elif 'Days' in string_part:
+            days += int(string_part.replace('Days', ''))
+        elif 'Hours' in string_part:
+            hours = int(string_part.replace('Hours', ''))
+            if hours > 0:
+                days += 1
+    return days
+
+def build_registry(*groups):
+    registry = {}
+    for fields, converter in groups:
+        for field in fields:
+            registry[field] = converter
+    return registry
+
+def apply_conversions(case_details, registry):
+    for key in case_details.keys():
+        converter = registry.get(key)
+        if converter is not None:
+            case_details[key] = converter(case_details[key])
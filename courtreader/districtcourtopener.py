@@ -1,25 +1,152 @@
 import deathbycaptcha
 import logging
 import os
+import re
+import threading
 import time
 import urllib
 from bs4 import BeautifulSoup
-from opener import Opener
+from courtutils import metrics, resilience, tracing
+from opener import Opener, SessionExpired
 from selenium import webdriver
+from sessions import SessionStore
 
 log = logging.getLogger('logentries')
 
+CAPTCHA_EVENTS = metrics.counter(
+    'court_captcha_events_total',
+    'CAPTCHA pages shown by the court site, and how they turned out',
+    ['court', 'result'])
+STORED_SESSIONS = metrics.counter(
+    'court_stored_sessions_total',
+    'Sessions leased from the session store, by whether the site still accepted them',
+    ['court', 'result'])
+HEDGED_REQUESTS = metrics.counter(
+    'court_hedged_requests_total',
+    'Case details requests that were hedged, by which session answered first',
+    ['court', 'winner'])
+
+# Lines of hearing date results with a case details link, whose self-closed
+# tags have to be opened for the parser to find the link's text
+CASE_DETAILS_LINE = re.compile(
+    r'^.*<a href="caseSearch\.do\?formAction=caseDetails.*$', re.MULTILINE)
+
+# How often a worker waiting on the session pool checks the store
+SESSION_POOL_POLL_SECONDS = 5
+
+# Recent case details response times. A hedged request gets a duplicate on
+# the second session once it's been slower than HEDGE_PERCENTILE of them,
+# but never sooner than MIN_HEDGE_SECONDS.
+DETAILS_LATENCY = resilience.LatencyWindow()
+HEDGE_PERCENTILE = 95
+MIN_HEDGE_SECONDS = 0.5
+
+# How long to wait before trying again to lease a second session for hedging
+HEDGE_SESSION_RETRY_SECONDS = 60
+
 class DistrictCourtOpener:
     url_root = 'https://eapps.courts.state.va.us/gdcourts/'
+    # an expired session gets bounced back to the captcha page
+    session_expired_markers = ['By clicking Accept']
 
-    def __init__(self):
+    def __init__(self, session_pool=False, hedge=False):
         self.opener = Opener('district')
-        self.use_driver = True
+        # name searches post the form directly; set this to drive them in
+        # Chrome instead, after opening it with open_driver
+        self.use_driver = False
+        # sessions are shared with other workers and kept across restarts,
+        # since each new one needs a CAPTCHA solved
+        self.sessions = SessionStore()
+        self.session = None
+        # with a session pool (court_session_pool.py) filling the store, wait
+        # for a session from it instead of making one
+        self.session_pool = session_pool
+        self.court_name = None
+        # with hedging, case details requests that are slow to answer are
+        # repeated on a second stored session, see open_case_details_html
+        self.hedge = hedge
+        self.hedge_opener = None
+        self.hedge_session = None
+        # set when no request is running on the hedge session
+        self.hedge_done = threading.Event()
+        self.hedge_done.set()
+        self.hedge_retry_at = 0
 
     def url(self, url):
         return DistrictCourtOpener.url_root + url
 
+    def check_session(self, page, content):
+        for marker in self.session_expired_markers:
+            if marker in content:
+                raise SessionExpired(page.geturl())
+        return content
+
+    def read(self, page):
+        with tracing.span('fetch'):
+            content = page.read()
+        content = self.check_session(page, content)
+        self.renew_sessions()
+        return content
+
+    def renew_sessions(self):
+        """Renew the leases on this opener's sessions, the hedge session's
+        too, since it can go unused for longer than a lease lasts. A hedge
+        session whose lease ran out anyway is given up, as another worker
+        may have it now; another is leased when it's next needed."""
+        if self.session is not None:
+            self.sessions.renew(self.session)
+        if self.hedge_session is not None and \
+                not self.sessions.renew(self.hedge_session):
+            log.info('Lease on the hedge session ran out, giving it up')
+            self.hedge_opener = None
+            self.hedge_session = None
+
     def log_off(self):
+        # the session stays valid on the site, for another worker to use
+        self.release_session()
+        if self.hedge_session is not None:
+            self.sessions.release(self.hedge_session)
+            self.hedge_opener = None
+            self.hedge_session = None
+
+    def discard_session(self):
+        """Drop the current session from the store, once the site has
+        expired it."""
+        if self.session is not None:
+            self.sessions.discard(self.session)
+            self.session = None
+
+    def release_session(self):
+        if self.session is not None:
+            self.sessions.release(self.session)
+            self.session = None
+
+    def open_stored_session(self, url):
+        """Try stored sessions until the site accepts one. Returns the
+        welcome page's content, or None if no stored session worked."""
+        while True:
+            self.session = self.sessions.lease('district')
+            if self.session is None:
+                return None
+            page_content = self.check_stored_session(url, self.session)
+            if page_content is not None:
+                return page_content
+            self.session = None
+
+    def check_stored_session(self, url, lease, opener=None):
+        """Open url with a leased session's cookies, on opener or this
+        opener's own. Returns the page's content, or None, after discarding
+        the session, if the site no longer accepts it."""
+        if opener is None:
+            opener = self.opener
+        opener.set_cookies(lease['cookies'])
+        page_content = opener.open(url).read()
+        if 'By clicking Accept' not in page_content:
+            STORED_SESSIONS.inc(court='district', result='valid')
+            return page_content
+        STORED_SESSIONS.inc(court='district', result='expired')
+        self.sessions.discard(lease)
+        opener.set_cookies([])
         return None
 
     def open_driver(self):
@@ -29,18 +156,36 @@ class DistrictCourtOpener:
 
     def open_welcome_page(self):
         url = self.url('caseSearch.do?welcomePage=welcomePage')
-        page = self.opener.open('https://google.com')
-        page_content = page.read()
+        self.opener.court = None
+        self.release_session()
+        while True:
+            page_content = self.open_stored_session(url)
+            if page_content is not None:
+                return BeautifulSoup(page_content, 'html.parser')
+            if not self.session_pool:
+                break
+            log.info('Waiting for a session from the session pool')
+            time.sleep(SESSION_POOL_POLL_SECONDS)
+        return BeautifulSoup(self.open_new_session(url), 'html.parser')
+
+    def open_new_session(self, url):
+        """Start a new session, solving a CAPTCHA if the site asks for one,
+        and add it to the store, leased. Returns the welcome page's
+        content."""
         page = self.opener.open(url)
         page_content = page.read()
         # See if we need to solve a captcha
         if 'By clicking Accept' in page_content:
+            CAPTCHA_EVENTS.inc(court='district', result='required')
             self.solve_captcha(url)
             page = self.opener.open(url)
             page_content = page.read()
-        if 'By clicking Accept' in page_content:
-            raise RuntimeError('CAPTCHA failed')
-        return BeautifulSoup(page_content, 'html.parser')
+            if 'By clicking Accept' in page_content:
+                CAPTCHA_EVENTS.inc(court='district', result='failed')
+                raise RuntimeError('CAPTCHA failed')
+            CAPTCHA_EVENTS.inc(court='district', result='solved')
+        self.session = self.sessions.add('district', self.opener.get_cookies())
+        return page_content
 
     def solve_captcha(self, url):
         self.open_driver()
@@ -80,17 +225,22 @@ class DistrictCourtOpener:
         '''
         cookie = self.driver.get_cookie('JSESSIONID')['value']
         self.opener.set_cookie('JSESSIONID', cookie)
-        self.opener.save_cookies()
         self.driver.quit()
 
     def change_court(self, name, code):
+        self.court_name = name
+        self.read(self.post_change_court(self.opener, name, code))
+
+    def post_change_court(self, opener, name, code):
         data = urllib.urlencode({
             'selectedCourtsName': name,
             'selectedCourtsFipCode': code,
             'sessionCourtsFipCode': ''
         })
         url = self.url('changeCourt.do')
-        self.opener.open(url, data)
+        # requests from here on count against this court's circuit breakers
+        opener.court = code
+        return opener.open(url, data)
 
     def open_hearing_date_search(self, code, search_division):
         url = self.url('caseSearch.do')
@@ -100,7 +250,7 @@ class DistrictCourtOpener:
         url += '&curentFipsCode=' + code
         self.opener.open(url)
 
-    def do_hearing_date_search(self, code, date, first_page):
+    def do_hearing_date_search_html(self, code, date, first_page):
         data = {
             'formAction':'',
             'curentFipsCode':code,
@@ -122,14 +272,16 @@ class DistrictCourtOpener:
             data['unCheckedCases'] = ''
         data = urllib.urlencode(data)
         url = self.url('caseSearch.do')
-        page = self.opener.open(url, data)
-        content = ''
-        for line in page:
-            if '<a href="caseSearch.do?formAction=caseDetails' in line:
-                line = line.replace('/>', '>')
-            content += line
-        soup = BeautifulSoup(content, 'html.parser')
-        return soup
+        page = self.opener.open(url, data, idempotent=first_page)
+        with tracing.span('fetch'):
+            content = page.read()
+        content = CASE_DETAILS_LINE.sub(
+            lambda match: match.group(0).replace('/>', '>'), content)
+        return self.check_session(page, content)
+
+    def do_hearing_date_search(self, code, date, first_page):
+        content = self.do_hearing_date_search_html(code, date, first_page)
+        return BeautifulSoup(content, 'html.parser')
 
     def open_case_number_search(self, code, search_division):
         url = self.url('criminalCivilCaseSearch.do')
@@ -138,7 +290,7 @@ class DistrictCourtOpener:
         url += '&curentFipsCode=' + code
         self.opener.open(url)
 
-    def do_case_number_search(self, code, case_number, search_division):
+    def do_case_number_search_html(self, code, case_number, search_division):
         data = {
             'formAction':'submitCase',
             'searchFipsCode':code,
@@ -150,18 +302,108 @@ class DistrictCourtOpener:
         }
         data = urllib.urlencode(data)
         url = self.url('criminalCivilCaseSearch.do')
-        self.opener.open(url, data)
+        self.opener.open(url, data, idempotent=True)
         # the post returns 302, then we have to do a GET... strange
 
         url = self.url('criminalDetail.do')
-        content = self.opener.open(url)
-        soup = BeautifulSoup(content, 'html.parser')
-        return soup
+        return self.read(self.opener.open(url))
 
-    def open_case_details(self, details_url):
+    def do_case_number_search(self, code, case_number, search_division):
+        content = self.do_case_number_search_html(code, case_number, search_division)
+        return BeautifulSoup(content, 'html.parser')
+
+    def open_case_details_html(self, details_url):
         url = self.url(details_url)
-        page = self.opener.open(url)
-        return BeautifulSoup(page.read(), 'html.parser')
+        if self.hedge:
+            return self.hedged_read(url)
+        return self.read(self.opener.open(url))
+
+    def hedged_read(self, url):
+        """GET url, and if the site is slower than usual to answer, GET it
+        again on the hedge session and use whichever answers first. The
+        case details url names the case, so the same request works on any
+        session that's on the same court.
+
+        The slower request is left to finish in the background. When the
+        hedge session wins, the two sessions swap places, so this opener
+        never has two requests running on one session."""
+        delay = DETAILS_LATENCY.percentile(HEDGE_PERCENTILE)
+        primary = (self.opener, self.session, threading.Event())
+        hedge = None
+        backup = None
+        if delay is not None and self.hedge_ready():
+            hedge = (self.hedge_opener, self.hedge_session, self.hedge_done)
+            self.hedge_done.clear()
+            court = (self.opener.court, self.court_name)
+            backup = lambda: self.fetch_on(hedge, url, court)
+        call = resilience.HedgedCall(lambda: self.fetch_on(primary, url), backup,
+                                     max(delay, MIN_HEDGE_SECONDS) if backup else None)
+        try:
+            with tracing.span('fetch'):
+                winner, content = call.run()
+        finally:
+            if hedge is not None and not call.hedged:
+                # the hedge session wasn't needed after all
+                self.hedge_done.set()
+        if call.hedged:
+            HEDGED_REQUESTS.inc(court='district',
+                                winner='hedge' if winner == 1 else 'primary')
+        if winner == 1:
+            self.opener, self.session = hedge[0], hedge[1]
+            self.hedge_opener, self.hedge_session, self.hedge_done = primary
+        self.renew_sessions()
+        return content
+
+    def fetch_on(self, session, url, court=None):
+        """GET url on session, an (opener, lease, done) tuple, first moving
+        it to court, a (code, name) tuple, if it's on another one. done is
+        set when the request has finished."""
+        opener, lease, done = session
+        try:
+            if court is not None and opener.court != court[0]:
+                page = self.post_change_court(opener, court[1], court[0])
+                self.check_session(page, page.read())
+            start = time.time()
+            page = opener.open(url)
+            content = self.check_session(page, page.read())
+            DETAILS_LATENCY.add(time.time() - start)
+            return content
+        except SessionExpired:
+            if lease is not None:
+                lease['expired'] = True
+                self.sessions.discard(lease)
+            raise
+        finally:
+            done.set()
+
+    def hedge_ready(self):
+        """Whether a hedged request can be made now, leasing a second
+        session from the store if there isn't one yet."""
+        if not self.hedge_done.is_set():
+            # the last hedged request is still running on it
+            return False
+        if self.hedge_session is not None and self.hedge_session.get('expired'):
+            self.hedge_opener = None
+            self.hedge_session = None
+        if self.hedge_session is not None:
+            return True
+        if time.time() < self.hedge_retry_at:
+            return False
+        opener = Opener('district')
+        url = self.url('caseSearch.do?welcomePage=welcomePage')
+        while True:
+            lease = self.sessions.lease('district')
+            if lease is None:
+                self.hedge_retry_at = time.time() + HEDGE_SESSION_RETRY_SECONDS
+                return False
+            if self.check_stored_session(url, lease, opener) is not None:
+                log.info('Leased a second session for hedged requests')
+                self.hedge_opener = opener
+                self.hedge_session = lease
+                return True
+
+    def open_case_details(self, details_url):
+        return BeautifulSoup(self.open_case_details_html(details_url), 'html.parser')
 
     def open_name_search(self, code, search_division):
         url = self.url('nameSearch.do')
@@ -183,11 +425,13 @@ class DistrictCourtOpener:
             xpath = "//input[@value='Search'][@type='submit']"
             self.driver.find_element_by_xpath(xpath).click()
         time.sleep(1)
-        source = self.driver.page_source
-        soup = BeautifulSoup(source, 'html.parser')
-        return soup
+        return self.driver.page_source
 
     def do_name_search(self, code, search_division, name, count, prev_cases=None):
+        content = self.do_name_search_html(code, search_division, name, count, prev_cases)
+        return BeautifulSoup(content, 'html.parser')
+
+    def do_name_search_html(self, code, search_division, name, count, prev_cases=None):
         if self.use_driver:
             return self.do_name_search_with_driver(code, name, count, prev_cases)
         data = {
@@ -227,6 +471,4 @@ class DistrictCourtOpener:
             data['lastRowCaseNumber'] = prev_cases[-1]['case_number']
         data = urllib.urlencode(data)
         url = self.url('nameSearch.do')
-        content = self.opener.open(url, data)
-        soup = BeautifulSoup(content, 'html.parser')
-        return soup
+        return self.read(self.opener.open(url, data, idempotent=not prev_cases))
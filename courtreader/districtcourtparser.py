@@ -1,5 +1,13 @@
 import re
-from datetime import datetime
+from bs4 import BeautifulSoup, SoupStrainer
+from courtutils import metrics, tracing
+from conversions import (apply_conversions, build_registry, parse_date,
+                         simplify_time_str_to_days)
+from records import (HearingDateSearchResult, DistrictHearing, DistrictService,
+                     DistrictReport, DistrictParty, get_case_details_type)
+
+PARSE_SECONDS = metrics.histogram(
+    'court_parse_seconds', 'Time spent parsing a page', ['court', 'page'])
 
 def handle_parse_exception(soup):
     print '\nException parsing HTML.', \
@@ -8,6 +16,36 @@ def handle_parse_exception(soup):
     with open('unexpected_output.html', 'wb') as output:
         output.write(soup.prettify().encode('UTF-8'))
 
+def handle_page_parse_exception(content):
+    print '\nException parsing HTML.', \
+          'Probably contained something unexpected.', \
+          'Check unexpected_output.html'
+    if isinstance(content, unicode):
+        content = content.encode('UTF-8')
+    with open('unexpected_output.html', 'wb') as output:
+        output.write(content)
+
+NO_RESULTS = 'No results found for the search criteria'
+
+def is_search_results_tag(name, attrs):
+    if name == 'table':
+        classes = attrs.get('class', '')
+        if not isinstance(classes, list):
+            classes = classes.split()
+        return 'tableborder' in classes
+    if name == 'input':
+        return attrs.get('name') == 'caseInfoScrollForward' or \
+               attrs.get('title') == 'Next'
+    return False
+
+# Search result pages are mostly layout and navigation. Only the results
+# table and the paging buttons are needed, so only those get built into a tree.
+SEARCH_RESULTS_STRAINER = SoupStrainer(is_search_results_tag)
+
+def get_search_results_soup(content):
+    return BeautifulSoup(content, 'html.parser',
+                         parse_only=SEARCH_RESULTS_STRAINER)
+
 def parse_court_names(soup):
     try:
         # Load list of courts and fips codes
@@ -54,6 +92,33 @@ def next_names_button_found(soup):
         handle_parse_exception(soup)
         raise
 
+@metrics.timed(PARSE_SECONDS, court='district', page='name_search')
+@tracing.traced('parse')
+def parse_name_search_page(content):
+    """Parse a raw name search page, returning the cases found and whether
+    there is another page of results."""
+    try:
+        soup = get_search_results_soup(content)
+        cases = [] if NO_RESULTS in content else parse_name_search(soup)
+        return cases, next_names_button_found(soup)
+    except:
+        handle_page_parse_exception(content)
+        raise
+
+@metrics.timed(PARSE_SECONDS, court='district', page='hearing_date_search')
+@tracing.traced('parse')
+def parse_hearing_date_search_page(content, case_type):
+    """Parse a raw hearing date search page, returning the cases found and
+    whether there is another page of results."""
+    try:
+        soup = get_search_results_soup(content)
+        cases = [] if NO_RESULTS in content else \
+                parse_hearing_date_search(soup, case_type)
+        return cases, next_button_found(soup)
+    except:
+        handle_page_parse_exception(content)
+        raise
+
 def parse_hearing_date_search(soup, case_type):
     try:
         no_results = re.compile(r'No results found for the search criteria')
@@ -76,23 +141,23 @@ def parse_hearing_date_search(soup, case_type):
                 civil_case_type = civil_case_type_content[0] if len(civil_case_type_content) > 0 else ''
                 hearing_time_content = list(cells[5].stripped_strings)
                 hearing_time = hearing_time_content[0] if len(hearing_time_content) > 0 else ''
-                cases.append({
-                    'case_number': case_number,
-                    'details_url': details_url,
-                    'defendant': defendant,
-                    'plaintiff': plaintiff,
-                    'civil_case_type': civil_case_type,
-                    'hearing_time': hearing_time
-                })
+                cases.append(HearingDateSearchResult(
+                    case_number=case_number,
+                    details_url=details_url,
+                    defendant=defendant,
+                    plaintiff=plaintiff,
+                    civil_case_type=civil_case_type,
+                    hearing_time=hearing_time
+                ))
             else:
                 status_cell_content = list(cells[6].stripped_strings)
                 status = status_cell_content[0] if len(status_cell_content) > 0 else ''
-                cases.append({
-                    'case_number': case_number,
-                    'details_url': details_url,
-                    'defendant': defendant,
-                    'status': status
-                })
+                cases.append(HearingDateSearchResult(
+                    case_number=case_number,
+                    details_url=details_url,
+                    defendant=defendant,
+                    status=status
+                ))
         return cases
     except:
         handle_parse_exception(soup)
@@ -147,8 +212,27 @@ BOOL = [
     'IsJudgmentSatisfied'
 ]
 
+def convert_date(value):
+    return parse_date(value.replace('PAST DUE', ''))
+
+def convert_monetary(value):
+    try:
+        return float(value.replace('$', '').replace(',', '').split(' ')[0])
+    except ValueError:
+        return -1.0
+
+def convert_bool(value):
+    return False if value.upper() == 'NO' else True
+
+CONVERSIONS = build_registry(
+    (DATES, convert_date),
+    (TIME_SPANS, simplify_time_str_to_days),
+    (MONETARY, convert_monetary),
+    (BOOL, convert_bool)
+)
+
 def parse_case_details(soup, case_type):
-    case_details = {}
+    case_details = get_case_details_type('district', case_type)()
     try:
         #case_details['CourtName'] = soup.find(id='headerCourtName') \
         #                                .string.strip()
@@ -164,11 +248,11 @@ def parse_case_details(soup, case_type):
         # Parse tables
         if case_type == 'civil':
             # the table names really are backwards here
-            case_details['Plaintiffs'] = parse_table(soup, 'toggleDef')
-            case_details['Defendants'] = parse_table(soup, 'togglePlaintiff')
-            case_details['Reports'] = parse_table(soup, 'toggleReports')
-        case_details['Hearings'] = parse_table(soup, 'toggleHearing')
-        case_details['Services'] = parse_table(soup, 'toggleServices')
+            case_details['Plaintiffs'] = parse_table(soup, 'toggleDef', DistrictParty)
+            case_details['Defendants'] = parse_table(soup, 'togglePlaintiff', DistrictParty)
+            case_details['Reports'] = parse_table(soup, 'toggleReports', DistrictReport)
+        case_details['Hearings'] = parse_table(soup, 'toggleHearing', DistrictHearing)
+        case_details['Services'] = parse_table(soup, 'toggleServices', DistrictService)
         if 'CaseNumber' not in case_details:
             raise ValueError('Missing Case Number')
 
@@ -186,28 +270,7 @@ def parse_case_details(soup, case_type):
         if 'FineCostsDue' in case_details:
             case_details['FineCostsPastDue'] = 'PAST DUE' in case_details['FineCostsDue']
 
-        for key in DATES:
-            if key in case_details:
-                case_details[key] = case_details[key].replace('PAST DUE', '')
-                case_details[key] = datetime.strptime(case_details[key], '%m/%d/%Y')
-
-        for key in TIME_SPANS:
-            if key in case_details:
-                case_details[key] = simplify_time_str_to_days(case_details[key])
-
-        for key in MONETARY:
-            if key in case_details:
-                try:
-                    case_details[key] = float(case_details[key]
-                                              .replace('$', '')
-                                              .replace(',', '')
-                                              .split(' ')[0])
-                except ValueError:
-                    case_details[key] = -1.0
-
-        for key in BOOL:
-            if key in case_details:
-                case_details[key] = False if case_details[key].upper() == 'NO' else True
+        apply_conversions(case_details, CONVERSIONS)
     except:
         handle_parse_exception(soup)
         raise
@@ -229,15 +292,15 @@ def get_string_from_cell(cell, is_label=False):
                      .replace(' ', '')
     return value
 
-def parse_table(soup, table_id):
+def parse_table(soup, table_id, record_type):
     table_contents = []
     table_section = soup.find(id=table_id)
     table_headers = [s.replace(' ', '').replace('/', '') for s in
                      table_section.find(class_='gridheader').stripped_strings]
     for row in table_section.find_all(class_='gridrow'):
-        table_contents.append(parse_table_row(row, table_headers))
+        table_contents.append(parse_table_row(row, table_headers, record_type))
     for row in table_section.find_all(class_='gridalternaterow'):
-        table_contents.append(parse_table_row(row, table_headers))
+        table_contents.append(parse_table_row(row, table_headers, record_type))
     return table_contents
 
 NO_ATTORNEY = [
@@ -245,46 +308,24 @@ NO_ATTORNEY = [
     'NOT EMPLOYED'
 ]
 
-def parse_table_row(row, table_headers):
-    data_dict = {}
-    data_list = zip(
-        table_headers,
-        [cell.string.replace('\0', '').strip()
-         if cell.string is not None else ''
-         for cell in row.find_all('td')]
-    )
-    for item in data_list:
-        if item[1] == '':
+def parse_table_row(row, table_headers, record_type):
+    item = record_type()
+    time = None
+    for header, cell in zip(table_headers, row.find_all('td')):
+        value = cell.string.replace('\0', '').strip() \
+                if cell.string is not None else ''
+        if value == '':
+            continue
+        if header == 'Time':
+            time = value
             continue
-        data_dict[item[0]] = item[1]
-        if item[0] in DATES:
-            data_dict[item[0]] = datetime.strptime(item[1], '%m/%d/%Y')
-    if 'Time' in data_dict:
-        full_dt = '{} {}'.format(data_dict['Date'], data_dict['Time'])
-        data_dict['Date'] = datetime.strptime(full_dt, '%m/%d/%Y %I:%M %p')
-        del data_dict['Time']
-    if 'Attorney' in data_dict and data_dict['Attorney'].upper() in NO_ATTORNEY:
-        del data_dict['Attorney']
-
-    return data_dict
-
-def simplify_time_str_to_days(time_string):
-    time_string = time_string.replace(' Year(s)', 'Years ') \
-                             .replace(' Month(s)', 'Months ') \
-                             .replace(' Day(s)', 'Days ')
-    days = 0
-    string_parts = time_string.split(' ')
-    for string_part in string_parts:
-        if 'Years' in string_part:
-            days += int(string_part.replace('Years', '')) * 365
-        elif string_part == '12Months':
-            days += 365
-        elif 'Months' in string_part:
-            days += int(string_part.replace('Months', '')) * 30
-        elif 'Days' in string_part:
-            days += int(string_part.replace('Days', ''))
-        elif 'Hours' in string_part:
-            hours = int(string_part.replace('Hours', ''))
-            if hours > 0:
-                days += 1
-    return days
+        if header in DATES:
+            value = parse_date(value)
+        item[header] = value
+    if time is not None:
+        full_dt = '{} {}'.format(item['Date'], time)
+        item['Date'] = parse_date(full_dt, '%m/%d/%Y %I:%M %p')
+    if 'Attorney' in item and item['Attorney'].upper() in NO_ATTORNEY:
+        del item['Attorney']
+
+    return item
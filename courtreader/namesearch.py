@@ -0,0 +1,118 @@
+"""Search for a name in every court at once.
+
+A name search used to be queued as one task per court and run one court
+after another by a single worker, which took tens of minutes for the whole
+state. search_name runs the per-court searches on a pool of threads
+instead, each thread with its own readers and so its own court sessions,
+and merges what they find.
+
+District court threads take sessions from the session store
+(courtreader/sessions.py), so running court_session_pool.py with a target
+of at least the number of workers saves them solving CAPTCHAs.
+"""
+import logging
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+from courtutils import metrics
+from readers import CircuitCourtReader, DistrictCourtReader
+
+log = logging.getLogger('logentries')
+
+NAME_SEARCH_SECONDS = metrics.histogram(
+    'court_name_search_seconds', 'Time to search one court for a name', ['court'])
+
+COURT_TYPES = ('district', 'circuit')
+DEFAULT_WORKERS = 8
+
+class NameSearch(object):
+    def __init__(self, name, case_type, session_pool=False):
+        # the circuit court lists every name from the one searched for on,
+        # and its results are matched against it, in upper case
+        self.name = name.upper()
+        self.case_type = case_type
+        self.session_pool = session_pool
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.readers = []
+
+    def get_reader(self, court_type):
+        """This thread's reader for court_type."""
+        if not hasattr(self.local, 'readers'):
+            self.local.readers = {}
+        if court_type not in self.local.readers:
+            reader = CircuitCourtReader() if court_type == 'circuit' else \
+                     DistrictCourtReader(self.session_pool)
+            self.local.readers[court_type] = reader
+            with self.lock:
+                self.readers.append(reader)
+        return self.local.readers[court_type]
+
+    def get_fips_codes(self, court_type):
+        return sorted(self.get_reader(court_type).connect().keys())
+
+    def search_court(self, court):
+        """Returns (court_type, fips_code, cases, error)."""
+        court_type, fips_code = court
+        try:
+            with NAME_SEARCH_SECONDS.time(court=court_type):
+                cases = self.get_reader(court_type).get_cases_by_name(
+                    fips_code, self.case_type, self.name)
+            return court_type, fips_code, cases, None
+        except Exception:
+            error = traceback.format_exc()
+            log.warn('Name search failed in %s court %s\n%s', court_type, fips_code, error)
+            return court_type, fips_code, [], error.splitlines()[-1]
+
+    def log_off(self):
+        for reader in self.readers:
+            try:
+                reader.log_off()
+            except Exception:
+                pass
+
+def merge_cases(results):
+    """Tag each found case with its court and drop duplicates, which the
+    sites can repeat across pages of results."""
+    cases = []
+    seen = set()
+    for court_type, fips_code, found, error in results:
+        for case in found:
+            key = (court_type, fips_code, case['case_number'])
+            if key in seen:
+                continue
+            seen.add(key)
+            case['court_type'] = court_type
+            case['fips_code'] = fips_code
+            cases.append(case)
+    return cases
+
+def search_name(name, case_type, court_types=COURT_TYPES, fips_codes=None,
+                workers=DEFAULT_WORKERS, session_pool=False):
+    """Search every court of court_types, or just those in fips_codes, for
+    cases of case_type ('criminal' or 'civil') with a party named name,
+    with up to workers courts searched at a time.
+
+    Returns (cases, failures). Each case has its court_type and fips_code
+    added. failures lists (court_type, fips_code, error) for courts that
+    couldn't be searched, including those whose site is failing.
+    """
+    search = NameSearch(name, case_type, session_pool)
+    pool = ThreadPool(workers)
+    try:
+        courts = []
+        for court_type in court_types:
+            # listed by a pool thread, so the session it takes goes on to
+            # be used for searches instead of being held idle here
+            courts.extend((court_type, fips_code)
+                          for fips_code in pool.apply(search.get_fips_codes, (court_type,))
+                          if fips_codes is None or fips_code in fips_codes)
+        log.info('Searching %s courts for %s', len(courts), search.name)
+        results = pool.map(search.search_court, courts)
+    finally:
+        pool.close()
+        search.log_off()
+    failures = [(court_type, fips_code, error)
+                for court_type, fips_code, found, error in results
+                if error is not None]
+    return merge_cases(results), failures
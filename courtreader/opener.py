@@ -1,4 +1,225 @@
+import collections
+import httplib
 import mechanize
+import os
+import socket
+import urllib2
+import urlparse
+import zlib
+from cStringIO import StringIO
+from courtutils import metrics, resilience, tracing
+from mechanize._response import closeable_response
+
+REQUEST_SECONDS = metrics.histogram(
+    'court_request_seconds',
+    'Time until the court site starts responding to a request',
+    ['court', 'endpoint'])
+REQUEST_ERRORS = metrics.counter(
+    'court_request_errors_total',
+    'Requests to the court site that raised an error',
+    ['court', 'endpoint'])
+RESPONSE_BYTES = metrics.counter(
+    'court_response_bytes_total',
+    'Bytes of response bodies from the court site, as sent (wire) and decompressed (body)',
+    ['court', 'size'])
+CONNECTIONS = metrics.counter(
+    'court_request_connections_total',
+    'Requests to the court site, by whether they reused an open connection',
+    ['court', 'connection'])
+
+# Requests that fail with a transient error are retried this many times
+REQUEST_RETRIES = 3
+
+# One breaker per site, court and endpoint, shared by every opener in the
+# process. A court whose site keeps failing is skipped for a while, without
+# holding up work on the other courts.
+BREAKERS = resilience.BreakerRegistry(failure_threshold=5, reset_seconds=30,
+                                      max_reset_seconds=600)
+
+# Seconds to wait for a connection, and then for each read from it, by kind
+# of page. Searches can keep the site busy for a while; anything else should
+# answer quickly. Override with COURT_TIMEOUTS, e.g. search=10:120,details=10:45
+Timeouts = collections.namedtuple('Timeouts', ['connect', 'read'])
+TIMEOUTS = {
+    'search': Timeouts(10, 90),
+    'details': Timeouts(10, 45),
+    'session': Timeouts(10, 30)
+}
+ENDPOINT_KINDS = {
+    # district
+    'caseSearch.do': 'search',
+    'criminalCivilCaseSearch.do': 'search',
+    'nameSearch.do': 'search',
+    'criminalDetail.do': 'details',
+    # circuit
+    'Search.do': 'search',
+    'hearSearch.do': 'search',
+    'CaseDetail.do': 'details'
+}
+
+def parse_timeouts(value):
+    timeouts = {}
+    for setting in value.split(','):
+        kind, seconds = setting.split('=')
+        connect, read = seconds.split(':')
+        timeouts[kind.strip()] = Timeouts(float(connect), float(read))
+    return timeouts
+
+if os.environ.get('COURT_TIMEOUTS'):
+    TIMEOUTS.update(parse_timeouts(os.environ['COURT_TIMEOUTS']))
+
+def get_timeouts(endpoint):
+    return TIMEOUTS[ENDPOINT_KINDS.get(endpoint, 'session')]
+
+class TimeoutsMixin:
+    """Connections that take Timeouts for their timeout, and use the read
+    timeout once connected."""
+    def __init__(self, host, timeout=None, **kwargs):
+        self.read_timeout = None
+        if isinstance(timeout, Timeouts):
+            self.read_timeout = timeout.read
+            timeout = timeout.connect
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        self.connection_class.__init__(self, host, **kwargs)
+
+    def connect(self):
+        self.connection_class.connect(self)
+        if self.read_timeout is not None:
+            self.sock.settimeout(self.read_timeout)
+
+    def set_timeout(self, timeout):
+        """Change the read timeout of an open connection that's reused."""
+        if isinstance(timeout, Timeouts):
+            timeout = timeout.read
+        elif not isinstance(timeout, (int, float)):
+            timeout = None
+        self.read_timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+class HTTPConnection(TimeoutsMixin, httplib.HTTPConnection):
+    connection_class = httplib.HTTPConnection
+
+class HTTPSConnection(TimeoutsMixin, httplib.HTTPSConnection):
+    connection_class = httplib.HTTPSConnection
+
+class KeepAliveMixin:
+    """Handlers that keep a connection open to each host and reuse it,
+    instead of mechanize's connection per request, and ask for gzipped
+    responses. Each response is read whole, and decompressed, as soon as it
+    arrives, which frees the connection for the next request and gives the
+    parsers one buffer rather than a socket to read in pieces.
+
+    A handler belongs to one Browser, which is only used by one thread at a
+    time, so its connections aren't locked.
+    """
+    def get_connection(self, connection_class, req):
+        """Returns (connection, whether it was already open)."""
+        key = (req.get_host(), req._tunnel_host)
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            connection.set_timeout(req.timeout)
+            return connection, True
+        connection = connection_class(req.get_host(), timeout=req.timeout)
+        connection.set_debuglevel(self._debuglevel)
+        if req._tunnel_host:
+            connection.set_tunnel(req._tunnel_host)
+        return connection, False
+
+    def do_open(self, connection_class, req):
+        if not req.get_host():
+            raise urllib2.URLError('no host given')
+        if not hasattr(self, 'connections'):
+            self.connections = {}
+        while True:
+            connection, reused = self.get_connection(connection_class, req)
+            connection.request_sent = False
+            try:
+                response = self.send(connection, req)
+                break
+            except (socket.error, httplib.HTTPException), err:
+                connection.close()
+                if reused and self.can_resend(req, err, connection.request_sent):
+                    continue
+                raise urllib2.URLError(err)
+        if not response.will_close:
+            self.connections[(req.get_host(), req._tunnel_host)] = connection
+        else:
+            connection.close()
+        return self.build_response(req, response, reused)
+
+    def can_resend(self, req, err, request_sent):
+        """Whether a request that failed on a reused connection can be sent
+        again on a new one, the server having likely closed the connection
+        while it sat open. A POST can only go again if the server can't have
+        acted on it: it wasn't sent, or the server closed the connection
+        without answering. Otherwise it could be a paging request the site
+        has already moved past (see Opener.open)."""
+        if isinstance(err, socket.timeout):
+            # the server was just slow to answer
+            return False
+        if req.get_method() in ('GET', 'HEAD') or not request_sent:
+            return True
+        return isinstance(err, httplib.BadStatusLine) and \
+            (err.line in ('', "''") or err.line.startswith('No status line received'))
+
+    def send(self, connection, req):
+        headers = dict(req.headers)
+        headers.update(req.unredirected_hdrs)
+        headers['Accept-Encoding'] = 'gzip'
+        headers = dict((name.title(), value) for name, value in headers.items())
+        connection.request(req.get_method(), req.get_selector(), req.data, headers)
+        connection.request_sent = True
+        response = connection.getresponse()
+        response.body = response.read()
+        return response
+
+    def build_response(self, req, response, reused):
+        body = response.body
+        wire_bytes = len(body)
+        headers = response.msg
+        if 'gzip' in headers.get('content-encoding', ''):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            # describe the body as it's handed on
+            del headers['content-encoding']
+            del headers['content-length']
+            headers['Content-Length'] = str(len(body))
+        page = closeable_response(StringIO(body), headers, req.get_full_url(),
+                                  response.status, response.reason)
+        page.wire_bytes = wire_bytes
+        page.body_bytes = len(body)
+        page.connection_reused = reused
+        return page
+
+class HTTPHandler(KeepAliveMixin, mechanize.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(HTTPConnection, req)
+
+class HTTPSHandler(KeepAliveMixin, mechanize.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(HTTPSConnection, req)
+
+class Browser(mechanize.Browser):
+    handler_classes = dict(mechanize.Browser.handler_classes,
+                           http=HTTPHandler, https=HTTPSHandler)
+
+class SessionExpired(Exception):
+    """Raised when a court's site answers a request with its welcome or
+    CAPTCHA page instead, meaning the session has to be re-established."""
+    pass
+
+def is_transient(err):
+    """Errors worth retrying: the site being overloaded or briefly
+    unreachable, not it rejecting the request."""
+    if isinstance(err, urllib2.HTTPError):
+        return err.code >= 500 or err.code == 429
+    return isinstance(err, (urllib2.URLError, socket.error, httplib.HTTPException))
+
+def get_unavailable_courts(name):
+    """Courts on the name site with an open circuit breaker."""
+    return set(court for site, court, endpoint in BREAKERS.open_keys()
+               if site == name and court is not None)
 
 class NoHistory(object):
     def add(self, *a, **k): pass
@@ -6,18 +227,71 @@ class NoHistory(object):
 
 class Opener:
     def __init__(self, name):
-        self.opener = mechanize.Browser(history=NoHistory())
+        self.name = name
+        # the court the session is on, set by the court openers
+        self.court = None
+        self.opener = Browser(history=NoHistory())
         self.opener.set_handle_robots(False)
+        self.cookiejar = mechanize.CookieJar()
+        self.opener.set_cookiejar(self.cookiejar)
 
     def set_cookie(self, name, value):
         self.opener.set_cookie(str(name) + '=' + str(value))
 
-    def save_cookies(self):
-        return
+    def get_cookies(self):
+        """The session's cookies, as dicts that can be stored as JSON and
+        given to set_cookies."""
+        return [{
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'secure': cookie.secure
+        } for cookie in self.cookiejar]
+
+    def set_cookies(self, cookies):
+        """Replace the session's cookies with ones from get_cookies."""
+        self.cookiejar.clear()
+        for cookie in cookies:
+            self.cookiejar.set_cookie(mechanize.Cookie(
+                0, cookie['name'], cookie['value'], None, False,
+                cookie['domain'], True, cookie['domain'].startswith('.'),
+                cookie['path'], True, cookie['secure'], None, True,
+                None, None, {}))
+
+    def open(self, url, data=None, idempotent=None):
+        """Open url, posting data if given. Requests that fail with a
+        transient error are retried if they're idempotent, which GETs are
+        and POSTs are only when the caller says so. A POST that moves the
+        site's state on, like asking for the next page of results, mustn't
+        be sent twice: if the site had already moved on, the retry would get
+        the page after. Those errors are raised for the caller to start over."""
+        if idempotent is None:
+            idempotent = data is None
+        # label by page, e.g. caseSearch.do, not by the full url with its
+        # query string, to keep the number of series small
+        endpoint = urlparse.urlparse(url).path.rsplit('/', 1)[-1]
+        breaker = BREAKERS.get((self.name, self.court, endpoint))
+        return resilience.call_with_retries(
+            lambda: self.open_once(endpoint, url, data), breaker,
+            REQUEST_RETRIES if idempotent else 0, is_transient)
+
+    def open_once(self, endpoint, url, data=None):
+        try:
+            with REQUEST_SECONDS.time(court=self.name, endpoint=endpoint), \
+                    tracing.span('fetch'):
+                page = self.opener.open(url, data, timeout=get_timeouts(endpoint))
+        except Exception:
+            REQUEST_ERRORS.inc(court=self.name, endpoint=endpoint)
+            raise
+        self.record_transfer(page)
+        return page
 
-    def open(self, *args):
-        url = args[0]
-        if len(args) == 2:
-            data = args[1]
-            return self.opener.open(url, data)
-        return self.opener.open(url)
+    def record_transfer(self, page):
+        wire_bytes = getattr(page, 'wire_bytes', None)
+        if wire_bytes is None:
+            return
+        RESPONSE_BYTES.inc(wire_bytes, court=self.name, size='wire')
+        RESPONSE_BYTES.inc(page.body_bytes, court=self.name, size='body')
+        CONNECTIONS.inc(court=self.name,
+                        connection='reused' if page.connection_reused else 'new')
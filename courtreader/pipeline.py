@@ -0,0 +1,66 @@
+"""Parse case detail pages in a pool of worker processes.
+
+BeautifulSoup parsing is CPU bound and used to run on the same thread that
+owns the HTTP session, so the collector was either waiting on the court's
+server or parsing, never both. In pipeline mode the reader only fetches raw
+pages (fetch_case_details_by_number) and hands them to a ParsePool; the
+collector keeps fetching while earlier cases are parsed on other cores, and
+writes parsed cases to the database as they come back.
+"""
+import multiprocessing
+import signal
+import time
+from circuitcourtparser import PARSE_SECONDS
+from readers import parse_case_details_pages
+
+def init_worker():
+    # Let the collector handle Ctrl-C and shut the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def parse_and_time(court_type, case_type, pages):
+    # Metrics recorded in a worker stay in the worker, so the parse time is
+    # sent back with the result and recorded by the collector
+    start = time.time()
+    details = parse_case_details_pages(court_type, case_type, pages)
+    return details, time.time() - start
+
+class ParsePool:
+    def __init__(self, court_type, processes=None):
+        self.court_type = court_type
+        self.pool = multiprocessing.Pool(processes, init_worker)
+        self.pending = []
+
+    def submit(self, case, case_type, pages, trace=None):
+        """Queue a case's pages to be parsed. The parse time is added to
+        trace, the case's courtutils.tracing.Trace, if there is one."""
+        result = self.pool.apply_async(parse_and_time,
+                                       (self.court_type, case_type, pages))
+        self.pending.append((case, result, trace))
+
+    def completed(self):
+        """Yield (case, details, trace) for cases whose parse has finished,
+        in the order they were submitted, without waiting on the rest."""
+        while len(self.pending) > 0 and self.pending[0][1].ready():
+            case, result, trace = self.pending.pop(0)
+            yield case, self.get_details(result, trace), trace
+
+    def drain(self):
+        """Yield (case, details, trace) for every submitted case, waiting
+        as needed."""
+        while len(self.pending) > 0:
+            case, result, trace = self.pending.pop(0)
+            yield case, self.get_details(result, trace), trace
+
+    def get_details(self, result, trace):
+        details, elapsed = result.get()
+        PARSE_SECONDS.observe(elapsed, court=self.court_type, page='case_details')
+        if trace is not None:
+            trace.add_elsewhere('parse', elapsed)
+        return details
+
+    def discard(self):
+        self.pending = []
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -2,34 +2,99 @@ import circuitcourtparser
 import districtcourtparser
 import logging
 import sys
+from bs4 import BeautifulSoup
+from courtutils import metrics, tracing
 from circuitcourtopener import CircuitCourtOpener
 from districtcourtopener import DistrictCourtOpener
+from opener import SessionExpired
 from time import sleep
 
 log = logging.getLogger('logentries')
 
+SESSION_RETRIES = metrics.counter(
+    'court_session_retries_total',
+    'Requests retried after the court site expired the session', ['court'])
+COURT_CHANGES = metrics.counter(
+    'court_changes_total', 'Times a reader switched courts', ['court'])
+
+# Court lists parsed from the welcome pages. They don't change while a worker
+# runs, so reconnecting doesn't need to parse them again.
+COURT_NAMES = {}
+
+def session_required(method):
+    """Connect on first use and, if the court's site reports that the session
+    has expired, reconnect and try the request once more."""
+    def wrapper(self, *args, **kwargs):
+        if not self.connected:
+            self.connect()
+        try:
+            return method(self, *args, **kwargs)
+        except SessionExpired:
+            log.warn('Session expired, reconnecting')
+            SESSION_RETRIES.inc(court=self.court_type)
+            self.reconnect()
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+def parse_case_details_pages(court_type, case_type, pages):
+    """Parse the raw pages returned by a reader's fetch_case_details_by_number.
+
+    Kept at module level, away from the readers and their sessions, so it
+    can run in a worker process (see courtreader.pipeline).
+    """
+    with circuitcourtparser.PARSE_SECONDS.time(court=court_type, page='case_details'), \
+            tracing.span('parse'):
+        return parse_pages(court_type, case_type, pages)
+
+def parse_pages(court_type, case_type, pages):
+    if court_type == 'district':
+        soup = BeautifulSoup(pages[0], 'html.parser')
+        return districtcourtparser.parse_case_details(soup, case_type)
+
+    soup, pleadings_soup, services_soup = [
+        BeautifulSoup(page, 'html.parser') for page in pages
+    ]
+    if case_type == 'civil':
+        case_details = circuitcourtparser.parse_civil_case_details(soup)
+    else:
+        case_details = circuitcourtparser.parse_case_details(soup)
+    case_details['Pleadings'] = circuitcourtparser.parse_pleadings_table(pleadings_soup, case_type)
+    case_details['Services'] = circuitcourtparser.parse_services_table(services_soup, case_type)
+    return case_details
+
 class DistrictCourtReader:
-    def __init__(self):
-        self.searches_on_session = 0
+    court_type = 'district'
+
+    def __init__(self, session_pool=False, hedge=False):
+        self.connected = False
         self.fips_code = ''
         self.case_type = ''
-        self.opener = DistrictCourtOpener()
+        # number of times this reader has switched courts, for the collector
+        # to report how well tasks are being matched to sessions
+        self.court_changes = 0
+        self.opener = DistrictCourtOpener(session_pool, hedge)
 
     def connect(self):
         soup = self.opener.open_welcome_page()
-        self.court_names = districtcourtparser.parse_court_names(soup)
+        if 'district' not in COURT_NAMES:
+            COURT_NAMES['district'] = districtcourtparser.parse_court_names(soup)
+        self.court_names = COURT_NAMES['district']
+        self.connected = True
         return self.court_names
 
-    def manage_opener(self):
-        self.searches_on_session += 1
-        if self.searches_on_session > 10000:
-            print 'RESETTING OPENER'
+    def reconnect(self):
+        # reconnecting means the site expired the session
+        self.opener.discard_session()
+        try:
             self.log_off()
-            sleep(2)
-            self.connect()
-            self.searches_on_session = 0
-            self.fips_code = ''
-            print 'RESET SUCCESSFUL'
+        except Exception:
+            pass
+        self.connected = False
+        self.fips_code = ''
+        sleep(2)
+        self.connect()
 
     def change_court(self, fips_code, case_type):
         if fips_code != self.fips_code or case_type != self.case_type:
@@ -38,24 +103,30 @@ class DistrictCourtReader:
             self.opener.change_court(name, fips_code)
             self.fips_code = fips_code
             self.case_type = case_type
+            self.court_changes += 1
+            COURT_CHANGES.inc(court=self.court_type)
             sleep(1)
 
     def log_off(self):
         self.opener.log_off()
 
-    def get_case_details_by_number(self, fips_code, case_type, case_number, case_details_url=None):
-        self.manage_opener()
+    @session_required
+    def fetch_case_details_by_number(self, fips_code, case_type, case_number, case_details_url=None):
         self.change_court(fips_code, case_type)
         sleep(1)
         search_division = 'T'
         if case_type == 'civil':
             search_division = 'V'
-        soup = self.opener.do_case_number_search(fips_code, case_number, search_division) \
-            if case_details_url is None else self.opener.open_case_details(case_details_url)
-        return districtcourtparser.parse_case_details(soup, case_type)
+        content = self.opener.do_case_number_search_html(fips_code, case_number, search_division) \
+            if case_details_url is None else self.opener.open_case_details_html(case_details_url)
+        return (content,)
 
+    def get_case_details_by_number(self, fips_code, case_type, case_number, case_details_url=None):
+        pages = self.fetch_case_details_by_number(fips_code, case_type, case_number, case_details_url)
+        return parse_case_details_pages('district', case_type, pages)
+
+    @session_required
     def get_cases_by_date(self, fips_code, case_type, date):
-        self.manage_opener()
         self.change_court(fips_code, case_type)
         search_division = 'T'
         if case_type == 'civil':
@@ -66,28 +137,30 @@ class DistrictCourtReader:
         #date = date.strftime('%m/%d/%Y')
         print '\tSearching ' + self.court_names[fips_code] + \
               ' for cases on ' + date
-        soup = self.opener.do_hearing_date_search(fips_code, date, True)
+        content = self.opener.do_hearing_date_search_html(fips_code, date, True)
         sleep(1)
 
         cases = []
         while True:
-            cases.extend(districtcourtparser.parse_hearing_date_search(soup, case_type))
+            found_cases, next_page = districtcourtparser.parse_hearing_date_search_page(
+                content, case_type)
+            cases.extend(found_cases)
             print '\tFound ' + str(len(cases)) + ' cases\r',
             sys.stdout.flush()
-            if not districtcourtparser.next_button_found(soup):
+            if not next_page:
                 break
             sleep(1)
-            soup = self.opener.do_hearing_date_search(fips_code, date, False)
+            content = self.opener.do_hearing_date_search_html(fips_code, date, False)
         return cases
 
+    @session_required
     def get_case_details(self, case):
-        self.manage_opener()
         sleep(1)
         soup = self.opener.open_case_details(case)
         return districtcourtparser.parse_case_details(soup, None)
 
+    @session_required
     def get_cases_by_name(self, fips_code, case_type, name):
-        self.manage_opener()
         self.change_court(fips_code, case_type)
         search_division = 'T'
         if case_type == 'civil':
@@ -98,10 +171,10 @@ class DistrictCourtReader:
         count = 0
         found_cases = None
         while True:
-            soup = self.opener.do_name_search(fips_code, search_division, name, count, found_cases)
-            found_cases = districtcourtparser.parse_name_search(soup)
+            content = self.opener.do_name_search_html(fips_code, search_division, name, count, found_cases)
+            found_cases, next_page = districtcourtparser.parse_name_search_page(content)
             cases.extend(found_cases)
-            if not districtcourtparser.next_names_button_found(soup):
+            if not next_page:
                 break
             log.info('Next Names Page')
             print 'Next Names Page'
@@ -110,28 +183,35 @@ class DistrictCourtReader:
         return cases
 
 class CircuitCourtReader:
+    court_type = 'circuit'
+
     def __init__(self):
+        self.connected = False
         self.fips_code = ''
         self.case_type = ''
+        # number of times this reader has switched courts, for the collector
+        # to report how well tasks are being matched to sessions
+        self.court_changes = 0
         self.opener = CircuitCourtOpener()
-        self.searches_on_session = 0
-
-    def manage_opener(self):
-        self.searches_on_session += 1
-        if self.searches_on_session > 100:
-            print 'RESETTING OPENER'
-            self.log_off()
-            sleep(2)
-            self.connect()
-            self.searches_on_session = 0
-            self.fips_code = ''
-            print 'RESET SUCCESSFUL'
 
     def connect(self):
         soup = self.opener.open_welcome_page()
-        self.courts = circuitcourtparser.parse_court_names(soup)
+        if 'circuit' not in COURT_NAMES:
+            COURT_NAMES['circuit'] = circuitcourtparser.parse_court_names(soup)
+        self.courts = COURT_NAMES['circuit']
+        self.connected = True
         return self.courts
 
+    def reconnect(self):
+        try:
+            self.log_off()
+        except Exception:
+            pass
+        self.connected = False
+        self.fips_code = ''
+        sleep(2)
+        self.connect()
+
     def log_off(self):
         self.opener.log_off()
 
@@ -141,54 +221,54 @@ class CircuitCourtReader:
             self.opener.change_court(fips_code, self.courts[fips_code]['full_name'])
             self.fips_code = fips_code
             self.case_type = case_type
+            self.court_changes += 1
+            COURT_CHANGES.inc(court=self.court_type)
             sleep(1)
 
-    def get_case_details_by_number(self, fips, case_type, case_number, case_details_url=None):
-        self.manage_opener()
+    @session_required
+    def fetch_case_details_by_number(self, fips, case_type, case_number, case_details_url=None):
         category_code = 'R'
         if case_type == 'civil':
             category_code = 'CIVIL'
         self.change_court(fips, case_type)
-        soup = self.opener.do_case_number_search(fips, case_number, category_code)
-        pleadings_soup = self.opener.do_case_number_pleadings_search(fips, case_number, category_code)
-        services_soup = self.opener.do_case_number_services_search(fips, case_number, category_code)
+        content = self.opener.do_case_number_search_html(fips, case_number, category_code)
+        pleadings_content = self.opener.do_case_number_pleadings_search_html(fips, case_number, category_code)
+        services_content = self.opener.do_case_number_services_search_html(fips, case_number, category_code)
         self.opener.return_to_main_menu(fips)
-        if case_type == 'civil':
-            case_details = circuitcourtparser.parse_civil_case_details(soup)
-        else:
-            case_details = circuitcourtparser.parse_case_details(soup)
-        case_details['Pleadings'] = circuitcourtparser.parse_pleadings_table(pleadings_soup, case_type)
-        case_details['Services'] = circuitcourtparser.parse_services_table(services_soup, case_type)
-        return case_details
+        return (content, pleadings_content, services_content)
+
+    def get_case_details_by_number(self, fips, case_type, case_number, case_details_url=None):
+        pages = self.fetch_case_details_by_number(fips, case_type, case_number, case_details_url)
+        return parse_case_details_pages('circuit', case_type, pages)
 
+    @session_required
     def get_cases_by_name(self, fips_code, case_type, name):
-        self.manage_opener()
         category_code = 'R'
         if case_type == 'civil':
             category_code = 'CIVIL'
         self.change_court(fips_code, case_type)
         cases = []
-        soup = self.opener.do_name_search(fips_code, name, category_code)
-        all_found = circuitcourtparser.parse_name_search(soup, name, cases)
+        content = self.opener.do_name_search_html(fips_code, name, category_code)
+        all_found = circuitcourtparser.parse_name_search_page(content, name, cases)
         while not all_found:
             sleep(1)
-            soup = self.opener.continue_name_search(fips_code, category_code)
-            all_found = circuitcourtparser.parse_name_search(soup, name, cases)
+            content = self.opener.continue_name_search_html(fips_code, category_code)
+            all_found = circuitcourtparser.parse_name_search_page(content, name, cases)
         return cases
 
+    @session_required
     def get_cases_by_date(self, fips_code, case_type, date):
-        self.manage_opener()
         category_code = 'R'
         if case_type == 'civil':
             category_code = 'CIVIL'
         self.change_court(fips_code, case_type)
         cases = []
-        soup = self.opener.do_date_search(fips_code, date, category_code)
-        all_found = circuitcourtparser.parse_date_search(soup, cases)
+        content = self.opener.do_date_search_html(fips_code, date, category_code)
+        all_found = circuitcourtparser.parse_date_search_page(content, cases)
         print 'FINAL PAGE', all_found
         while not all_found:
             sleep(1)
-            soup = self.opener.continue_date_search(fips_code, category_code)
-            all_found = circuitcourtparser.parse_date_search(soup, cases)
+            content = self.opener.continue_date_search_html(fips_code, category_code)
+            all_found = circuitcourtparser.parse_date_search_page(content, cases)
             print 'FINAL PAGE', all_found
         return cases
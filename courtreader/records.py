@@ -0,0 +1,257 @@
+"""Compact record types for parsed court data.
+
+Parsed cases used to be plain dicts, which cost a hash table per hearing,
+service and party. Records store their known fields in __slots__ but keep
+the dict interface the rest of the code relies on (case['CaseNumber'],
+'Hearings' in details, Model(**details)), so they can be handed straight to
+the database writers. Fields a record doesn't know about are kept in a
+small overflow dict that is only allocated when needed.
+"""
+import hashlib
+import json
+from datetime import date
+
+class Record(object):
+    __slots__ = ('_extra',)
+    _fields = frozenset()
+
+    def __init__(self, **fields):
+        for key, value in fields.iteritems():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        extra = self._get_extra()
+        if extra is None or key not in extra:
+            raise KeyError(key)
+        return extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+            return
+        extra = self._get_extra()
+        if extra is None:
+            extra = self._extra = {}
+        extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            try:
+                delattr(self, key)
+                return
+            except AttributeError:
+                raise KeyError(key)
+        extra = self._get_extra()
+        if extra is None or key not in extra:
+            raise KeyError(key)
+        del extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.to_dict())
+
+    def __getstate__(self):
+        return self.to_dict(recursive=False)
+
+    def __setstate__(self, state):
+        for key, value in state.iteritems():
+            self[key] = value
+
+    def _get_extra(self):
+        try:
+            return self._extra
+        except AttributeError:
+            return None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        del self[key]
+        return value
+
+    def keys(self):
+        keys = [key for key in self.__slots__ if hasattr(self, key)]
+        extra = self._get_extra()
+        if extra:
+            keys.extend(extra.keys())
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def to_dict(self, recursive=True):
+        data = {}
+        for key, value in self.iteritems():
+            if recursive and isinstance(value, list):
+                value = [item.to_dict() if isinstance(item, Record) else item
+                         for item in value]
+            elif recursive and isinstance(value, Record):
+                value = value.to_dict()
+            data[key] = value
+        return data
+
+def json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Record):
+        return value.to_dict(recursive=False)
+    raise TypeError(repr(value))
+
+def content_hash(value):
+    """A stable hash of parsed data, records, dicts and lists included, for
+    telling whether a case has changed since it was last stored. Keys are
+    sorted, so field order doesn't matter; list order does."""
+    serialized = json.dumps(value, sort_keys=True, separators=(',', ':'),
+                            default=json_default)
+    return hashlib.sha1(serialized).hexdigest()
+
+def record_type(name, fields):
+    fields = tuple(fields)
+    return type(name, (Record,), {
+        '__slots__': fields,
+        '_fields': frozenset(fields)
+    })
+
+#
+# Search results
+#
+HearingDateSearchResult = record_type('HearingDateSearchResult', [
+    'case_number',
+    'details_url',
+    'defendant',
+    'plaintiff',
+    'civil_case_type',
+    'hearing_time',
+    'status',
+    # filled in by the collector
+    'fips',
+    'details_fetched_for_hearing_date',
+    'collected',
+    'details'
+])
+
+#
+# Case details
+#
+CircuitCriminalCaseDetails = record_type('CircuitCriminalCaseDetails', [
+    'CaseNumber', 'Filed', 'Commencedby', 'Locality',
+    'Defendant', 'AKA', 'AKA2', 'Sex', 'Race', 'DOB', 'Address',
+    'Charge', 'CodeSection', 'ChargeType', 'Class', 'OffenseDate', 'ArrestDate',
+    'DispositionCode', 'DispositionDate', 'ConcludedBy',
+    'AmendedCharge', 'AmendedCodeSection', 'AmendedChargeType',
+    'JailPenitentiary', 'ConcurrentConsecutive', 'LifeDeath',
+    'SentenceTime', 'SentenceSuspended', 'OperatorLicenseSuspensionTime',
+    'FineAmount', 'Costs', 'FinesCostPaid', 'ProgramType',
+    'ProbationType', 'ProbationTime', 'ProbationStarts',
+    'CourtDMVSurrender', 'DriverImprovementClinic', 'DrivingRestrictions',
+    'RestrictionEffectiveDate', 'RestrictionEndDate', 'VAAlcoholSafetyAction',
+    'RestitutionPaid', 'RestitutionAmount', 'Military', 'TrafficFatality',
+    'AppealedDate',
+    'Hearings', 'Pleadings', 'Services', 'error'
+])
+
+CircuitCivilCaseDetails = record_type('CircuitCivilCaseDetails', [
+    'CaseNumber', 'Filed', 'FilingType', 'FilingFeePaid',
+    'NumberofPlaintiffs', 'NumberofDefendants', 'CommencedBy', 'Bond',
+    'ComplexCase', 'DateOrderedToMediation', 'Judgment', 'FinalOrderDate',
+    'AppealedDate', 'ConcludedBy',
+    'Hearings', 'Pleadings', 'Services', 'Plaintiffs', 'Defendants', 'error'
+])
+
+DistrictCriminalCaseDetails = record_type('DistrictCriminalCaseDetails', [
+    'CaseNumber', 'FiledDate', 'Locality', 'Name', 'Status', 'DefenseAttorney',
+    'Address', 'AKA1', 'AKA2', 'Gender', 'Race', 'DOB',
+    'Charge', 'CodeSection', 'CaseType', 'Class', 'OffenseDate', 'ArrestDate',
+    'Complainant', 'AmendedCharge', 'AmendedCode', 'AmendedCaseType',
+    'FinalDisposition', 'SentenceTime', 'SentenceSuspendedTime',
+    'ProbationType', 'ProbationTime', 'ProbationStarts',
+    'OperatorLicenseSuspensionTime', 'RestrictionEffectiveDate',
+    'RestrictionEndDate', 'OperatorLicenseRestrictionCodes',
+    'Fine', 'Costs', 'FineCostsDue', 'FineCostsPastDue', 'FineCostsPaid',
+    'FineCostsPaidDate', 'VASAP',
+    'Hearings', 'Services'
+])
+
+DistrictCivilCaseDetails = record_type('DistrictCivilCaseDetails', [
+    'CaseNumber', 'FiledDate', 'CaseType', 'DebtType',
+    'Judgment', 'Costs', 'AttorneyFees', 'PrincipalAmount', 'OtherAmount',
+    'InterestAward', 'Possession', 'WritIssuedDate', 'HomesteadExemptionWaived',
+    'IsJudgmentSatisfied', 'DateSatisfactionFiled', 'OtherAwarded',
+    'FurtherCaseInformation', 'Garnishee', 'Address', 'GarnisheeAnswer',
+    'AnswerDate', 'NumberofChecksReceived', 'AppealDate', 'AppealedBy',
+    'Hearings', 'Services', 'Reports', 'Plaintiffs', 'Defendants'
+])
+
+def get_case_details_type(court_type, case_type):
+    if court_type == 'circuit':
+        if case_type == 'civil':
+            return CircuitCivilCaseDetails
+        return CircuitCriminalCaseDetails
+    if case_type == 'civil':
+        return DistrictCivilCaseDetails
+    return DistrictCriminalCaseDetails
+
+#
+# Case detail tables
+#
+CircuitHearing = record_type('CircuitHearing', [
+    'Date', 'Result', 'Duration', 'Jury', 'Plea', 'Type', 'Room'
+])
+
+DistrictHearing = record_type('DistrictHearing', [
+    'Date', 'Result', 'Plea', 'ContinuanceCode', 'HearingType', 'Courtroom'
+])
+
+CircuitPleading = record_type('CircuitPleading', [
+    'Filed', 'Type', 'Party', 'Judge', 'Book', 'Page', 'Remarks'
+])
+
+CircuitService = record_type('CircuitService', [
+    'HowServed', 'HearDate', 'DateServed', 'Name', 'Type'
+])
+
+DistrictService = record_type('DistrictService', [
+    'HowServed', 'DateIssued', 'DateReturned', 'Plaintiff', 'PersonServed',
+    'ProcessType'
+])
+
+DistrictReport = record_type('DistrictReport', [
+    'ReportType', 'ReportingAgency', 'DateOrdered', 'DateDue', 'DateReceived'
+])
+
+CircuitParty = record_type('CircuitParty', [
+    'Name', 'TradingAs', 'Attorney'
+])
+
+DistrictParty = record_type('DistrictParty', [
+    'Name', 'DBATA', 'Address', 'Judgment', 'Attorney'
+])
@@ -0,0 +1,197 @@
+"""Court site sessions shared between workers through a file.
+
+Getting a district court session means solving a CAPTCHA, so sessions are
+kept in a JSON file (COURT_SESSION_STORE, by default court_sessions.json)
+that every worker on the machine shares, and reused when a worker restarts.
+A session can only be used by one worker at a time, since the site keeps
+the selected court and search results in it, so workers lease sessions
+from the store and release them when they're done. A lease that isn't
+renewed within lease_seconds, because its worker died, runs out and the
+session can be leased again.
+
+Sessions the site has probably expired, having gone unused for longer
+than max_idle_seconds, are dropped. Whoever leases a session still has to
+check that the site accepts it, and discard it if not.
+"""
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+log = logging.getLogger('logentries')
+
+DEFAULT_PATH = 'court_sessions.json'
+LEASE_SECONDS = 300
+MAX_IDLE_SECONDS = 20 * 60
+
+# Leases are renewed at most this often
+RENEW_SECONDS = 60
+
+class FileLock(object):
+    """A lock shared between processes, held by creating a lock file.
+    Locks left by a dead process are broken after stale_seconds."""
+    def __init__(self, path, stale_seconds=30):
+        self.path = path
+        self.stale_seconds = stale_seconds
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except OSError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale_seconds:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    pass
+                time.sleep(0.05)
+
+    def __exit__(self, *exc_info):
+        os.remove(self.path)
+        return False
+
+class SessionStore(object):
+    def __init__(self, path=None, lease_seconds=LEASE_SECONDS,
+                 max_idle_seconds=MAX_IDLE_SECONDS):
+        if path is None:
+            path = os.environ.get('COURT_SESSION_STORE', DEFAULT_PATH)
+        self.path = path
+        self.lock = FileLock(path + '.lock')
+        self.lease_seconds = lease_seconds
+        self.max_idle_seconds = max_idle_seconds
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, sessions):
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(sessions, f, indent=2)
+        try:
+            os.rename(temp_path, self.path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(self.path)
+            os.rename(temp_path, self.path)
+
+    def update(self, site, change):
+        """Apply change to the sessions for site, under the lock, after
+        dropping expired ones. Returns what change returns."""
+        with self.lock:
+            sessions = self.load()
+            site_sessions = sessions.setdefault(site, {})
+            now = time.time()
+            for session_id, session in site_sessions.items():
+                if now - session['last_used'] > self.max_idle_seconds and \
+                        not self.is_leased(session, now):
+                    log.info('Dropping idle %s session %s', site, session_id)
+                    del site_sessions[session_id]
+            result = change(site_sessions, now)
+            self.save(sessions)
+            return result
+
+    def is_leased(self, session, now):
+        return session.get('leased_until', 0) > now
+
+    def lease(self, site, idle_seconds=None):
+        """Lease the most recently used free session for site, or with
+        idle_seconds, the least recently used one that's been idle at least
+        that long. Returns a lease, a dict with the session's cookies, or
+        None."""
+        def take(site_sessions, now):
+            free = [(session['last_used'], session_id)
+                    for session_id, session in site_sessions.iteritems()
+                    if not self.is_leased(session, now)]
+            if idle_seconds is not None:
+                free = [(last_used, session_id) for last_used, session_id in free
+                        if now - last_used >= idle_seconds]
+            if not free:
+                return None
+            session_id = max(free)[1] if idle_seconds is None else min(free)[1]
+            session = site_sessions[session_id]
+            session['leased_by'] = self.owner
+            session['leased_until'] = now + self.lease_seconds
+            session['lease_token'] = uuid.uuid4().hex
+            return self.build_lease(site, session_id, session, now)
+        return self.update(site, take)
+
+    def add(self, site, cookies):
+        """Store a new session, leased to the caller."""
+        def add(site_sessions, now):
+            session_id = uuid.uuid4().hex
+            site_sessions[session_id] = {
+                'cookies': cookies,
+                'created': now,
+                'last_used': now,
+                'leased_by': self.owner,
+                'leased_until': now + self.lease_seconds,
+                'lease_token': uuid.uuid4().hex
+            }
+            return self.build_lease(site, session_id, site_sessions[session_id], now)
+        return self.update(site, add)
+
+    def holds(self, lease, session, now):
+        """Whether lease is still the session's current, unexpired lease."""
+        return session is not None and self.is_leased(session, now) and \
+            session.get('lease_token') == lease['token']
+
+    def renew(self, lease, force=False):
+        """Extend a lease, and note that its session is still in use. Does
+        nothing if the lease was renewed in the last RENEW_SECONDS. Returns
+        False if the lease had already run out, after which the session may
+        have been leased by someone else and shouldn't be used."""
+        if not force and time.time() - lease['renewed'] < RENEW_SECONDS:
+            return True
+        def renew(site_sessions, now):
+            session = site_sessions.get(lease['id'])
+            if not self.holds(lease, session, now):
+                return False
+            session['last_used'] = now
+            session['leased_until'] = now + self.lease_seconds
+            lease['renewed'] = now
+            return True
+        return self.update(lease['site'], renew)
+
+    def release(self, lease):
+        """Give a session that still works back to the store."""
+        def release(site_sessions, now):
+            session = site_sessions.get(lease['id'])
+            if not self.holds(lease, session, now):
+                return
+            session['last_used'] = now
+            session['leased_until'] = 0
+            session.pop('leased_by', None)
+            session.pop('lease_token', None)
+        self.update(lease['site'], release)
+
+    def discard(self, lease):
+        """Remove a session the site no longer accepts."""
+        def discard(site_sessions, now):
+            site_sessions.pop(lease['id'], None)
+        self.update(lease['site'], discard)
+
+    def count(self, site):
+        """The number of (free, leased) sessions for site."""
+        def count(site_sessions, now):
+            leased = len([session for session in site_sessions.itervalues()
+                          if self.is_leased(session, now)])
+            return len(site_sessions) - leased, leased
+        return self.update(site, count)
+
+    def build_lease(self, site, session_id, session, now):
+        return {
+            'site': site,
+            'id': session_id,
+            'cookies': session['cookies'],
+            'token': session['lease_token'],
+            'renewed': now
+        }
@@ -1,10 +1,71 @@
 import pymongo
 import os
+from datetime import datetime, time
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from courtreader.records import content_hash
+from courtutils.tasks import is_search_fresh, to_date
+
+# Indexes for the lookups the collectors make, by collection suffix
+INDEXES = {
+    '_court_detailed_cases': [
+        [('fips', ASCENDING), ('case_number', ASCENDING),
+         ('details_fetched_for_hearing_date', DESCENDING)]
+    ],
+    '_court_dates_searched': [
+        [('fips', ASCENDING), ('date', ASCENDING), ('case_type', ASCENDING)]
+    ],
+    '_court_date_tasks': [
+        [('fips', ASCENDING), ('case_type', ASCENDING)]
+    ],
+    '_court_hearing_date_search_cache': [
+        [('fips', ASCENDING), ('case_type', ASCENDING), ('date', ASCENDING)]
+    ]
+}
+
+# Indexes are ensured once per process
+INDEXES_READY = set()
 
 class MongoDatabase():
     def __init__(self, name, court_type):
         self.client = pymongo.MongoClient(os.environ['MONGO_DB'])[name]
         self.court_type = court_type
+        # writes made with commit=False, to send in bulk on commit
+        self.pending_cases = []
+        self.pending_date_searches = []
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        if self.court_type in INDEXES_READY:
+            return
+        for suffix, indexes in INDEXES.iteritems():
+            for keys in indexes:
+                self.client[self.court_type + suffix].create_index(keys, background=True)
+        INDEXES_READY.add(self.court_type)
+
+    def commit(self):
+        """Send the writes made with commit=False, as one unordered bulk
+        write per collection."""
+        if self.pending_cases:
+            self.write_cases(self.pending_cases)
+            self.pending_cases = []
+        if self.pending_date_searches:
+            # a date searched again once its search went stale keeps its
+            # document
+            self.client[self.court_type + '_court_dates_searched'].bulk_write([
+                UpdateOne({
+                    'fips': search['fips'],
+                    'case_type': search['case_type'],
+                    'date': search['date']
+                }, {'$set': {'searched': search['searched']}}, upsert=True)
+                for search in self.pending_date_searches], ordered=False)
+            self.pending_date_searches = []
+
+    def rollback(self):
+        self.pending_cases = []
+        self.pending_date_searches = []
+
+    def disconnect(self):
+        self.client.client.close()
 
     def add_court(self, name, fips, location):
         self.client[self.court_type + '_courts'].insert_one({
@@ -26,32 +87,165 @@ class MongoDatabase():
         return self.client[self.court_type + '_courts'].find(None, {'_id':0})
 
     def add_date_tasks(self, tasks):
-        self.client[self.court_type + '_court_date_tasks'].insert_many(tasks)
+        if len(tasks) == 0:
+            return
+        # pymongo stores datetimes, not dates
+        self.client[self.court_type + '_court_date_tasks'].insert_many([dict(
+            task,
+            start_date=datetime.combine(task['start_date'], time()),
+            end_date=datetime.combine(task['end_date'], time())
+        ) for task in tasks])
+
+    def get_dates_searched(self, case_type, start_date, end_date):
+        dates = {}
+        now = datetime.now()
+        for search in self.client[self.court_type + '_court_dates_searched'].find({
+            'case_type': case_type,
+            'date': {'$lte': start_date, '$gte': end_date}
+        }):
+            if is_search_fresh(search['date'], search.get('searched'), now):
+                dates.setdefault(int(search['fips']), set()).add(to_date(search['date']))
+        return dates
+
+    def get_date_task_ranges(self, case_type, start_date, end_date):
+        # claimed tasks aren't tracked in mongo, so only queued ones count
+        ranges = {}
+        for task in self.client[self.court_type + '_court_date_tasks'].find({
+            'case_type': case_type,
+            'start_date': {'$gte': end_date},
+            'end_date': {'$lte': start_date}
+        }):
+            ranges.setdefault(int(task['fips']), []).append(
+                (to_date(task['start_date']), to_date(task['end_date'])))
+        return ranges
 
-    def add_date_task(self, task):
+    def add_date_task(self, task, stopping_work=False):
         self.client[self.court_type + '_court_date_tasks'].insert_one(task)
 
-    def get_and_delete_date_task(self):
-        return self.client[self.court_type + '_court_date_tasks'].find_one_and_delete({})
+    def get_and_delete_date_task(self, finished_task=None, fips=None, case_type=None,
+                                 exclude_fips=None):
+        collection = self.client[self.court_type + '_court_date_tasks']
+        task = None
+        if fips is not None and fips not in (exclude_fips or []):
+            task = collection.find_one_and_delete({'fips': fips, 'case_type': case_type})
+        if task is None:
+            query = {}
+            if exclude_fips:
+                query['fips'] = {'$nin': list(exclude_fips)}
+            task = collection.find_one_and_delete(query)
+        return task
+
+    def split_active_date_task(self, fips=None, case_type=None, exclude_fips=None):
+        # claimed tasks aren't tracked in mongo, so there's nothing to split
+        return None
+
+    def update_date_task_progress(self, task, date):
+        return task['end_date']
 
-    def add_date_search(self, search):
-        self.client[self.court_type + '_court_dates_searched'].insert_one(search)
+    def update_date_task_cursor(self, task, date, case_numbers, commit=True):
+        # a task put back keeps its cursor, but claimed tasks aren't stored
+        pass
+
+    def add_date_search(self, search, commit=True):
+        self.pending_date_searches.append(dict(search, searched=datetime.now()))
+        if commit:
+            self.commit()
 
     def get_date_search(self, search):
-        return self.client[self.court_type + '_court_dates_searched'].find_one(search)
+        for stored in self.client[self.court_type + '_court_dates_searched'].find(search):
+            if is_search_fresh(search['date'], stored.get('searched')):
+                return stored
+        return None
+
+    def get_cached_search_results(self, fips, case_type, date, fetched_since):
+        result = self.client[self.court_type + '_court_hearing_date_search_cache'].find_one({
+            'fips': fips,
+            'case_type': case_type,
+            'date': date,
+            'fetched': {'$gte': fetched_since}
+        })
+        if result is None:
+            return None
+        return result['results']
+
+    def cache_search_results(self, fips, case_type, date, cases):
+        self.client[self.court_type + '_court_hearing_date_search_cache'].find_one_and_replace({
+            'fips': fips,
+            'case_type': case_type,
+            'date': date
+        }, {
+            'fips': fips,
+            'case_type': case_type,
+            'date': date,
+            'fetched': datetime.now(),
+            'results': [dict(case.items()) for case in cases]
+        }, upsert=True)
+
+    def prune_search_cache(self, fetched_before):
+        return self.client[self.court_type + '_court_hearing_date_search_cache'].delete_many({
+            'fetched': {'$lt': fetched_before}
+        }).deleted_count
 
     def get_more_recent_case_details(self, case, case_type, date):
         return self.client[self.court_type + '_court_detailed_cases'].find_one({
-            'court_fips': case['court_fips'],
+            'fips': case['fips'],
             'case_number': case['case_number'],
             'details_fetched_for_hearing_date': {'$gte': date}
         })
 
-    def replace_case_details(self, case, case_type):
-        self.client[self.court_type + '_court_detailed_cases'].find_one_and_replace({
-            'court_fips': case['court_fips'],
-            'case_number': case['case_number']
-        }, case, upsert=True)
+    def get_more_recent_case_dates(self, fips, case_type, case_numbers, date):
+        dates = {}
+        if not case_numbers:
+            return dates
+        for case in self.client[self.court_type + '_court_detailed_cases'].find({
+            'fips': fips,
+            'case_number': {'$in': list(case_numbers)},
+            'details_fetched_for_hearing_date': {'$gte': date}
+        }, {'case_number': 1, 'details_fetched_for_hearing_date': 1}):
+            dates[case['case_number']] = case['details_fetched_for_hearing_date']
+        return dates
+
+    def replace_case_details(self, case, case_type, commit=True):
+        details_hash = content_hash(case['details'])
+        if hasattr(case, 'to_dict'):
+            case = case.to_dict()
+        case = dict(case, content_hash=details_hash)
+        self.pending_cases.append(case)
+        if commit:
+            self.commit()
+
+    def write_cases(self, cases):
+        collection = self.client[self.court_type + '_court_detailed_cases']
+        # unordered writes to the same case could land in either order, so
+        # only the last copy of a case in the batch is written
+        cases = dict(((case['fips'], case['case_number']), case)
+                     for case in cases).values()
+        # one query for the stored hashes of every case in the batch; cases
+        # that haven't changed just get their dates updated
+        stored_hashes = {}
+        for stored in collection.find({
+            '$or': [{
+                'fips': case['fips'],
+                'case_number': case['case_number']
+            } for case in cases]
+        }, {'fips': 1, 'case_number': 1, 'content_hash': 1}):
+            stored_hashes[(stored['fips'], stored['case_number'])] = \
+                stored.get('content_hash')
+
+        operations = []
+        for case in cases:
+            key = {
+                'fips': case['fips'],
+                'case_number': case['case_number']
+            }
+            if stored_hashes.get((case['fips'], case['case_number'])) == case['content_hash']:
+                operations.append(UpdateOne(key, {'$set': {
+                    'details_fetched_for_hearing_date': case['details_fetched_for_hearing_date'],
+                    'collected': case['collected']
+                }}))
+            else:
+                operations.append(ReplaceOne(key, case, upsert=True))
+        collection.bulk_write(operations, ordered=False)
 
     def get_cases_by_hearing_date(self, start, end):
         return self.client[self.court_type + '_court_detailed_cases'].find({
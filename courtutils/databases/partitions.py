@@ -0,0 +1,196 @@
+"""Yearly range partitioning for the case tables and their child tables.
+
+In a partitioned schema each case table and each of its child tables
+(hearings, services, pleadings, reports and parties) is a PostgreSQL
+declarative partitioned table, split by year of
+details_fetched_for_hearing_date, with one partition per year named
+"<table>_<year>" and a "<table>_default" partition for anything else. The
+exporter's yearly downloads and the collector's lookups then only touch
+one year's partitions, and an old year can be vacuumed, detached and
+archived on its own.
+
+Partitioned tables can't have the foreign keys the flat tables use to
+cascade deletes, so PostgresDatabase deletes child rows itself when the
+case tables are partitioned. Child rows carry a copy of the case's
+details_fetched_for_hearing_date to be partitioned by.
+
+Needs PostgreSQL 11 or later. See court_partition_tables.py for the
+command line tool that creates and migrates the tables.
+"""
+import logging
+from datetime import date
+from sqlalchemy import text
+from courtutils.databases.postgres import (CASE_TABLES, get_child_tables,
+                                          get_partitioned_tables, get_table_columns)
+
+log = logging.getLogger('logentries')
+
+PARTITION_COLUMN = 'details_fetched_for_hearing_date'
+
+def get_partitionable_tables():
+    """Case tables with their child tables after them."""
+    tables = []
+    for case_builder in CASE_TABLES:
+        tables.append(case_builder.__table__) #pylint: disable=E1101
+        tables.extend(child.__table__ for child in get_child_tables(case_builder))
+    return tables
+
+def partition_name(table_name, year):
+    return '{}_{}'.format(table_name, year)
+
+def default_partition_name(table_name):
+    return table_name + '_default'
+
+def year_bounds(year):
+    return date(year, 1, 1), date(year + 1, 1, 1)
+
+def create_partitioned_table(connection, table):
+    """Create table, a model's Table, as a table partitioned by year with
+    only a default partition."""
+    table_name = table.name
+    columns = []
+    for column in table.columns:
+        if column.primary_key:
+            column_type = 'BIGSERIAL'
+        else:
+            column_type = column.type.compile(dialect=connection.dialect)
+        if column.name == PARTITION_COLUMN:
+            column_type += ' NOT NULL'
+        columns.append('"{}" {}'.format(column.name, column_type))
+    # the partition key has to be part of the primary key
+    columns.append('PRIMARY KEY ("id", "{}")'.format(PARTITION_COLUMN))
+    connection.execute('CREATE TABLE "{}" ({}) PARTITION BY RANGE ("{}")'.format(
+        table_name, ', '.join(columns), PARTITION_COLUMN))
+    connection.execute('CREATE TABLE "{}" PARTITION OF "{}" DEFAULT'.format(
+        default_partition_name(table_name), table_name))
+    create_partition_indexes(connection, table)
+
+def create_partition_indexes(connection, table):
+    # Indexes on a partitioned table are created on every partition,
+    # including ones added later
+    for index in table.indexes:
+        index.create(connection)
+
+def add_year_partition(connection, table_name, year):
+    """Add the partition for year, moving that year's rows out of the
+    default partition. Returns False if the partition already exists."""
+    name = partition_name(table_name, year)
+    if len(get_table_columns(connection, name)) > 0:
+        return False
+    start, end = year_bounds(year)
+    # A partition can't be added while the default partition holds rows
+    # that belong in it, so it's filled first and then attached
+    connection.execute('CREATE TABLE "{}" (LIKE "{}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+        name, table_name))
+    connection.execute(text('''
+        WITH moved AS (
+            DELETE FROM "{default}"
+            WHERE "{column}" >= :start AND "{column}" < :end
+            RETURNING *
+        )
+        INSERT INTO "{partition}" SELECT * FROM moved
+    '''.format(default=default_partition_name(table_name), column=PARTITION_COLUMN,
+               partition=name)), start=start, end=end)
+    connection.execute(text(
+        'ALTER TABLE "{}" ATTACH PARTITION "{}" FOR VALUES FROM (:start) TO (:end)'.format(
+            table_name, name)), start=start, end=end)
+    return True
+
+def add_year_partitions(engine, years):
+    """Add partitions for years to every partitioned case and child table."""
+    with engine.begin() as connection:
+        partitioned = get_partitioned_tables(connection)
+        for table in get_partitionable_tables():
+            if table.name not in partitioned:
+                continue
+            for year in years:
+                if add_year_partition(connection, table.name, year):
+                    log.info('Added partition %s', partition_name(table.name, year))
+
+def detach_year_partitions(engine, year):
+    """Detach the partitions for year from every partitioned table. They are
+    left as ordinary tables, to be archived and dropped."""
+    with engine.begin() as connection:
+        partitioned = get_partitioned_tables(connection)
+        for table in get_partitionable_tables():
+            name = partition_name(table.name, year)
+            if table.name not in partitioned or len(get_table_columns(connection, name)) == 0:
+                continue
+            connection.execute('ALTER TABLE "{}" DETACH PARTITION "{}"'.format(table.name, name))
+            log.info('Detached partition %s', name)
+
+def create_partitioned_tables(engine, years):
+    """Create the case and child tables partitioned, for a new database.
+    Run before anything else creates them as flat tables."""
+    with engine.begin() as connection:
+        for table in get_partitionable_tables():
+            if len(get_table_columns(connection, table.name)) > 0:
+                raise RuntimeError('{} already exists'.format(table.name))
+            create_partitioned_table(connection, table)
+            for year in years:
+                add_year_partition(connection, table.name, year)
+            log.info('Created %s', table.name)
+
+def migrate_flat_tables(engine, drop_flat=False):
+    """Copy the flat case and child tables into partitioned tables of the
+    same names, in one transaction. The flat tables are kept, renamed with
+    a _flat suffix, unless drop_flat is set."""
+    with engine.begin() as connection:
+        partitioned = get_partitioned_tables(connection)
+        for case_builder in CASE_TABLES:
+            case_table = case_builder.__table__ #pylint: disable=E1101
+            if case_table.name in partitioned:
+                log.info('%s is already partitioned', case_table.name)
+                continue
+            migrate_case_table(connection, case_table,
+                               [child.__table__ for child in get_child_tables(case_builder)])
+        if drop_flat:
+            for table in reversed(get_partitionable_tables()):
+                connection.execute('DROP TABLE IF EXISTS "{}_flat"'.format(table.name))
+
+def migrate_case_table(connection, case_table, child_tables):
+    case_name = case_table.name
+    missing_dates = connection.execute(
+        'SELECT count(*) FROM "{}" WHERE "{}" IS NULL'.format(case_name, PARTITION_COLUMN)).scalar()
+    if missing_dates > 0:
+        raise RuntimeError('{} has {} cases without a {}; fix or delete them first'.format(
+            case_name, missing_dates, PARTITION_COLUMN))
+    years = [int(row[0]) for row in connection.execute(
+        'SELECT DISTINCT extract(year FROM "{}") FROM "{}"'.format(PARTITION_COLUMN, case_name))]
+
+    for table in [case_table] + child_tables:
+        connection.execute('ALTER TABLE "{0}" RENAME TO "{0}_flat"'.format(table.name))
+        # index names are per schema, so the flat table's have to make way
+        for index in table.indexes:
+            connection.execute('ALTER INDEX IF EXISTS "{0}" RENAME TO "{0}_flat"'.format(index.name))
+        create_partitioned_table(connection, table)
+        for year in sorted(years):
+            add_year_partition(connection, table.name, year)
+
+    case_columns = [column for column in get_table_columns(connection, case_name + '_flat')
+                    if column in case_table.columns]
+    connection.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM "{0}_flat"'.format(
+        case_name, ', '.join('"{}"'.format(column) for column in case_columns)))
+    log.info('Copied %s', case_name)
+
+    for child_table in child_tables:
+        # child rows get their case's date, and rows whose case is gone
+        # (there shouldn't be any, the foreign keys cascade) are dropped
+        child_columns = [column for column in get_table_columns(connection, child_table.name + '_flat')
+                         if column in child_table.columns and column != PARTITION_COLUMN]
+        connection.execute('''
+            INSERT INTO "{child}" ({columns}, "{date}")
+            SELECT {child_columns}, c."{date}"
+            FROM "{child}_flat" t JOIN "{case}_flat" c ON t.case_id = c.id
+        '''.format(
+            child=child_table.name, case=case_name, date=PARTITION_COLUMN,
+            columns=', '.join('"{}"'.format(column) for column in child_columns),
+            child_columns=', '.join('t."{}"'.format(column) for column in child_columns)))
+        log.info('Copied %s', child_table.name)
+
+    # new ids carry on from the copied ones
+    for table in [case_table] + child_tables:
+        connection.execute('''
+            SELECT setval(pg_get_serial_sequence('"{0}"', 'id'),
+                          GREATEST((SELECT max(id) FROM "{0}"), 1))
+        '''.format(table.name))
@@ -1,17 +1,41 @@
 import os
-from datetime import datetime, date
-from sqlalchemy import (create_engine, Boolean, Column,
+import json
+from datetime import datetime, date, timedelta
+from sqlalchemy import (create_engine, inspect, text, Boolean, Column,
                         Date, DateTime, Integer, BigInteger,
-                        Float, String, ForeignKey, Index)
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.declarative import declarative_base
+                        Float, String, Text, ForeignKey, Index)
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.pool import NullPool
 from geoalchemy2 import Geometry
 from pprint import pprint
+from courtreader.records import content_hash
+from courtutils import metrics, tracing
+from courtutils.tasks import is_search_fresh
+
+QUERY_SECONDS = metrics.histogram(
+    'db_query_seconds', 'Time spent in database calls', ['backend', 'operation'])
+
+def timed(method):
+    return metrics.timed(QUERY_SECONDS, backend='postgres', operation=method.__name__)(method)
+
+CASE_WRITES = metrics.counter(
+    'db_case_writes_total',
+    'Cases stored, by whether they had changed since they were last stored',
+    ['backend', 'result'])
 
 Base = declarative_base()
 
+def table_indexes(cls):
+    # Mixins list the indexes their tables need as (name, columns) in
+    # `indexes`, or (name, columns, operator classes by column); they're
+    # named after the table, since names are per schema
+    return tuple(
+        Index('{}_{}_idx'.format(cls.__tablename__, index[0]), *index[1],
+              postgresql_ops=index[2] if len(index) > 2 else {})
+        for index in cls.indexes
+    )
+
 class Court():
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -31,6 +55,16 @@ class DateTask():
     startdate = Column(Date)
     enddate = Column(Date)
     casetype = Column(String)
+    # Tasks run from startdate back to enddate. On an active task this is
+    # the last date the worker finished, so only the dates after it are
+    # left to search and can be split off to an idle worker.
+    progressdate = Column(Date)
+    # Where the worker is in the date after progressdate: the date, and the
+    # case numbers from its search results that are done, as a JSON list.
+    # A task put back part way through a date keeps these, so the worker
+    # that picks it up carries on from the same case.
+    cursordate = Column(Date)
+    cursorcases = Column(Text)
 
 class CircuitCourtDateTask(Base, DateTask):
     __tablename__ = 'circuit_court_date_tasks'
@@ -51,12 +85,29 @@ class CircuitCourtActiveDateTask(Base, DateTask):
 class DistrictCourtActiveDateTask(Base, DateTask):
     __tablename__ = 'district_court_active_date_tasks'
 
+# Active tasks used to be unique per court. A split task has several workers
+# on the same court, each with its own part of the date range.
+Index('circuit_court_active_date_tasks_fips_casetype_idx',
+      CircuitCourtActiveDateTask.__table__.c.fips,
+      CircuitCourtActiveDateTask.__table__.c.casetype)
+Index('district_court_active_date_tasks_fips_casetype_idx',
+      DistrictCourtActiveDateTask.__table__.c.fips,
+      DistrictCourtActiveDateTask.__table__.c.casetype)
+
+# Don't split off less than this many days of an active task
+MIN_SPLIT_DAYS = 14
+
 
 class DateSearch():
     id = Column(Integer, primary_key=True)
     fips = Column(Integer)
     date = Column(Date)
     casetype = Column(String)
+    searched = Column(DateTime)
+
+    # get_date_search
+    indexes = [('fips_date_casetype', ['fips', 'date', 'casetype'])]
+    __table_args__ = declared_attr(table_indexes)
 
 class CircuitCourtDateSearch(Base, DateSearch):
     __tablename__ = 'circuit_court_dates_searched'
@@ -65,6 +116,33 @@ class DistrictCourtDateSearch(Base, DateSearch):
     __tablename__ = 'district_court_dates_searched'
 
 
+class HearingDateSearchCache():
+    id = Column(Integer, primary_key=True)
+    fips = Column(Integer)
+    date = Column(Date)
+    casetype = Column(String)
+    fetched = Column(DateTime)
+    # the search results as a JSON list
+    results = Column(Text)
+
+class CircuitCourtHearingDateSearchCache(Base, HearingDateSearchCache):
+    __tablename__ = 'circuit_court_hearing_date_search_cache'
+
+class DistrictCourtHearingDateSearchCache(Base, HearingDateSearchCache):
+    __tablename__ = 'district_court_hearing_date_search_cache'
+
+Index('circuit_court_hearing_date_search_cache_idx',
+      CircuitCourtHearingDateSearchCache.__table__.c.fips,
+      CircuitCourtHearingDateSearchCache.__table__.c.casetype,
+      CircuitCourtHearingDateSearchCache.__table__.c.date,
+      unique=True)
+Index('district_court_hearing_date_search_cache_idx',
+      DistrictCourtHearingDateSearchCache.__table__.c.fips,
+      DistrictCourtHearingDateSearchCache.__table__.c.casetype,
+      DistrictCourtHearingDateSearchCache.__table__.c.date,
+      unique=True)
+
+
 CIRCUIT_CRIMINAL = 'CircuitCriminal'
 CIRCUIT_CIVIL = 'CircuitCivil'
 DISTRICT_CRIMINAL = 'DistrictCriminal'
@@ -79,10 +157,20 @@ class Case():
     details_fetched_for_hearing_date = Column(Date)
     collected = Column(Date)
     CaseNumber = Column(String)
+    # content_hash of the parsed details when they were stored
+    content_hash = Column(String)
+
+    # get_more_recent_case_details and replace_case_details
+    indexes = [('fips_casenumber', ['fips', 'CaseNumber', 'details_fetched_for_hearing_date'])]
+    __table_args__ = declared_attr(table_indexes)
 
 class CircuitCriminalCase(Base, Case):
     prefix = CIRCUIT_CRIMINAL
     __tablename__ = prefix + 'Case'
+    # list_people_to_id; its name prefix match can only use an index under
+    # a non-C collation with the pattern operator class
+    indexes = Case.indexes + [('dob_sex_defendant', ['DOB', 'Sex', 'Defendant'],
+                               {'Defendant': 'varchar_pattern_ops'})]
     Hearings = relationship(prefix + 'Hearing')
     Pleadings = relationship(prefix + 'Pleading')
     Services = relationship(prefix + 'Service')
@@ -256,6 +344,9 @@ class CircuitCivilCase(Base, Case):
 class DistrictCriminalCase(Base, Case):
     prefix = DISTRICT_CRIMINAL
     __tablename__ = prefix + 'Case'
+    # list_people_to_id, see CircuitCriminalCase
+    indexes = Case.indexes + [('dob_gender_name', ['DOB', 'Gender', 'Name'],
+                               {'Name': 'varchar_pattern_ops'})]
     Hearings = relationship(prefix + 'Hearing')
     Services = relationship(prefix + 'Service')
 
@@ -422,6 +513,12 @@ class DistrictCivilCase(Base, Case):
 #
 class Hearing():
     id = Column(BigInteger, primary_key=True)
+    # copied from the case, so child tables can be partitioned by year too
+    details_fetched_for_hearing_date = Column(Date)
+
+    # loading and deleting a case's rows, and the exporter's joins
+    indexes = [('case_id', ['case_id'])]
+    __table_args__ = declared_attr(table_indexes)
     Date = Column(DateTime)
     Result = Column(String)
 
@@ -465,6 +562,12 @@ class DistrictCivilHearing(Base, Hearing):
 #
 class Pleading():
     id = Column(BigInteger, primary_key=True)
+    # copied from the case, so child tables can be partitioned by year too
+    details_fetched_for_hearing_date = Column(Date)
+
+    # loading and deleting a case's rows, and the exporter's joins
+    indexes = [('case_id', ['case_id'])]
+    __table_args__ = declared_attr(table_indexes)
     Filed = Column(Date)
     Type = Column(String)
     Party = Column(String)
@@ -488,6 +591,12 @@ class CircuitCivilPleading(Base, Pleading):
 #
 class Service():
     id = Column(BigInteger, primary_key=True)
+    # copied from the case, so child tables can be partitioned by year too
+    details_fetched_for_hearing_date = Column(Date)
+
+    # loading and deleting a case's rows, and the exporter's joins
+    indexes = [('case_id', ['case_id'])]
+    __table_args__ = declared_attr(table_indexes)
     HowServed = Column(String)
 
 class CircuitCriminalService(Base, Service):
@@ -533,6 +642,12 @@ class DistrictCivilService(Base, Service):
 #
 class Report():
     id = Column(BigInteger, primary_key=True)
+    # copied from the case, so child tables can be partitioned by year too
+    details_fetched_for_hearing_date = Column(Date)
+
+    # loading and deleting a case's rows, and the exporter's joins
+    indexes = [('case_id', ['case_id'])]
+    __table_args__ = declared_attr(table_indexes)
     ReportType = Column(String)
     ReportingAgency = Column(String)
     DateOrdered = Column(Date)
@@ -549,6 +664,12 @@ class DistrictCivilReport(Base, Report):
 #
 class CircuitCivilParty():
     id = Column(BigInteger, primary_key=True)
+    # copied from the case, so child tables can be partitioned by year too
+    details_fetched_for_hearing_date = Column(Date)
+
+    # loading and deleting a case's rows, and the exporter's joins
+    indexes = [('case_id', ['case_id'])]
+    __table_args__ = declared_attr(table_indexes)
     Name = Column(String)
     TradingAs = Column(String)
     Attorney = Column(String)
@@ -565,6 +686,12 @@ class CircuitCivilDefendant(Base, CircuitCivilParty):
 
 class DistrictCivilParty():
     id = Column(BigInteger, primary_key=True)
+    # copied from the case, so child tables can be partitioned by year too
+    details_fetched_for_hearing_date = Column(Date)
+
+    # loading and deleting a case's rows, and the exporter's joins
+    indexes = [('case_id', ['case_id'])]
+    __table_args__ = declared_attr(table_indexes)
     Name = Column(String)
     DBATA = Column(String)
     Address = Column(String)
@@ -596,6 +723,8 @@ TABLES = [
     # Searches
     CircuitCourtDateSearch,
     DistrictCourtDateSearch,
+    CircuitCourtHearingDateSearchCache,
+    DistrictCourtHearingDateSearchCache,
 
     # Cases
     CircuitCriminalCase,
@@ -627,25 +756,65 @@ TABLES = [
     CircuitCivilDefendant
 ]
 
+CASE_TABLES = [
+    CircuitCriminalCase,
+    CircuitCivilCase,
+    DistrictCriminalCase,
+    DistrictCivilCase
+]
+
+def get_child_tables(case_builder):
+    return [prop.mapper.class_
+            for prop in case_builder.__mapper__.relationships] #pylint: disable=E1101
+
+def create_postgres_engine():
+    return create_engine("postgresql://" + os.environ['POSTGRES_DB'], poolclass=NullPool)
+
+def get_table_columns(connectable, table_name):
+    # information_schema rather than the inspector, which doesn't see
+    # partitioned tables
+    return [row[0] for row in connectable.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table_name
+        ORDER BY ordinal_position
+    """), table_name=table_name)]
+
+def get_index_names(connectable, table_name):
+    return set(row[0] for row in connectable.execute(text("""
+        SELECT indexname FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = :table_name
+    """), table_name=table_name))
+
+def get_missing_indexes(connectable):
+    """Indexes declared on the models that a database created before they
+    were added doesn't have."""
+    missing = []
+    for table in TABLES:
+        table = table.__table__ #pylint: disable=E1101
+        existing = get_index_names(connectable, table.name)
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+def get_partitioned_tables(connectable):
+    return set(row[0] for row in connectable.execute(
+        "SELECT relname FROM pg_class WHERE relkind = 'p'"))
+
 #
 # Database class
 #
+
+# Tables are created and migrated once per process, not per connection
+SCHEMA_READY = False
+
+# Tables partitioned by year (see courtutils.databases.partitions)
+PARTITIONED_TABLES = set()
+
 class PostgresDatabase():
     def __init__(self, court_type):
-        self.engine = create_engine("postgresql://" + os.environ['POSTGRES_DB'], poolclass=NullPool)
+        self.engine = create_postgres_engine()
         self.session = sessionmaker(bind=self.engine)()
 
-        Index('circuit_court_active_date_tasks_fips_casetype_idx',
-              CircuitCourtActiveDateTask.__table__.c.fips,
-              CircuitCourtActiveDateTask.__table__.c.casetype,
-              unique=True)
-        Index('district_court_active_date_tasks_fips_casetype_idx',
-              DistrictCourtActiveDateTask.__table__.c.fips,
-              DistrictCourtActiveDateTask.__table__.c.casetype,
-              unique=True)
-
-        for table in TABLES:
-            table.__table__.create(self.engine, checkfirst=True) #pylint: disable=E1101
+        self.create_tables()
 
         self.court_type = court_type
         if court_type == 'circuit':
@@ -653,11 +822,49 @@ class PostgresDatabase():
             self.date_task_builder = CircuitCourtDateTask
             self.active_date_task_builder = CircuitCourtActiveDateTask
             self.date_search_builder = CircuitCourtDateSearch
+            self.search_cache_builder = CircuitCourtHearingDateSearchCache
         else:
             self.court_builder = DistrictCourt
             self.date_task_builder = DistrictCourtDateTask
             self.active_date_task_builder = DistrictCourtActiveDateTask
             self.date_search_builder = DistrictCourtDateSearch
+            self.search_cache_builder = DistrictCourtHearingDateSearchCache
+
+    def create_tables(self):
+        global SCHEMA_READY
+        if SCHEMA_READY:
+            return
+        for table in TABLES:
+            table.__table__.create(self.engine, checkfirst=True) #pylint: disable=E1101
+        self.add_missing_columns()
+        self.drop_unique_active_task_indexes()
+        PARTITIONED_TABLES.update(get_partitioned_tables(self.engine))
+        SCHEMA_READY = True
+
+    def add_missing_columns(self):
+        # create(checkfirst=True) skips tables that already exist, so columns
+        # added to the models since a database was created are added here
+        for table in TABLES:
+            table = table.__table__ #pylint: disable=E1101
+            existing = set(get_table_columns(self.engine, table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                self.engine.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                    table.name, column.name,
+                    column.type.compile(dialect=self.engine.dialect)))
+
+    def drop_unique_active_task_indexes(self):
+        inspector = inspect(self.engine)
+        for builder in [CircuitCourtActiveDateTask, DistrictCourtActiveDateTask]:
+            table = builder.__table__ #pylint: disable=E1101
+            for index in inspector.get_indexes(table.name):
+                if not index['unique']:
+                    continue
+                self.engine.execute('DROP INDEX IF EXISTS "{}"'.format(index['name']))
+                for declared in table.indexes:
+                    if declared.name == index['name']:
+                        declared.create(self.engine)
 
     def commit(self):
         self.session.commit()
@@ -688,97 +895,333 @@ class PostgresDatabase():
         return self.session.query(self.court_builder).count()
 
     def add_date_tasks(self, tasks):
-        for task in tasks:
-            self.session.add(
-                self.date_task_builder(
-                    fips=int(task['fips']),
-                    startdate=task['start_date'],
-                    enddate=task['end_date'],
-                    casetype=task['case_type']
-                )
-            )
+        if len(tasks) == 0:
+            return
+        # one multi-row INSERT rather than a statement per task
+        self.session.execute(self.date_task_builder.__table__.insert().values([{
+            'fips': int(task['fips']),
+            'startdate': task['start_date'],
+            'enddate': task['end_date'],
+            'casetype': task['case_type']
+        } for task in tasks]))
         self.session.commit()
 
+    def get_dates_searched(self, case_type, start_date, end_date):
+        """The dates from start_date back to end_date whose search is still
+        fresh, as a set of dates for each court's fips code."""
+        dates = {}
+        now = datetime.now()
+        rows = self.session.query(self.date_search_builder).filter(
+            self.date_search_builder.casetype == case_type,
+            self.date_search_builder.date <= start_date,
+            self.date_search_builder.date >= end_date
+        ).with_entities(
+            self.date_search_builder.fips,
+            self.date_search_builder.date,
+            self.date_search_builder.searched
+        )
+        for fips, searched_date, searched in rows:
+            if is_search_fresh(searched_date, searched, now):
+                dates.setdefault(fips, set()).add(searched_date)
+        return dates
+
+    def get_date_task_ranges(self, case_type, start_date, end_date):
+        """The (start, end) date ranges of queued tasks, and the parts of
+        active tasks still to search, that overlap start_date back to
+        end_date, as a list for each court's fips code."""
+        ranges = {}
+        rows = self.session.execute(text("""
+            SELECT fips, startdate, enddate FROM {queued}
+            WHERE casetype = :case_type AND startdate >= :end_date AND enddate <= :start_date
+            UNION ALL
+            SELECT fips, COALESCE(progressdate - 1, startdate), enddate FROM {active}
+            WHERE casetype = :case_type AND COALESCE(progressdate - 1, startdate) >= :end_date
+                AND enddate <= :start_date
+        """.format(
+            queued=self.date_task_builder.__tablename__,
+            active=self.active_date_task_builder.__tablename__
+        )), {'case_type': case_type, 'start_date': start_date, 'end_date': end_date})
+        for fips, task_start, task_end in rows:
+            ranges.setdefault(fips, []).append((task_start, task_end))
+        return ranges
+
     def add_date_task(self, task, stopping_work=False):
+        """Queue task. With stopping_work, task is what's left of an active
+        task, which is deleted in the same statement, and re-queued up to
+        the active task's current end date: another worker may have split
+        off the older dates since this one last read it."""
+        cursor = task.get('cursor')
+        if stopping_work:
+            self.session.execute(text("""
+                WITH task AS (
+                    DELETE FROM {active} WHERE id = :id RETURNING enddate
+                )
+                INSERT INTO {queued} (fips, startdate, enddate, casetype, cursordate, cursorcases)
+                SELECT :fips, :start_date, enddate, :case_type, :cursor_date, :cursor_cases
+                FROM task WHERE enddate <= :start_date
+                RETURNING id
+            """.format(
+                queued=self.date_task_builder.__tablename__,
+                active=self.active_date_task_builder.__tablename__
+            )), {
+                'id': task['id'],
+                'fips': int(task['fips']),
+                'start_date': task['start_date'],
+                'case_type': task['case_type'],
+                'cursor_date': None if cursor is None else cursor['date'],
+                'cursor_cases': None if cursor is None else json.dumps(cursor['cases'])
+            })
+            self.session.commit()
+            return
         self.session.add(
             self.date_task_builder(
                 fips=int(task['fips']),
                 startdate=task['start_date'],
                 enddate=task['end_date'],
-                casetype=task['case_type']
+                casetype=task['case_type'],
+                cursordate=None if cursor is None else cursor['date'],
+                cursorcases=None if cursor is None else json.dumps(cursor['cases'])
             )
         )
-        if stopping_work:
+        self.session.commit()
+
+    @timed
+    def get_and_delete_date_task(self, finished_task=None, fips=None, case_type=None,
+                                 exclude_fips=None):
+        """Claim the queued task with the latest start date, preferring one
+        for fips and case_type, the court the worker's session is already
+        on, so it doesn't have to change courts. Tasks for courts in
+        exclude_fips, whose sites are failing, are left for later.
+        """
+        if finished_task is not None:
             self.session \
                 .query(self.active_date_task_builder) \
-                .filter(
-                    self.active_date_task_builder.fips == int(task['fips']),
-                    self.active_date_task_builder.casetype == task['case_type']
-                ) \
+                .filter(self.active_date_task_builder.id == finished_task['id']) \
                 .delete()
+            self.session.commit()
+
+        # Moving the task from the queue to the active table is a single
+        # transaction, so a worker dying in between can't lose it. SKIP
+        # LOCKED lets concurrent workers each claim a different task.
+        row = self.session.execute(text("""
+            WITH task AS (
+                DELETE FROM {queued} WHERE id = (
+                    SELECT id FROM {queued}
+                    WHERE {exclusion}
+                    ORDER BY {affinity} startdate DESC
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING fips, startdate, enddate, casetype, cursordate, cursorcases
+            )
+            INSERT INTO {active} (fips, startdate, enddate, casetype, cursordate, cursorcases)
+            SELECT fips, startdate, enddate, casetype, cursordate, cursorcases FROM task
+            RETURNING id, fips, startdate, enddate, casetype, cursordate, cursorcases
+        """.format(
+            queued=self.date_task_builder.__tablename__,
+            active=self.active_date_task_builder.__tablename__,
+            affinity=self.task_affinity_order(fips, case_type),
+            exclusion=self.task_exclusion(exclude_fips)
+        )), dict(self.task_affinity_params(fips, case_type),
+                 **self.task_exclusion_params(exclude_fips))).first()
         self.session.commit()
+        if row is None:
+            return None
+        return self.build_date_task(row)
+
+    @timed
+    def split_active_date_task(self, fips=None, case_type=None, min_days=MIN_SPLIT_DAYS,
+                               exclude_fips=None):
+        """Claim the second half of the unsearched range of the active task
+        with the most dates left, for a worker that has nothing else to do.
+        Tasks on the worker's current court are split first. The task's own
+        worker picks up its new end date at its next checkpoint.
+        """
+        # dates still to search run from the day before progressdate (or
+        # from startdate if nothing is finished yet) back to enddate
+        row = self.session.execute(text("""
+            SELECT id, fips, startdate, enddate, casetype, progressdate
+            FROM {active}
+            WHERE COALESCE(progressdate - 1, startdate) - enddate >= :min_days
+                AND {exclusion}
+            ORDER BY {affinity} COALESCE(progressdate - 1, startdate) - enddate DESC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """.format(
+            active=self.active_date_task_builder.__tablename__,
+            affinity=self.task_affinity_order(fips, case_type),
+            exclusion=self.task_exclusion(exclude_fips)
+        )), dict(self.task_affinity_params(fips, case_type), min_days=min_days,
+                 **self.task_exclusion_params(exclude_fips))).first()
+        if row is None:
+            self.session.commit()
+            return None
 
-    def get_and_delete_date_task(self, finished_task=None):
-        while True:
-            try:
-                if finished_task is not None:
-                    self.session \
-                        .query(self.active_date_task_builder) \
-                        .filter(
-                            self.active_date_task_builder.fips == int(finished_task['fips']),
-                            self.active_date_task_builder.casetype == finished_task['case_type']
-                        ) \
-                        .delete()
-                    self.session.commit()
-
-                task = self.session \
-                           .query(self.date_task_builder) \
-                           .order_by(self.date_task_builder.startdate.desc()) \
-                           .first()
-                if task is None:
-                    return None
-                self.session.delete(task)
-                self.session.commit()
+        next_date = row.startdate
+        if row.progressdate is not None:
+            next_date = row.progressdate - timedelta(days=1)
+        days_left = (next_date - row.enddate).days + 1
+        kept_end_date = next_date - timedelta(days=(days_left + 1) / 2 - 1)
+
+        self.session \
+            .query(self.active_date_task_builder) \
+            .filter(self.active_date_task_builder.id == row.id) \
+            .update({'enddate': kept_end_date}, synchronize_session=False)
+        task = self.active_date_task_builder(
+            fips=row.fips,
+            startdate=kept_end_date - timedelta(days=1),
+            enddate=row.enddate,
+            casetype=row.casetype
+        )
+        self.session.add(task)
+        self.session.commit()
+        return self.build_date_task(task)
+
+    def task_affinity_order(self, fips, case_type):
+        if fips is None:
+            return ''
+        return '(fips = :fips AND casetype = :case_type) DESC,'
+
+    def task_affinity_params(self, fips, case_type):
+        if fips is None:
+            return {}
+        return {'fips': int(fips), 'case_type': case_type}
+
+    def task_exclusion(self, exclude_fips):
+        if not exclude_fips:
+            return 'TRUE'
+        return 'fips NOT IN :exclude_fips'
+
+    def task_exclusion_params(self, exclude_fips):
+        if not exclude_fips:
+            return {}
+        return {'exclude_fips': tuple(int(fips) for fips in exclude_fips)}
+
+    @timed
+    def update_date_task_progress(self, task, date):
+        """Record that an active task has finished searching date, and return
+        the end date it should now stop at, which moves up if part of the
+        task has been split off.
+        """
+        row = self.session.execute(text("""
+            UPDATE {active}
+            SET progressdate = :date, cursordate = NULL, cursorcases = NULL
+            WHERE id = :id
+            RETURNING enddate
+        """.format(active=self.active_date_task_builder.__tablename__)),
+        {'date': date, 'id': task['id']}).first()
+        self.session.commit()
+        if row is None:
+            return task['end_date']
+        return row.enddate
+
+    @timed
+    def update_date_task_cursor(self, task, date, case_numbers, commit=True):
+        """Record the cases of date, the date an active task is working
+        on, that are done."""
+        self.session.execute(text("""
+            UPDATE {active} SET cursordate = :date, cursorcases = :cases
+            WHERE id = :id
+        """.format(active=self.active_date_task_builder.__tablename__)),
+        {'date': date, 'cases': json.dumps(case_numbers), 'id': task['id']})
+        if commit:
+            self.session.commit()
+
+    def build_date_task(self, task):
+        cursor = None
+        if task.cursordate is not None:
+            cursor = {
+                'date': task.cursordate,
+                'cases': json.loads(task.cursorcases or '[]')
+            }
+        return {
+            'id': task.id,
+            'fips': str(task.fips).zfill(3),
+            'start_date': task.startdate,
+            'end_date': task.enddate,
+            'case_type': task.casetype,
+            'cursor': cursor
+        }
 
-                self.session.add(
-                    self.active_date_task_builder(
-                        fips=task.fips,
-                        startdate=task.startdate,
-                        enddate=task.enddate,
-                        casetype=task.casetype
-                    )
+    @timed
+    @tracing.traced('db_store')
+    def add_date_search(self, search, commit=True):
+        # a date searched again once its search went stale keeps its row
+        updated = self.session.query(self.date_search_builder).filter_by(
+            fips=int(search['fips']),
+            date=search['date'],
+            casetype=search['case_type']
+        ).update({'searched': datetime.now()}, synchronize_session=False)
+        if updated == 0:
+            self.session.add(
+                self.date_search_builder(
+                    fips=int(search['fips']),
+                    date=search['date'],
+                    casetype=search['case_type'],
+                    searched=datetime.now()
                 )
-                self.session.commit()
-
-                return {
-                    'fips': str(task.fips).zfill(3),
-                    'start_date': task.startdate,
-                    'end_date': task.enddate,
-                    'case_type': task.casetype
-                }
-            except IntegrityError:
-                print 'WARNING - FAILED TO GET NEW TASK'
-                self.session.rollback()
-
-    def add_date_search(self, search):
-        self.session.add(
-            self.date_search_builder(
-                fips=int(search['fips']),
-                date=search['date'],
-                casetype=search['case_type']
             )
-        )
-        self.session.commit()
+        if commit:
+            self.session.commit()
 
+    @timed
+    @tracing.traced('db_lookup')
     def get_date_search(self, search):
-        result = self.session.query(self.date_search_builder).filter_by(
+        """Returns search if the date has been searched and the search is
+        still fresh, or None."""
+        rows = self.session.query(self.date_search_builder.searched).filter_by(
             fips=int(search['fips']),
             date=search['date'],
             casetype=search['case_type']
+        ).all()
+        if not any(is_search_fresh(search['date'], row.searched) for row in rows):
+            return None
+        return search
+
+    @timed
+    @tracing.traced('db_lookup')
+    def get_cached_search_results(self, fips, case_type, date, fetched_since):
+        """Return the hearing date search results cached for fips, case_type
+        and date, as a list of dicts, if they were fetched after
+        fetched_since, or None."""
+        result = self.session.query(self.search_cache_builder.results).filter(
+            self.search_cache_builder.fips == int(fips),
+            self.search_cache_builder.casetype == case_type,
+            self.search_cache_builder.date == date,
+            self.search_cache_builder.fetched >= fetched_since
         ).first()
         if result is None:
             return None
-        return search
+        return json.loads(result.results)
+
+    @timed
+    @tracing.traced('db_store')
+    def cache_search_results(self, fips, case_type, date, cases):
+        self.session.query(self.search_cache_builder).filter_by(
+            fips=int(fips),
+            casetype=case_type,
+            date=date
+        ).delete()
+        self.session.add(
+            self.search_cache_builder(
+                fips=int(fips),
+                casetype=case_type,
+                date=date,
+                fetched=datetime.now(),
+                results=json.dumps([dict(case.items()) for case in cases])
+            )
+        )
+        self.session.commit()
+
+    @timed
+    @tracing.traced('db_store')
+    def prune_search_cache(self, fetched_before):
+        """Delete cached search results fetched before fetched_before."""
+        deleted = self.session.query(self.search_cache_builder).filter(
+            self.search_cache_builder.fetched < fetched_before
+        ).delete()
+        self.session.commit()
+        return deleted
 
     def count_dates_searched_for_year(self, case_type, year):
         start_date = date(year, 1, 1)
@@ -801,6 +1244,8 @@ class PostgresDatabase():
             else:
                 return DistrictCivilCase
 
+    @timed
+    @tracing.traced('db_lookup')
     def get_more_recent_case_details(self, case, case_type, date):
         case_builder = self.get_case_builder(case_type)
         result = self.session.query(case_builder).filter(
@@ -814,15 +1259,88 @@ class PostgresDatabase():
             'details_fetched_for_hearing_date': result.details_fetched_for_hearing_date
         }
 
-    def replace_case_details(self, case, case_type):
-        #pprint(case)
+    @timed
+    @tracing.traced('db_lookup')
+    def get_more_recent_case_dates(self, fips, case_type, case_numbers, date):
+        """Which of case_numbers already have details collected for a
+        hearing on or after date, in one query, as a dict of case number to
+        the hearing date the details were collected for."""
+        dates = {}
+        if not case_numbers:
+            return dates
+        case_builder = self.get_case_builder(case_type)
+        rows = self.session.query(
+            case_builder.CaseNumber,
+            case_builder.details_fetched_for_hearing_date
+        ).filter(
+            case_builder.fips == int(fips),
+            case_builder.CaseNumber.in_(list(case_numbers)),
+            case_builder.details_fetched_for_hearing_date >= date
+        )
+        for case_number, hearing_date in rows:
+            dates[case_number] = hearing_date
+        return dates
+
+    @timed
+    @tracing.traced('db_store')
+    def replace_case_details(self, case, case_type, commit=True):
+        """Store case, replacing any earlier copy. With commit=False the
+        changes are left in the session's transaction, for the caller to
+        commit along with others (see courtutils.databases.writer)."""
         case_builder = self.get_case_builder(case_type)
-        self.session.query(case_builder).filter_by(
+        partitioned = case_builder.__tablename__ in PARTITIONED_TABLES
+        hearing_date = case['details_fetched_for_hearing_date']
+        # Hash before create(), which takes the child lists out of details
+        details_hash = content_hash(case['details'])
+
+        # Most cases collected again haven't changed; for those, just note
+        # when they were collected instead of rewriting them and their
+        # hearings, services and pleadings
+        unchanged = self.session.query(case_builder).filter_by(
+            fips=int(case['fips']),
+            CaseNumber=case['case_number'],
+            content_hash=details_hash
+        )
+        if partitioned:
+            # the child rows are in the partition for the year of the
+            # hearing date they were stored with, so a case moving to a
+            # new year is rewritten to move them along with it
+            unchanged = unchanged.filter(
+                case_builder.details_fetched_for_hearing_date >= date(hearing_date.year, 1, 1),
+                case_builder.details_fetched_for_hearing_date < date(hearing_date.year + 1, 1, 1))
+        unchanged = unchanged.update({
+            'details_fetched_for_hearing_date': hearing_date,
+            'collected': case['collected']
+        }, synchronize_session=False)
+        if unchanged > 0:
+            if commit:
+                self.session.commit()
+            CASE_WRITES.inc(backend='postgres', result='unchanged')
+            return
+
+        old_cases = self.session.query(case_builder).filter_by(
             fips=int(case['fips']),
             CaseNumber=case['case_number']
-        ).delete()
-        self.session.add(case_builder.create(case))
-        self.session.commit()
+        )
+        if partitioned:
+            # partitioned tables can't have foreign keys, so there's no
+            # cascade to delete the old case's child rows
+            old_case_ids = old_cases.with_entities(case_builder.id).subquery()
+            for child_builder in get_child_tables(case_builder):
+                self.session.query(child_builder).filter(
+                    child_builder.case_id.in_(old_case_ids)
+                ).delete(synchronize_session=False)
+        old_cases.delete(synchronize_session=False)
+
+        db_case = case_builder.create(case)
+        db_case.content_hash = details_hash
+        for prop in case_builder.__mapper__.relationships:
+            for child in getattr(db_case, prop.key):
+                child.details_fetched_for_hearing_date = hearing_date
+        self.session.add(db_case)
+        if commit:
+            self.session.commit()
+        CASE_WRITES.inc(backend='postgres', result='replaced')
 
     def list_people_to_id(self, date, letter, sex):
         people = []
@@ -0,0 +1,403 @@
+"""SQLite backend, for running collectors on one machine without a
+database server, e.g. to benchmark the collector pipeline.
+
+Implements the same methods the collectors and task creator use on
+PostgresDatabase, in one database file (SQLITE_DB, by default
+va_court_search.db) shared by every collector on the machine. Cases are
+stored whole as JSON documents, like in MongoDatabase, rather than in the
+Postgres tables' columns, so there's no exporting from here.
+
+The database is in WAL mode, so collectors can read while another writes.
+Write methods take commit=False, like PostgresDatabase's, so a
+write-behind writer can batch them into one transaction.
+"""
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from courtreader.records import content_hash, json_default
+from courtutils.tasks import is_search_fresh, to_date
+
+# Don't split off less than this many days of an active task
+MIN_SPLIT_DAYS = 14
+
+TABLES = [
+    '''CREATE TABLE IF NOT EXISTS {court}_courts (
+        fips TEXT PRIMARY KEY, name TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS {court}_court_date_tasks (
+        id INTEGER PRIMARY KEY, fips TEXT, startdate DATE, enddate DATE,
+        casetype TEXT, cursordate DATE, cursorcases TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS {court}_court_active_date_tasks (
+        id INTEGER PRIMARY KEY, fips TEXT, startdate DATE, enddate DATE,
+        casetype TEXT, progressdate DATE, cursordate DATE, cursorcases TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS {court}_court_dates_searched (
+        id INTEGER PRIMARY KEY, fips TEXT, date DATE, casetype TEXT,
+        searched TIMESTAMP)''',
+    '''CREATE INDEX IF NOT EXISTS {court}_court_dates_searched_idx
+        ON {court}_court_dates_searched (fips, date, casetype)''',
+    '''CREATE TABLE IF NOT EXISTS {court}_court_hearing_date_search_cache (
+        fips TEXT, casetype TEXT, date DATE, fetched TIMESTAMP, results TEXT,
+        PRIMARY KEY (fips, casetype, date))''',
+    '''CREATE TABLE IF NOT EXISTS {court}_court_cases (
+        fips TEXT, casetype TEXT, case_number TEXT,
+        details_fetched_for_hearing_date DATE, collected TIMESTAMP,
+        content_hash TEXT, document TEXT,
+        PRIMARY KEY (fips, casetype, case_number))'''
+]
+
+# Columns added to the tables above since they were first created, as
+# (table, column, type)
+NEW_COLUMNS = [
+    ('{court}_court_dates_searched', 'searched', 'TIMESTAMP')
+]
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=60,
+                                 detect_types=sqlite3.PARSE_DECLTYPES)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    # with WAL, a crash can only lose the last transactions, not corrupt
+    # the database
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+class SqliteDatabase():
+    def __init__(self, court_type, path=None):
+        if path is None:
+            path = os.environ.get('SQLITE_DB', 'va_court_search.db')
+        self.court_type = court_type
+        self.connection = connect(path)
+        for table in TABLES:
+            self.connection.execute(table.format(court=court_type))
+        self.add_missing_columns()
+        self.connection.commit()
+
+    def add_missing_columns(self):
+        for table, column, column_type in NEW_COLUMNS:
+            existing = [row['name'] for row in self.execute(
+                'PRAGMA table_info({})'.format(table))]
+            if column not in existing:
+                self.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, column, column_type))
+
+    def execute(self, query, params=()):
+        return self.connection.execute(query.format(court=self.court_type), params)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def disconnect(self):
+        self.connection.close()
+
+    def add_court(self, name, fips, location):
+        self.execute('INSERT OR REPLACE INTO {court}_courts (fips, name) VALUES (?, ?)',
+                     (str(fips).zfill(3), name))
+
+    def add_court_location_index(self):
+        pass
+
+    def drop_courts(self):
+        self.execute('DELETE FROM {court}_courts')
+        self.commit()
+
+    def get_courts(self):
+        return [{
+            'name': row['name'],
+            'fips': row['fips']
+        } for row in self.execute('SELECT fips, name FROM {court}_courts')]
+
+    def count_courts(self):
+        return self.execute('SELECT count(*) FROM {court}_courts').fetchone()[0]
+
+    def add_date_tasks(self, tasks):
+        self.connection.executemany('''
+            INSERT INTO {}_court_date_tasks (fips, startdate, enddate, casetype)
+            VALUES (?, ?, ?, ?)
+        '''.format(self.court_type), [(
+            str(task['fips']).zfill(3),
+            to_date(task['start_date']),
+            to_date(task['end_date']),
+            task['case_type']
+        ) for task in tasks])
+        self.commit()
+
+    def add_date_task(self, task, stopping_work=False):
+        """See PostgresDatabase.add_date_task."""
+        cursor = task.get('cursor')
+        end_date = task['end_date']
+        if stopping_work:
+            # hold the write lock from reading the end date on, so the task
+            # can't be split in between
+            self.commit()
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.execute('SELECT enddate FROM {court}_court_active_date_tasks WHERE id = ?',
+                               (task['id'],)).fetchone()
+            self.execute('DELETE FROM {court}_court_active_date_tasks WHERE id = ?',
+                         (task['id'],))
+            if row is None or row['enddate'] > to_date(task['start_date']):
+                self.commit()
+                return
+            end_date = row['enddate']
+        self.execute('''
+            INSERT INTO {court}_court_date_tasks
+                (fips, startdate, enddate, casetype, cursordate, cursorcases)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            task['fips'], task['start_date'], end_date, task['case_type'],
+            None if cursor is None else cursor['date'],
+            None if cursor is None else json.dumps(cursor['cases'])
+        ))
+        self.commit()
+
+    def get_and_delete_date_task(self, finished_task=None, fips=None, case_type=None,
+                                 exclude_fips=None):
+        if finished_task is not None:
+            self.execute('DELETE FROM {court}_court_active_date_tasks WHERE id = ?',
+                         (finished_task['id'],))
+            self.commit()
+
+        exclusion, exclude_fips = fips_exclusion(exclude_fips)
+        while True:
+            # other collectors may claim the same task between the SELECT and
+            # the DELETE; whoever deletes it has it
+            task = self.execute('''
+                SELECT * FROM {{court}}_court_date_tasks
+                WHERE {}
+                ORDER BY (fips = ? AND casetype = ?) DESC, startdate DESC
+                LIMIT 1
+            '''.format(exclusion), exclude_fips + [fips, case_type]).fetchone()
+            if task is None:
+                return None
+            deleted = self.execute('DELETE FROM {court}_court_date_tasks WHERE id = ?',
+                                   (task['id'],)).rowcount
+            if deleted == 0:
+                self.rollback()
+                continue
+            active_id = self.execute('''
+                INSERT INTO {court}_court_active_date_tasks
+                    (fips, startdate, enddate, casetype, cursordate, cursorcases)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (task['fips'], task['startdate'], task['enddate'], task['casetype'],
+                  task['cursordate'], task['cursorcases'])).lastrowid
+            self.commit()
+            return self.build_date_task(task, active_id)
+
+    def split_active_date_task(self, fips=None, case_type=None, min_days=MIN_SPLIT_DAYS,
+                               exclude_fips=None):
+        """Claim the second half of the unsearched range of the active task
+        with the most dates left. See PostgresDatabase.split_active_date_task."""
+        exclusion, exclude_fips = fips_exclusion(exclude_fips)
+        days_left = "julianday(COALESCE(date(progressdate, '-1 day'), startdate)) - julianday(enddate)"
+        # BEGIN IMMEDIATE holds the write lock from the SELECT on, so the
+        # task can't be split twice at once
+        self.commit()
+        self.connection.execute('BEGIN IMMEDIATE')
+        row = self.execute('''
+            SELECT * FROM {{court}}_court_active_date_tasks
+            WHERE {days_left} >= ? AND {exclusion}
+            ORDER BY (fips = ? AND casetype = ?) DESC, {days_left} DESC
+            LIMIT 1
+        '''.format(days_left=days_left, exclusion=exclusion),
+            [min_days] + exclude_fips + [fips, case_type]).fetchone()
+        if row is None:
+            self.commit()
+            return None
+
+        next_date = row['startdate']
+        if row['progressdate'] is not None:
+            next_date = row['progressdate'] - timedelta(days=1)
+        days = (next_date - row['enddate']).days + 1
+        kept_end_date = next_date - timedelta(days=(days + 1) / 2 - 1)
+        self.execute('UPDATE {court}_court_active_date_tasks SET enddate = ? WHERE id = ?',
+                     (kept_end_date, row['id']))
+        start_date = kept_end_date - timedelta(days=1)
+        active_id = self.execute('''
+            INSERT INTO {court}_court_active_date_tasks (fips, startdate, enddate, casetype)
+            VALUES (?, ?, ?, ?)
+        ''', (row['fips'], start_date, row['enddate'], row['casetype'])).lastrowid
+        self.commit()
+        return {
+            'id': active_id,
+            'fips': row['fips'],
+            'start_date': start_date,
+            'end_date': row['enddate'],
+            'case_type': row['casetype'],
+            'cursor': None
+        }
+
+    def update_date_task_progress(self, task, date):
+        self.execute('''
+            UPDATE {court}_court_active_date_tasks
+            SET progressdate = ?, cursordate = NULL, cursorcases = NULL
+            WHERE id = ?
+        ''', (date, task['id']))
+        row = self.execute('SELECT enddate FROM {court}_court_active_date_tasks WHERE id = ?',
+                           (task['id'],)).fetchone()
+        self.commit()
+        if row is None:
+            return task['end_date']
+        return row['enddate']
+
+    def update_date_task_cursor(self, task, date, case_numbers, commit=True):
+        self.execute('''
+            UPDATE {court}_court_active_date_tasks SET cursordate = ?, cursorcases = ?
+            WHERE id = ?
+        ''', (date, json.dumps(case_numbers), task['id']))
+        if commit:
+            self.commit()
+
+    def build_date_task(self, row, active_id):
+        cursor = None
+        if row['cursordate'] is not None:
+            cursor = {
+                'date': row['cursordate'],
+                'cases': json.loads(row['cursorcases'] or '[]')
+            }
+        return {
+            'id': active_id,
+            'fips': row['fips'],
+            'start_date': row['startdate'],
+            'end_date': row['enddate'],
+            'case_type': row['casetype'],
+            'cursor': cursor
+        }
+
+    def get_dates_searched(self, case_type, start_date, end_date):
+        dates = {}
+        now = datetime.now()
+        for row in self.execute('''
+            SELECT fips, date, searched FROM {court}_court_dates_searched
+            WHERE casetype = ? AND date <= ? AND date >= ?
+        ''', (case_type, to_date(start_date), to_date(end_date))):
+            if is_search_fresh(row['date'], row['searched'], now):
+                dates.setdefault(int(row['fips']), set()).add(row['date'])
+        return dates
+
+    def get_date_task_ranges(self, case_type, start_date, end_date):
+        ranges = {}
+        for row in self.execute('''
+            SELECT fips, startdate, enddate FROM {court}_court_date_tasks
+            WHERE casetype = ? AND startdate >= ? AND enddate <= ?
+            UNION ALL
+            SELECT fips, COALESCE(date(progressdate, '-1 day'), startdate), enddate
+            FROM {court}_court_active_date_tasks
+            WHERE casetype = ? AND COALESCE(date(progressdate, '-1 day'), startdate) >= ?
+                AND enddate <= ?
+        ''', (case_type, to_date(end_date), to_date(start_date)) * 2):
+            # COALESCE loses the column type, so dates can come back as text
+            ranges.setdefault(int(row[0]), []).append((parse_date(row[1]), parse_date(row[2])))
+        return ranges
+
+    def add_date_search(self, search, commit=True):
+        updated = self.execute('''
+            UPDATE {court}_court_dates_searched SET searched = ?
+            WHERE fips = ? AND date = ? AND casetype = ?
+        ''', (datetime.now(), search['fips'], search['date'], search['case_type'])).rowcount
+        if updated == 0:
+            self.execute('''
+                INSERT INTO {court}_court_dates_searched (fips, date, casetype, searched)
+                VALUES (?, ?, ?, ?)
+            ''', (search['fips'], search['date'], search['case_type'], datetime.now()))
+        if commit:
+            self.commit()
+
+    def get_date_search(self, search):
+        rows = self.execute('''
+            SELECT searched FROM {court}_court_dates_searched
+            WHERE fips = ? AND date = ? AND casetype = ?
+        ''', (search['fips'], search['date'], search['case_type']))
+        if not any(is_search_fresh(search['date'], row['searched']) for row in rows):
+            return None
+        return search
+
+    def get_cached_search_results(self, fips, case_type, date, fetched_since):
+        row = self.execute('''
+            SELECT results FROM {court}_court_hearing_date_search_cache
+            WHERE fips = ? AND casetype = ? AND date = ? AND fetched >= ?
+        ''', (fips, case_type, date, fetched_since)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row['results'])
+
+    def cache_search_results(self, fips, case_type, date, cases):
+        self.execute('''
+            INSERT OR REPLACE INTO {court}_court_hearing_date_search_cache
+                (fips, casetype, date, fetched, results)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (fips, case_type, date, datetime.now(),
+              json.dumps([dict(case.items()) for case in cases])))
+        self.commit()
+
+    def prune_search_cache(self, fetched_before):
+        deleted = self.execute('''
+            DELETE FROM {court}_court_hearing_date_search_cache WHERE fetched < ?
+        ''', (fetched_before,)).rowcount
+        self.commit()
+        return deleted
+
+    def get_more_recent_case_details(self, case, case_type, date):
+        row = self.execute('''
+            SELECT details_fetched_for_hearing_date FROM {court}_court_cases
+            WHERE fips = ? AND casetype = ? AND case_number = ?
+                AND details_fetched_for_hearing_date >= ?
+        ''', (case['fips'], case_type, case['case_number'], date)).fetchone()
+        if row is None:
+            return None
+        return {
+            'details_fetched_for_hearing_date': row['details_fetched_for_hearing_date']
+        }
+
+    def get_more_recent_case_dates(self, fips, case_type, case_numbers, date):
+        case_numbers = list(case_numbers)
+        dates = {}
+        # SQLite allows 999 parameters per statement
+        for start in range(0, len(case_numbers), 900):
+            chunk = case_numbers[start:start + 900]
+            for row in self.execute('''
+                SELECT case_number, details_fetched_for_hearing_date FROM {{court}}_court_cases
+                WHERE fips = ? AND casetype = ? AND details_fetched_for_hearing_date >= ?
+                    AND case_number IN ({})
+            '''.format(', '.join('?' * len(chunk))), [fips, case_type, date] + chunk):
+                dates[row['case_number']] = row['details_fetched_for_hearing_date']
+        return dates
+
+    def replace_case_details(self, case, case_type, commit=True):
+        details_hash = content_hash(case['details'])
+        unchanged = self.execute('''
+            UPDATE {court}_court_cases
+            SET details_fetched_for_hearing_date = ?, collected = ?
+            WHERE fips = ? AND casetype = ? AND case_number = ? AND content_hash = ?
+        ''', (case['details_fetched_for_hearing_date'], case['collected'],
+              case['fips'], case_type, case['case_number'], details_hash)).rowcount
+        if unchanged == 0:
+            self.execute('''
+                INSERT OR REPLACE INTO {court}_court_cases
+                    (fips, casetype, case_number, details_fetched_for_hearing_date,
+                     collected, content_hash, document)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (case['fips'], case_type, case['case_number'],
+                  case['details_fetched_for_hearing_date'], case['collected'],
+                  details_hash, json.dumps(dict(case.items()), default=json_default)))
+        if commit:
+            self.commit()
+
+    def get_cases_by_hearing_date(self, start, end):
+        return [json.loads(row['document']) for row in self.execute('''
+            SELECT document FROM {court}_court_cases
+            WHERE details_fetched_for_hearing_date >= ?
+                AND details_fetched_for_hearing_date < ?
+        ''', (start, end))]
+
+def fips_exclusion(exclude_fips):
+    exclude_fips = list(exclude_fips or [])
+    if not exclude_fips:
+        return '1', []
+    return 'fips NOT IN ({})'.format(', '.join('?' * len(exclude_fips))), exclude_fips
+
+def parse_date(value):
+    if isinstance(value, basestring):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
@@ -0,0 +1,158 @@
+"""Write-behind storage for collectors.
+
+WriteBehindWriter takes the collector's writes (case details, dates
+searched and task cursors) on a bounded queue and makes them on its own
+database connection in a background thread, so the collector can keep
+fetching while Postgres commits. Writes are grouped into transactions of
+up to batch_size writes, or whatever has arrived within batch_seconds of
+the first.
+
+Writes are made and committed in the order they were queued, and a failed
+transaction stops the writer, dropping everything queued after it. So a
+date queued as searched after its cases is never stored without them, and
+a task cursor never counts a case that wasn't stored. The error is raised
+in the collector at its next call to the writer.
+
+When the queue is full, calls wait for the writer to catch up. flush waits
+until everything queued so far is committed; close flushes and stops the
+thread.
+"""
+import logging
+import Queue
+import threading
+import time
+from courtutils import metrics, tracing
+
+log = logging.getLogger('logentries')
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'db_writer_queue_wait_seconds',
+    'Time spent waiting for room in the write-behind queue')
+BATCH_WRITES = metrics.histogram(
+    'db_writer_batch_writes', 'Writes per write-behind transaction',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500))
+
+class WriterError(Exception):
+    """Raised in the collector when the writer thread has failed."""
+    pass
+
+class Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+STOP = object()
+
+class WriteBehindWriter(object):
+    def __init__(self, connect, max_pending=500, batch_size=50, batch_seconds=2.0):
+        """connect is called once, in the writer thread, to open the
+        database connection to write with."""
+        self.connect = connect
+        self.queue = Queue.Queue(max_pending)
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='WriteBehindWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def replace_case_details(self, case, case_type):
+        self.put(('replace_case_details', (case, case_type)))
+
+    def add_date_search(self, search):
+        self.put(('add_date_search', (search,)))
+
+    def update_date_task_cursor(self, task, date, case_numbers):
+        self.put(('update_date_task_cursor', (task, date, list(case_numbers))))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def flush(self):
+        """Wait until everything queued so far is committed."""
+        flush = Flush()
+        self.put(flush)
+        while not flush.done.wait(1):
+            self.check()
+        self.check()
+
+    def close(self):
+        """Commit everything queued and stop the writer thread."""
+        if self.thread.is_alive():
+            self.put(STOP)
+            self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise WriterError('Write-behind writer failed: {}'.format(self.error))
+
+    def put(self, item):
+        with tracing.span('db_store'), QUEUE_WAIT_SECONDS.time():
+            while True:
+                self.check()
+                try:
+                    self.queue.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+    def run(self):
+        db = None
+        try:
+            db = self.connect()
+            stopping = False
+            while not stopping:
+                stopping = self.write_batch(db)
+        except Exception, err:
+            log.exception('Write-behind writer failed')
+            self.error = err
+            if db is not None:
+                try:
+                    db.rollback()
+                except Exception:
+                    pass
+            # let anything waiting on a flush find out
+            self.discard_pending()
+        finally:
+            if db is not None:
+                db.disconnect()
+
+    def write_batch(self, db):
+        """Write and commit one transaction's worth of queued writes.
+        Returns True when the writer should stop."""
+        item = self.queue.get()
+        writes = 0
+        flushes = []
+        stopping = False
+        deadline = time.time() + self.batch_seconds
+        while True:
+            if item is STOP:
+                stopping = True
+                break
+            if isinstance(item, Flush):
+                flushes.append(item)
+                break
+            method, args = item
+            getattr(db, method)(*args, commit=False)
+            writes += 1
+            if writes >= self.batch_size:
+                break
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                break
+        if writes > 0:
+            db.commit()
+            BATCH_WRITES.observe(writes)
+        for flush in flushes:
+            flush.done.set()
+        return stopping
+
+    def discard_pending(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if isinstance(item, Flush):
+                item.done.set()
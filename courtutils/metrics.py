@@ -0,0 +1,223 @@
+"""In-process metrics for the collectors.
+
+Counters and histograms are registered by name at module level by the code
+that updates them, e.g.
+
+    REQUEST_SECONDS = metrics.histogram(
+        'court_request_seconds', 'Time to get a response', ['court', 'endpoint'])
+    ...
+    with REQUEST_SECONDS.time(court='district', endpoint='caseSearch.do'):
+        ...
+
+and rendered in the Prometheus text format, either from a local HTTP
+/metrics endpoint (start_http_server) or to a file that is rewritten every
+so often (start_file_writer). Metrics are kept per process.
+"""
+import BaseHTTPServer
+import os
+import threading
+import time
+
+# Request and query latencies run from tens of milliseconds to the better
+# part of a minute when the courts' sites are struggling
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, escape_label_value(value))
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def label_values(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError('{} takes labels {}, got {}'.format(
+                self.name, self.label_names, sorted(labels.keys())))
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.kind)
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_value(self, label_values, value):
+        return ['{}{} {}'.format(self.name,
+                                 format_labels(self.label_names, label_values),
+                                 format_value(value))]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then sum and count
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, **labels):
+        """Context manager that observes how long its block took."""
+        return Timer(self, labels)
+
+    def render_value(self, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                format_labels(self.label_names, label_values, ('le', format_value(bound))),
+                cumulative))
+        labels = format_labels(self.label_names, label_values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(counts[-2])))
+        lines.append('{}_count{} {}'.format(self.name, labels, counts[-1]))
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric_type, name, *args, **kwargs):
+        # Modules register their metrics at import, and may be reloaded or
+        # share a metric, so registering the same name again returns it
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_type(name, *args, **kwargs)
+            elif not isinstance(metric, metric_type):
+                raise ValueError('{} is already registered as a {}'.format(name, metric.kind))
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, description, label_names=()):
+    return REGISTRY.register(Counter, name, description, label_names)
+
+def histogram(name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram, name, description, label_names, buckets)
+
+def timed(metric, **labels):
+    """Decorator that observes how long each call takes in a histogram."""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with metric.time(**labels):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+#
+# Exporting
+#
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        content = REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        # scrapes would otherwise be printed to stderr
+        pass
+
+def start_daemon(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def start_http_server(port, address='127.0.0.1'):
+    """Serve /metrics on a background thread."""
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+    start_daemon(server.serve_forever)
+    return server
+
+def write_file(path):
+    # Write and rename so a reader never sees a partly written file
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(REGISTRY.render())
+    os.rename(temp_path, path)
+
+def start_file_writer(path, interval=60):
+    """Rewrite path with the current metrics every interval seconds."""
+    def write_periodically():
+        while True:
+            time.sleep(interval)
+            write_file(path)
+    return start_daemon(write_periodically)
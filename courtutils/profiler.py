@@ -0,0 +1,124 @@
+"""Sampling profiler for long-running workers.
+
+A background thread looks at every other thread's stack every few
+milliseconds with sys._current_frames and counts how often each stack was
+seen. Nothing is hooked into the code being profiled, so it's cheap enough
+to turn on in a production collector for a while. When a profiling window
+ends, the counts are written in the collapsed stack format used by
+flamegraph.pl and speedscope, one file per window:
+
+    MainThread;court_bulk_collector.py:run;...;opener.py:open 1234
+
+Profiling can be started at launch or toggled on a running worker with a
+signal (see install_signal_toggle).
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+log = logging.getLogger('logentries')
+
+DEFAULT_INTERVAL = 0.01
+DEFAULT_DURATION = 60
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+class SamplingProfiler(object):
+    def __init__(self, output_dir='.', interval=DEFAULT_INTERVAL,
+                 duration=DEFAULT_DURATION):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=None):
+        """Sample for duration seconds (the profiler's default if None, or
+        until stop is called if 0), then write the profile."""
+        with self.lock:
+            if self.running:
+                return False
+            if duration is None:
+                duration = self.duration
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self.run,
+                                           args=(duration, self.stopping),
+                                           name='SamplingProfiler')
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """End the current window early. The profile is still written."""
+        with self.lock:
+            if not self.running:
+                return False
+            self.stopping.set()
+            thread = self.thread
+        thread.join()
+        return True
+
+    def toggle(self):
+        if not self.stop():
+            self.start()
+
+    def run(self, duration, stopping):
+        log.info('Profiling for %s', '{} seconds'.format(duration) if duration else 'until stopped')
+        started = time.time()
+        own_id = threading.current_thread().ident
+        counts = {}
+        samples = 0
+        while not stopping.is_set():
+            if duration and time.time() - started >= duration:
+                break
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stack.reverse()
+                key = ';'.join(stack)
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            stopping.wait(self.interval)
+        path = self.write(counts, started)
+        log.info('Wrote %s samples over %.0f seconds to %s',
+                 samples, time.time() - started, path)
+
+    def write(self, counts, started):
+        filename = 'profile-{}-{}.collapsed'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(started)))
+        path = os.path.join(self.output_dir, filename)
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.iteritems()):
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+def install_signal_toggle(profiler, signal_name='SIGUSR2'):
+    """Start or stop profiler whenever the process gets the signal, e.g.
+    kill -USR2 <pid>. Returns False where the signal doesn't exist."""
+    signum = getattr(signal, signal_name, None)
+    if signum is None:
+        return False
+    def handle(signum, frame):
+        # Stopping waits for the sampler thread, which must not happen
+        # inside a signal handler on the main thread
+        thread = threading.Thread(target=profiler.toggle)
+        thread.daemon = True
+        thread.start()
+    signal.signal(signum, handle)
+    return True
@@ -0,0 +1,214 @@
+"""Circuit breakers and jittered exponential backoff.
+
+Retrying a failed request straight away, or from every worker at once,
+tends to make a struggling server worse. backoff_delay spreads retries out
+with "full jitter": a random delay up to an exponentially growing cap.
+
+A CircuitBreaker counts consecutive failures of one kind of call, e.g.
+requests to one endpoint of one court's site. After failure_threshold of
+them it opens, and calls fail fast with CircuitOpen for reset_seconds.
+Then it lets a single trial call through: if that succeeds the breaker
+closes, if not it opens again for twice as long, up to max_reset_seconds.
+
+A few slow responses can take most of a worker's time. HedgedCall makes a
+second, duplicate call when the first is taking longer than most (the 95th
+percentile in a LatencyWindow, say) and uses whichever answers first.
+"""
+import collections
+import logging
+import Queue
+import random
+import threading
+import time
+
+log = logging.getLogger('logentries')
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Seconds to wait before retry number attempt (counting from 0)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitOpen(Exception):
+    """Raised instead of making a call while its circuit breaker is open."""
+    def __init__(self, key, retry_at):
+        Exception.__init__(self, '{} is unavailable for {:.0f} more seconds'.format(
+            key, max(0, retry_at - time.time())))
+        self.key = key
+        self.retry_at = retry_at
+
+class CircuitBreaker(object):
+    def __init__(self, key, failure_threshold=5, reset_seconds=30,
+                 max_reset_seconds=600):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = None
+        self.trial_running = False
+
+    @property
+    def is_open(self):
+        return self.retry_at is not None and time.time() < self.retry_at
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may be made now."""
+        with self.lock:
+            if self.retry_at is None:
+                return
+            if time.time() < self.retry_at or self.trial_running:
+                raise CircuitOpen(self.key, self.retry_at)
+            # half open: this call is the trial
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            if self.retry_at is not None:
+                log.info('%s is available again', self.key)
+            self.failures = 0
+            self.trips = 0
+            self.retry_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if not self.trial_running and self.failures < self.failure_threshold:
+                return
+            self.trial_running = False
+            reset_seconds = min(self.max_reset_seconds,
+                                self.reset_seconds * 2 ** self.trips)
+            self.trips += 1
+            self.retry_at = time.time() + reset_seconds
+            log.warn('%s failed %s times in a row, not trying again for %s seconds',
+                     self.key, self.failures, reset_seconds)
+
+class BreakerRegistry(object):
+    """Circuit breakers by key, created on first use."""
+    def __init__(self, **options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(key, **self.options)
+            return self.breakers[key]
+
+    def open_keys(self):
+        with self.lock:
+            return [key for key, breaker in self.breakers.iteritems() if breaker.is_open]
+
+def call_with_retries(func, breaker=None, retries=3, is_retryable=None,
+                      base_delay=1.0, max_delay=30.0):
+    """Call func, retrying up to retries times with jittered exponential
+    backoff when it raises an exception is_retryable accepts (any exception
+    if None). Failures and successes are recorded on breaker, which can
+    stop the retries early by opening."""
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = func()
+        except Exception, err:
+            retryable = is_retryable is None or is_retryable(err)
+            if breaker is not None:
+                # an error that isn't worth retrying still means the
+                # other end is up
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if not retryable or attempt >= retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            log.warn('%s, retrying in %.1f seconds', err, delay)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+class LatencyWindow(object):
+    """The durations of the last size calls of some kind."""
+    def __init__(self, size=200, min_samples=20):
+        self.times = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.times.append(seconds)
+
+    def percentile(self, percent):
+        """The duration percent of recent calls finished within, or None
+        until there have been min_samples calls."""
+        with self.lock:
+            if len(self.times) < self.min_samples:
+                return None
+            times = sorted(self.times)
+        index = int(round(percent / 100.0 * (len(times) - 1)))
+        return times[index]
+
+def start_call(func, index, results):
+    def run():
+        try:
+            results.put((index, True, func()))
+        except Exception, err:
+            results.put((index, False, err))
+    thread = threading.Thread(target=run, name='HedgedCall')
+    thread.daemon = True
+    thread.start()
+
+def get_result(results, timeout=None):
+    """results.get(timeout=timeout), in waits of at most a second: on
+    Python 2 a blocking get can't be interrupted with Ctrl-C."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        wait = 1 if deadline is None else min(1, deadline - time.time())
+        try:
+            return results.get(timeout=max(wait, 0))
+        except Queue.Empty:
+            if deadline is not None and time.time() >= deadline:
+                raise
+
+class HedgedCall(object):
+    """Calls primary and, if it hasn't returned within delay seconds,
+    backup as well, each in its own thread. Pass None for backup to make no
+    hedge. hedged says whether backup was called.
+
+    The slower call is left to finish on its own, and its result dropped,
+    so both have to be safe to make twice.
+    """
+    def __init__(self, primary, backup, delay):
+        self.primary = primary
+        self.backup = backup
+        self.delay = delay
+        self.hedged = False
+
+    def run(self):
+        """Returns (index, result) for the first call to succeed, index 0
+        for primary and 1 for backup. If both fail, the error from primary
+        is raised."""
+        results = Queue.Queue()
+        start_call(self.primary, 0, results)
+        try:
+            first = get_result(results,
+                               self.delay if self.backup is not None else None)
+        except Queue.Empty:
+            self.hedged = True
+            start_call(self.backup, 1, results)
+            first = get_result(results)
+        errors = {}
+        while True:
+            index, succeeded, value = first
+            if succeeded:
+                return index, value
+            errors[index] = value
+            if len(errors) == (2 if self.hedged else 1):
+                raise errors.get(0, value)
+            first = get_result(results)
@@ -0,0 +1,127 @@
+"""Planning date tasks around work that's already done or scheduled.
+
+A task covers a court, a case type and a range of dates, searched from
+start_date back to end_date. Before creating tasks, the task creator looks
+up which dates in the requested range have already been searched or are
+in a queued or active task, and only creates tasks for the dates left.
+Gaps with just a few searched dates between them are merged into one task,
+since collectors skip dates that have been searched cheaply, and gaps
+longer than max_days are split so no single task holds up a court.
+
+A date's search goes stale after a TTL that depends on how far the date is
+from today, after which the date counts as not searched: the dockets for
+the coming days are still being filled in, while results for hearings long
+past hardly change.
+"""
+from datetime import datetime, timedelta
+
+# Longest range of dates in one created task
+MAX_TASK_DAYS = 180
+
+# Gaps separated by fewer searched dates than this become one task
+MERGE_DAYS = 7
+
+# How long a date's search, and its cached search results, stay fresh, by
+# how many days the date is from today
+SEARCH_TTLS = [
+    (-30, timedelta(days=30)),
+    (-7, timedelta(days=7)),
+    (0, timedelta(hours=12)),
+    (7, timedelta(hours=2)),
+    (None, timedelta(hours=6))
+]
+
+# No search is fresh for longer than this
+MAX_SEARCH_TTL = max(ttl for max_days, ttl in SEARCH_TTLS)
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def get_search_ttl(day, today=None):
+    if today is None:
+        today = datetime.now().date()
+    days_from_today = (to_date(day) - today).days
+    for max_days, ttl in SEARCH_TTLS:
+        if max_days is None or days_from_today <= max_days:
+            return ttl
+
+def is_search_fresh(day, searched, now=None):
+    """Whether a search of day made at searched is still within its TTL.
+    Searches recorded before they were timestamped are stale."""
+    if searched is None:
+        return False
+    if now is None:
+        now = datetime.now()
+    return searched >= now - get_search_ttl(day, now.date())
+
+def task_dates(start_date, end_date):
+    """The dates in a task running from start_date back to end_date."""
+    dates = set()
+    day = to_date(start_date)
+    end_date = to_date(end_date)
+    while day >= end_date:
+        dates.add(day)
+        day -= timedelta(days=1)
+    return dates
+
+def get_uncovered_ranges(start_date, end_date, covered, scheduled=frozenset(),
+                         max_days=MAX_TASK_DAYS, merge_days=MERGE_DAYS):
+    """Ranges of the dates from start_date back to end_date that aren't in
+    covered, a set of searched dates, or scheduled, a set of dates in
+    queued or active tasks, as (start, end) tuples, newest first. Gaps are
+    only merged across searched dates, so no range overlaps a task."""
+    start_date = to_date(start_date)
+    end_date = to_date(end_date)
+    one_day = timedelta(days=1)
+
+    gaps = []
+    # whether a scheduled date lies between the last gap and day
+    after_scheduled = False
+    day = start_date
+    while day >= end_date:
+        if day in scheduled:
+            after_scheduled = True
+        elif day not in covered:
+            if gaps and not after_scheduled and \
+                    (gaps[-1][1] - day).days <= merge_days:
+                gaps[-1][1] = day
+            else:
+                gaps.append([day, day])
+            after_scheduled = False
+        day -= one_day
+
+    ranges = []
+    for gap_start, gap_end in gaps:
+        while (gap_start - gap_end).days >= max_days:
+            range_end = gap_start - timedelta(days=max_days - 1)
+            ranges.append((gap_start, range_end))
+            gap_start = range_end - one_day
+        ranges.append((gap_start, gap_end))
+    return ranges
+
+def plan_date_tasks(db, fips_codes, case_type, start_date, end_date,
+                    max_days=MAX_TASK_DAYS):
+    """Tasks for the dates from start_date back to end_date, for each court
+    in fips_codes, that haven't been searched, or whose search has gone
+    stale, and aren't already in a queued or active task."""
+    covered = db.get_dates_searched(case_type, start_date, end_date)
+    scheduled = {}
+    for fips, ranges in db.get_date_task_ranges(case_type, start_date, end_date).iteritems():
+        dates = scheduled.setdefault(fips, set())
+        for task_start, task_end in ranges:
+            dates.update(task_dates(task_start, task_end))
+
+    tasks = []
+    for fips in fips_codes:
+        for range_start, range_end in get_uncovered_ranges(
+                start_date, end_date, covered.get(int(fips), set()),
+                scheduled.get(int(fips), set()), max_days):
+            tasks.append({
+                'fips': fips,
+                'start_date': range_start,
+                'end_date': range_end,
+                'case_type': case_type
+            })
+    return tasks
@@ -0,0 +1,156 @@
+"""Per-case timing breakdowns for the collectors.
+
+A Trace covers one unit of work, like collecting a case or searching a
+hearing date. While it is active on a thread, spans opened around the hot
+paths (fetching a page, parsing it, looking up and storing the case) add
+their time to the trace's stages:
+
+    trace = tracing.Trace('case', court='district', fips='059', ...)
+    with trace.active():
+        ...
+        with tracing.span('fetch'):
+            ...
+    tracing.record(trace)
+
+Spans are exclusive, so a span opened inside another only counts toward
+its own stage, and time not covered by any span (mostly the sleeps between
+requests) is left as 'other'. Spans outside an active trace cost next to
+nothing. Recorded traces feed the collector_stage_seconds histogram and, if
+configured, a sample of them is written to a JSONL file that
+court_trace_summary.py summarizes.
+"""
+import json
+import random
+import threading
+import time
+from courtutils import metrics
+
+STAGE_SECONDS = metrics.histogram(
+    'collector_stage_seconds', 'Time per unit of work spent in each stage',
+    ['kind', 'stage'])
+
+local = threading.local()
+
+def current_trace():
+    return getattr(local, 'trace', None)
+
+class Trace(object):
+    def __init__(self, kind, **attributes):
+        self.kind = kind
+        self.attributes = attributes
+        self.stages = {}
+        self.open_spans = []
+        self.start = time.time()
+        self.elapsed = 0.0
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_elsewhere(self, stage, seconds):
+        """Add time spent on this trace's work off this thread, like parsing
+        in a worker process."""
+        self.add(stage, seconds)
+        self.elapsed += seconds
+
+    def active(self):
+        """Context manager that makes this the thread's current trace.
+        A trace can be activated more than once, e.g. while a case is
+        fetched and again when it is stored after being parsed elsewhere;
+        only the time it is active counts toward its total."""
+        return ActiveTrace(self)
+
+    def to_dict(self):
+        stages = dict(self.stages)
+        stages['other'] = max(self.elapsed - sum(self.stages.values()), 0.0)
+        data = dict(self.attributes)
+        data.update({
+            'kind': self.kind,
+            'start': self.start,
+            'total': self.elapsed,
+            'stages': stages
+        })
+        return data
+
+class ActiveTrace(object):
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = current_trace()
+        self.start = time.time()
+        local.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        self.trace.elapsed += time.time() - self.start
+        local.trace = self.previous
+        return False
+
+class Span(object):
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.trace = current_trace()
+        if self.trace is not None:
+            # [start, time spent in spans opened inside this one]
+            self.state = [time.time(), 0.0]
+            self.trace.open_spans.append(self.state)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.trace is None:
+            return False
+        open_spans = self.trace.open_spans
+        open_spans.pop()
+        elapsed = time.time() - self.state[0]
+        self.trace.add(self.stage, elapsed - self.state[1])
+        if len(open_spans) > 0:
+            open_spans[-1][1] += elapsed
+        return False
+
+def span(stage):
+    return Span(stage)
+
+def traced(stage):
+    """Decorator that runs each call in a span."""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with Span(stage):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+#
+# Recording
+#
+class TraceFile(object):
+    def __init__(self, path, sample_rate):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        # line buffered, so traces survive the collector being killed
+        self.file = open(path, 'a', 1)
+
+    def write(self, data):
+        if random.random() >= self.sample_rate:
+            return
+        line = json.dumps(data, sort_keys=True, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+TRACE_FILE = None
+
+def configure(path, sample_rate=1.0):
+    """Append a sample_rate fraction of recorded traces to path."""
+    global TRACE_FILE
+    TRACE_FILE = TraceFile(path, sample_rate)
+
+def record(trace):
+    data = trace.to_dict()
+    for stage, seconds in data['stages'].iteritems():
+        STAGE_SECONDS.observe(seconds, kind=trace.kind, stage=stage)
+    if TRACE_FILE is not None:
+        TRACE_FILE.write(data)
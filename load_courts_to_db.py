@@ -4,12 +4,15 @@ from courtreader import readers
 
 MONGO = False
 POSTGRES = True
+SQLITE = False
 
 if MONGO:
     import pymongo
     from courtutils.databases.mongo import MongoDatabase
 if POSTGRES:
     from courtutils.databases.postgres import PostgresDatabase
+if SQLITE:
+    from courtutils.databases.sqlite import SqliteDatabase
 
 #geolocator = GoogleV3(api_key=os.environ['GOOGLE_API_KEY'])
 
@@ -17,6 +20,7 @@ print 'CIRCUIT COURT'
 circuit_db = None
 if MONGO: circuit_db = MongoDatabase('va_court_search', 'circuit')
 if POSTGRES: circuit_db = PostgresDatabase('circuit')
+if SQLITE: circuit_db = SqliteDatabase('circuit')
 circuit_db.drop_courts()
 reader = readers.CircuitCourtReader()
 courts = reader.connect()
@@ -40,6 +44,7 @@ print 'DISTRICT COURT'
 district_db = None
 if MONGO: district_db = MongoDatabase('va_court_search', 'district')
 if POSTGRES: district_db = PostgresDatabase('district')
+if SQLITE: district_db = SqliteDatabase('district')
 district_db.drop_courts()
 reader = readers.DistrictCourtReader()
 courts = reader.connect()